@@ -0,0 +1,582 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""An asyncio (or uasyncio) version of the client, so that talking to
+devices can overlap with everything else going on.
+
+The SOAP requests are built and parsed with the same code as `upnp`, and
+the topology with the same code as `discovery`. Only the I/O is different.
+"""
+
+import io
+import time
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+import discovery
+import scpd
+import sonos
+import upnp
+
+
+async def _read_response(reader, status_line):
+    """Reads the rest of a response from `reader`, after its `status_line`,
+    returning (status, headers, body, keep_alive)."""
+    status = int(status_line.split(None, 2)[1])
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise OSError('Connection closed by device')
+        line = line.strip()
+        if not line:
+            break
+        name, value = upnp._parse_header(line)
+        headers[name] = value
+
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+        keep_alive = headers.get('connection', '').lower() != 'close'
+    else:
+        # No length, so the device will close the socket when it's done.
+        body = await reader.read(-1)
+        keep_alive = False
+    return status, headers, body, keep_alive
+
+
+def _close(writer):
+    try:
+        writer.close()
+    except RuntimeError:
+        # CPython: the event loop it belonged to has already gone.
+        pass
+
+
+class ConnectionPool:
+    """The asyncio equivalent of `upnp.ConnectionPool`: keeps keep-alive
+    connections to each device, keyed on 'host:port'.
+
+    Connections can only be re-used from the event loop they were made in,
+    so it's best to keep one loop running rather than calling `run()` again
+    and again.
+    """
+
+    def __init__(self, idle_timeout=upnp.DEFAULT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        # Values are lists of (reader, writer, last_used, loop).
+        self._idle = dict()
+
+    def _acquire(self, key):
+        connections = self._idle.get(key)
+        now = time.time()
+        loop = asyncio.get_event_loop()
+        while connections:
+            reader, writer, last_used, connection_loop = connections.pop()
+            if now - last_used < self.idle_timeout and connection_loop is loop:
+                return reader, writer
+            _close(writer)
+        return None, None
+
+    def close(self):
+        """Closes all idle connections."""
+        for connections in self._idle.values():
+            for _, writer, _, _ in connections:
+                _close(writer)
+        self._idle = dict()
+
+    def breaker(self, host, port):
+        """Returns the CircuitBreaker for a device. These are shared with
+        `upnp.connection_pool`, so that a device which has stopped responding
+        to one isn't waited on by the other."""
+        return upnp.connection_pool.breaker(host, port)
+
+    async def request(self, method, url, headers, body=b'', timeout=None):
+        """Makes a request, re-using an idle connection if there is one.
+        Returns (status, headers, body).
+
+        If a `timeout` (in seconds) is given, `upnp.Timeout` is raised if the
+        request isn't done by then. Like `upnp.ConnectionPool`, requests to
+        a device whose circuit breaker is open raise `upnp.CircuitOpen`
+        straight away.
+        """
+        host, port, path = upnp._split_url(url)
+        breaker = self.breaker(host, port)
+        if not breaker.allow():
+            raise upnp.CircuitOpen('%s:%d is not responding' % (host, port))
+        request = self._request(host, port, method, path, headers, body)
+        try:
+            if timeout is None:
+                response = await request
+            else:
+                response = await asyncio.wait_for(request, timeout)
+        except asyncio.TimeoutError:
+            breaker.failed()
+            raise upnp.Timeout('Timed out talking to %s' % host)
+        except (OSError, EOFError):
+            breaker.failed()
+            raise
+        except Exception:
+            # The device is there, even if we didn't like what it said.
+            breaker.succeeded()
+            raise
+        except BaseException:
+            # Cancelled, so we haven't found out either way.
+            breaker.released()
+            raise
+        breaker.succeeded()
+        return response
+
+    async def _request(self, host, port, method, path, headers, body):
+        key = '%s:%d' % (host, port)
+        head = upnp._request_head(method, path, host, port, headers, len(body))
+        if isinstance(body, upnp._StreamedBody):
+            # Written a piece at a time, rather than built in memory.
+            request = (head, body)
+        else:
+            request = (head + body,)
+
+        reader, writer = self._acquire(key)
+        response = None
+        try:
+            status_line = b''
+            if reader is not None:
+                try:
+                    status_line = await self._send(reader, writer, request)
+                except OSError:
+                    pass
+                if not status_line:
+                    # The device dropped the socket since we last used it,
+                    # before seeing the request. Try again (once) on a fresh
+                    # connection.
+                    _close(writer)
+                    reader = writer = None
+            if reader is None:
+                reader, writer = await asyncio.open_connection(host, port)
+                status_line = await self._send(reader, writer, request)
+                if not status_line:
+                    raise OSError('Connection closed by device')
+            response = await _read_response(reader, status_line)
+        finally:
+            if response is None and writer is not None:
+                # Failed (or timed out) part-way through, so it can't be
+                # re-used.
+                _close(writer)
+
+        status, resp_headers, resp_body, keep_alive = response
+        if keep_alive:
+            self._idle.setdefault(key, []).append(
+                (reader, writer, time.time(), asyncio.get_event_loop())
+            )
+        else:
+            _close(writer)
+        return status, resp_headers, resp_body
+
+    async def _send(self, reader, writer, request):
+        """Sends `request` (a tuple of bytes or `upnp._StreamedBody`),
+        returning the status line of the response (or b'' if the device
+        closed the connection instead of answering)."""
+        for part in request:
+            if isinstance(part, upnp._StreamedBody):
+                for piece in part._pieces():
+                    writer.write(piece)
+                    await writer.drain()
+            else:
+                writer.write(part)
+        await writer.drain()
+        return await reader.readline()
+
+
+# Shared by all devices, unless a different pool is passed to send_command().
+connection_pool = ConnectionPool()
+
+
+async def send_command(url, service_type, version, action, arguments, pool=None,
+                       timeout=upnp.DEFAULT_TIMEOUT):
+    """The asyncio version of `upnp.send_command()`, with the same `timeout`
+    and circuit breakers.
+
+    The response is read in full before it is parsed, as the parser pulls
+    from a file-like object and can't wait on the network.
+    """
+    headers, soap = upnp.build_command(service_type, version, action, arguments)
+    if pool is None:
+        pool = connection_pool
+    status, _, body = await pool.request('POST', url, headers, soap, timeout=timeout)
+    if status == 200:
+        return upnp.parse_response(action, io.StringIO(body.decode('utf-8')))
+    else:
+        raise Exception('UPnP command failed: %s' % body.decode('utf-8'))
+
+
+async def _get(url, parse, pool=None):
+    """The asyncio version of `scpd._get()`. The response is read in full,
+    for the same reason as in `send_command()`."""
+    if pool is None:
+        pool = connection_pool
+    status, _, body = await pool.request('GET', url, {}, timeout=upnp.DEFAULT_TIMEOUT)
+    if status != 200:
+        raise Exception('GET %s failed: %d' % (url, status))
+    return parse(io.StringIO(body.decode('utf-8')))
+
+
+async def _fetch_services(base_url, services):
+    fetched = dict()
+    for service in services:
+        scpd_url = service['SCPDURL']
+        if not scpd_url.startswith('/'):
+            scpd_url = '/' + scpd_url
+        fetched[scpd._service_name(service['controlURL'])] = dict(
+            service_type=service['serviceType'],
+            control_url=service['controlURL'],
+            actions=await _get(base_url + scpd_url, scpd.parse_scpd),
+        )
+    return fetched
+
+
+async def describe(base_url, uuid=None, software_version=None, cache=None):
+    """The asyncio version of `scpd.describe()`, sharing its cache."""
+    if cache is None:
+        cache = scpd.description_cache
+    if uuid is not None and software_version is not None:
+        description = cache.get(uuid, software_version)
+        if description is not None:
+            return description
+
+    description = await _get(
+        base_url + scpd.DEVICE_DESCRIPTION_PATH, scpd.parse_device_description
+    )
+    cached = cache.get_model(description['model'], description['software_version'])
+    if cached is not None:
+        description = cached
+    else:
+        description['services'] = await _fetch_services(base_url, description['services'])
+    if uuid is not None:
+        cache.put(uuid, description)
+    return description
+
+
+class Action(scpd.Action):
+    """An `scpd.Action` which is called as a coroutine."""
+
+    async def __call__(self, *args, **kwargs):
+        response = await self.service._send(
+            self.service.control_url, self.service.service_type, self.name,
+            self._arguments(args, kwargs)
+        )
+        return self._results(response)
+
+
+class CommandQueue(sonos.CommandQueue):
+    """The asyncio version of `sonos.CommandQueue`, for an AsyncSonos.
+
+    `submit()` still never blocks: if nothing is sending commands already,
+    it starts a task to, so it has to be called from the event loop.
+    `pump()` is a coroutine.
+    """
+
+    def __init__(self, device):
+        super().__init__(device, threaded=False)
+
+    def submit(self, command, value=1):
+        super().submit(command, value)
+        if not self._busy:
+            self._busy = True
+            asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            await self._pump()
+        except Exception as e:
+            self.error = e
+            self._busy = False
+
+    async def pump(self):
+        if self._busy:
+            return 0
+        self._busy = True
+        try:
+            return await self._pump()
+        finally:
+            self._busy = False
+
+    async def _pump(self):
+        requests = 0
+        while True:
+            taken = self._take()
+            if taken is None:
+                return requests
+            for call, cost in self._calls(taken):
+                await call()
+                requests += cost
+
+
+class _Browse:
+    """What `AsyncSonos.browse()` returns, to be iterated over with `async
+    for`. Like `sonos.Sonos.browse()`, the next page is fetched (from a
+    task) while the current one is being gone through."""
+
+    def __init__(self, device, object_id, page_size):
+        self._device = device
+        self._object_id = object_id
+        self._page_size = page_size
+        self._start = 0
+        # The task fetching the next page, or None if there are no more.
+        self._page = None
+        self._started = False
+        # BrowseItems from the current page.
+        self._items = None
+
+    def __aiter__(self):
+        return self
+
+    def _fetch(self, start):
+        return asyncio.create_task(self._device._browse(self._object_id, start, self._page_size))
+
+    async def __anext__(self):
+        if not self._started:
+            self._started = True
+            self._page = self._fetch(0)
+        while True:
+            if self._items is not None:
+                try:
+                    return next(self._items)
+                except StopIteration:
+                    self._items = None
+            if self._page is None:
+                raise StopAsyncIteration
+            response = await self._page
+            self._start = sonos._next_page_start(response, self._start)
+            self._page = None if self._start is None else self._fetch(self._start)
+            self._items = sonos._browse_items(response)
+
+
+class AsyncSonos(sonos.Sonos):
+    """A Sonos device with coroutine versions of the `sonos.Sonos` methods.
+
+    Cached players (see `discovery.discover_cached()`) aren't supported, as
+    checking them has to block.
+    """
+
+    async def _send_command(self, path, service_type, action, args):
+        return await send_command(
+            self._base_url + path, service_type, 1, action, args,
+            timeout=self.timeout
+        )
+
+    async def play(self):
+        await self._issue_av_transport_command('Play')
+
+    async def pause(self):
+        await self._issue_av_transport_command('Pause')
+
+    async def next(self):
+        await self._issue_av_transport_command('Next')
+
+    async def previous(self):
+        await self._issue_av_transport_command('Previous')
+
+    async def _skip(self, tracks):
+        if tracks == 1:
+            await self.next()
+        elif tracks == -1:
+            await self.previous()
+        else:
+            response = await self._get_position_info()
+            await self._seek_track(max(1, int(response['Track']) + tracks))
+
+    async def add_uris_to_queue(self, tracks, position=0, as_next=False,
+                                chunk_size=sonos.MAX_URIS_PER_ADD):
+        enqueuer = sonos._Enqueuer(position, as_next)
+        for chunk in sonos._chunks(tracks, chunk_size):
+            enqueuer.added_chunk(await self._issue_av_transport_command(
+                'AddMultipleURIsToQueue', enqueuer.arguments(chunk)
+            ), len(chunk))
+        return enqueuer.first, enqueuer.added
+
+    async def get_volume(self):
+        response = await self._issue_rendering_control_command('GetVolume', [
+            ('InstanceID', 0),
+            ('Channel', 'Master'),
+        ])
+        self.volume = int(response['CurrentVolume'])
+        return self.volume
+
+    async def set_volume(self, volume):
+        volume = max(0, min(100, volume))
+        await self._issue_rendering_control_command('SetVolume', [
+            ('InstanceID', 0),
+            ('Channel', 'Master'),
+            ('DesiredVolume', volume),
+        ])
+        self.volume = volume
+
+    async def adjust_volume(self, adjustment):
+        response = await self._issue_rendering_control_command('SetRelativeVolume', [
+            ('InstanceID', 0),
+            ('Channel', 'Master'),
+            ('Adjustment', adjustment),
+        ])
+        self.volume = int(response['NewVolume'])
+        return self.volume
+
+    async def get_group_volume(self):
+        response = await self._issue_group_rendering_control_command('GetGroupVolume', [])
+        self.group_volume = int(response['CurrentVolume'])
+        return self.group_volume
+
+    async def set_group_volume(self, volume):
+        volume = max(0, min(100, volume))
+        await self._issue_group_rendering_control_command('SnapshotGroupVolume', [])
+        await self._issue_group_rendering_control_command('SetGroupVolume', [
+            ('DesiredVolume', volume),
+        ])
+        self.group_volume = volume
+
+    async def adjust_group_volume(self, adjustment):
+        response = await self._issue_group_rendering_control_command('SetRelativeGroupVolume', [
+            ('Adjustment', adjustment),
+        ])
+        self.group_volume = int(response['NewVolume'])
+        return self.group_volume
+
+    @property
+    def services(self):
+        """A coroutine giving the same as `sonos.Sonos.services`, except that
+        each action is called as a coroutine:
+
+            > services = await speaker.services
+            > await services['AVTransport'].Play(0, 1)
+        """
+        return self._get_services()
+
+    async def _get_services(self):
+        if self._services is None:
+            description = await describe(self._base_url, self.uuid, self.software_version)
+            self._services = scpd.services(description, self._send_command, Action)
+        return self._services
+
+    def browse(self, object_id=sonos.QUEUE, page_size=sonos.DEFAULT_BROWSE_PAGE_SIZE):
+        """Like `sonos.Sonos.browse()`, but to be iterated over with `async
+        for`."""
+        return _Browse(self, object_id, page_size)
+
+    @property
+    def commands(self):
+        """This device's `CommandQueue`. Commands are sent from a task, so
+        `submit()` has to be called from the event loop."""
+        if self._commands is None:
+            self._commands = CommandQueue(self)
+        return self._commands
+
+    async def get_current_track_info(self):
+        response = await self._get_position_info()
+        return self._track_info_from_response(response)
+
+    async def get_transport_state(self):
+        response = await self._issue_av_transport_command('GetTransportInfo', [
+            ('InstanceID', 0),
+        ])
+        return response['CurrentTransportState']
+
+    async def track_info(self, resync_interval=sonos.DEFAULT_RESYNC_INTERVAL_MS):
+        now = upnp.ticks_ms()
+        if self._track_info_due(resync_interval, now):
+            state = await self.get_transport_state()
+            response = await self._get_position_info()
+            self._track_info = self._track_info_from_response(response, state)
+            self._track_info_at = now
+        return self._track_info
+
+
+async def broadcast(speakers, command, args=None):
+    """The asyncio version of `sonos.broadcast()`. Works with any Sonos
+    instances, not just AsyncSonos."""
+    speakers = list(speakers)
+    if args is None:
+        args = [('InstanceID', 0), ('Speed', 1)]
+    results = await asyncio.gather(*[
+        send_command(
+            speaker._base_url + '/MediaRenderer/AVTransport/Control',
+            'AVTransport', 1, command, args, timeout=speaker.timeout
+        )
+        for speaker in speakers
+    ], return_exceptions=True)
+    return list(zip(speakers, results))
+
+
+async def _recv_datagram(sock, size):
+    """Waits for a datagram to arrive on non-blocking `sock`, and returns
+    it, letting other tasks run in the meantime."""
+    loop = asyncio.get_event_loop()
+    if hasattr(loop, 'sock_recvfrom'):
+        # CPython 3.11 and later.
+        data, _ = await loop.sock_recvfrom(sock, size)
+        return data
+    if hasattr(loop, 'add_reader'):
+        # Older CPythons.
+        readable = loop.create_future()
+        loop.add_reader(sock.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(sock.fileno())
+        data, _ = sock.recvfrom(size)
+        return data
+    # uasyncio only waits on streams, which then read a datagram at a time.
+    return await asyncio.StreamReader(sock).read(size)
+
+
+async def _discover_ip(timeout=discovery.DEFAULT_DISCOVER_TIMEOUT):
+    """The asyncio version of `discovery._discover_ip()`."""
+    devices = discovery.known_devices.devices()
+    if devices:
+        return devices[0]['ip']
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        for _ in range(3):
+            sock.sendto(discovery.PLAYER_SEARCH, discovery.SSDP_ADDRESS)
+        deadline = upnp.ticks_add(upnp.ticks_ms(), int(timeout * 1000))
+        while True:
+            remaining = upnp.ticks_diff(deadline, upnp.ticks_ms())
+            if remaining <= 0:
+                break
+            # Sleep until something arrives (or we run out of time), rather
+            # than spin on the socket.
+            try:
+                data = await asyncio.wait_for(_recv_datagram(sock, 1024), remaining / 1000)
+            except asyncio.TimeoutError:
+                break
+            device = discovery._parse_ssdp_response(data)
+            if device is not None:
+                discovery.known_devices.add(device)
+                return device['ip']
+    finally:
+        sock.close()
+
+
+async def discover(timeout=discovery.DEFAULT_DISCOVER_TIMEOUT):
+    """The asyncio version of `discovery.discover()`. Returns a list of an
+    AsyncSonos for each coordinator on the network."""
+    ip = await _discover_ip(timeout)
+    assert ip is not None, 'Could not find Sonos device'
+    response = await send_command(
+        sonos.BASE_URL_TEMPLATE % ip + '/ZoneGroupTopology/Control',
+        'ZoneGroupTopology', 1, 'GetZoneGroupState', []
+    )
+    groups = discovery._parse_zone_groups(response.stream('ZoneGroupState'))
+    return [discovery._build_coordinator(group, cls=AsyncSonos) for group in groups]
+
+
+def run(coro):
+    """Runs `coro` to completion, returning its result."""
+    return asyncio.run(coro)
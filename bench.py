@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Benchmarks against a fake household on localhost.
+
+A FakeSonos serves recorded AVTransport and ZoneGroupTopology responses for
+a household of `--players` speakers, each response delayed by `--latency`
+milliseconds, and a FakeSSDPResponder answers for all of them. Each
+benchmark reports its timings and how much heap it needed, and the results
+are printed as a single JSON document so that runs can be compared:
+
+    python bench.py --players 12 --latency 5 > before.json
+
+This runs under CPython and the MicroPython Unix port. On CPython, the heap
+figure is the peak traced by tracemalloc. MicroPython can't tell us the
+peak, so the GC is disabled while measuring and the figure is everything
+allocated, which is an upper bound.
+"""
+
+import gc
+import sys
+import time
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import discovery
+import sonos
+import testhelpers
+import upnp
+
+
+DEFAULT_PLAYERS = 6
+DEFAULT_LATENCY_MS = 0
+DEFAULT_ITERATIONS = 20
+
+# Recorded from a Play:1, with the album art URI shortened.
+TRACK_METADATA = (
+    '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
+    'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+    'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
+    'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+    '<item id="-1" parentID="-1" restricted="true">'
+    '<res protocolInfo="sonos.com-spotify:*:audio/x-spotify:*" duration="0:04:21">'
+    'x-sonos-spotify:spotify%3atrack%3a0?sid=9&amp;flags=8224&amp;sn=1</res>'
+    '<r:streamContent></r:streamContent>'
+    '<upnp:albumArtURI>/getaa?s=1&amp;u=x-sonos-spotify</upnp:albumArtURI>'
+    '<dc:title>Impossible Germany</dc:title>'
+    '<upnp:class>object.item.audioItem.musicTrack</upnp:class>'
+    '<dc:creator>Wilco</dc:creator>'
+    '<upnp:album>Sky Blue Sky</upnp:album>'
+    '</item></DIDL-Lite>'
+)
+
+
+def _escape(xml):
+    return (xml
+        .replace('&', '&amp;')
+        .replace('<', '&lt;')
+        .replace('>', '&gt;')
+        .replace('"', '&quot;')
+    )
+
+
+def _player_uuid(idx):
+    return 'RINCON_BENCH%012d' % idx
+
+
+def topology_xml(players, group_size=2):
+    """Builds a <ZoneGroups> document for `players` speakers at 127.0.0.1,
+    in groups of (up to) `group_size`, with every attribute a real device
+    gives."""
+    groups = []
+    for start in range(0, players, group_size):
+        members = []
+        for idx in range(start, min(start + group_size, players)):
+            members.append(
+                '<ZoneGroupMember UUID="%s" '
+                'Location="http://127.0.0.1:1400/xml/device_description.xml" '
+                'ZoneName="Room %d" Icon="x-rincon-roomicon:living" '
+                'Configuration="1" SoftwareVersion="34.7-33240-Wilco_Release" '
+                'MinCompatibleVersion="33.0-00000" LegacyCompatibleVersion="25.0-00000" '
+                'BootSeq="%d" WirelessMode="1" WirelessLeafOnly="0" '
+                'HasConfiguredSSID="1" ChannelFreq="2437" BehindWifiExtender="0" '
+                'WifiEnabled="1" Orientation="0" RoomCalibrationState="4" '
+                'SecureRegState="3"/>' % (_player_uuid(idx), idx, idx + 10)
+            )
+        groups.append('<ZoneGroup Coordinator="%s" ID="%s:%d">%s</ZoneGroup>' % (
+            _player_uuid(start), _player_uuid(start), start, ''.join(members)
+        ))
+    return '<ZoneGroups>%s</ZoneGroups>' % ''.join(groups)
+
+
+def fake_responses(players):
+    return {
+        'Play': [],
+        'Pause': [],
+        'GetPositionInfo': [
+            ('Track', '1'),
+            ('TrackDuration', '0:04:21'),
+            ('TrackMetaData', _escape(TRACK_METADATA)),
+            ('TrackURI', 'x-sonos-spotify:spotify%3atrack%3a0'),
+            ('RelTime', '0:01:02'),
+            ('AbsTime', 'NOT_IMPLEMENTED'),
+            ('RelCount', '2147483647'),
+            ('AbsCount', '2147483647'),
+        ],
+        'GetZoneGroupState': [('ZoneGroupState', _escape(topology_xml(players)))],
+    }
+
+
+if hasattr(time, 'ticks_us'):
+    def _now_us():
+        return time.ticks_us()
+
+    def _elapsed_us(start):
+        return time.ticks_diff(time.ticks_us(), start)
+else:
+    def _now_us():
+        return time.perf_counter()
+
+    def _elapsed_us(start):
+        return int((time.perf_counter() - start) * 1000000)
+
+
+def _heap_start():
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        return tracemalloc.get_traced_memory()[0]
+    gc.disable()
+    return gc.mem_alloc()
+
+
+def _heap_stop(start):
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = gc.mem_alloc()
+        gc.enable()
+    return peak - start
+
+
+def measure(name, fn, iterations, operations=1):
+    """Calls `fn()` `iterations` times, returning a dict of results.
+
+    `operations` is how many requests (or whatever is being counted) each
+    call makes, for working out the throughput. The heap is measured over a
+    separate, final call, so that tracing doesn't slow down the timings.
+    """
+    # Warm up, so that connections are already open and the SOAP actions
+    # compiled.
+    fn()
+    timings = []
+    for _ in range(iterations):
+        start = _now_us()
+        fn()
+        timings.append(_elapsed_us(start))
+    heap_start = _heap_start()
+    try:
+        fn()
+    finally:
+        heap = _heap_stop(heap_start)
+    total_us = sum(timings)
+    timings.sort()
+    return dict(
+        name=name,
+        iterations=iterations,
+        mean_ms=total_us / iterations / 1000,
+        median_ms=timings[len(timings) // 2] / 1000,
+        min_ms=timings[0] / 1000,
+        max_ms=timings[-1] / 1000,
+        ops_per_sec=operations * iterations * 1000000 / total_us if total_us else None,
+        heap_bytes=heap,
+    )
+
+
+def run(players=DEFAULT_PLAYERS, latency_ms=DEFAULT_LATENCY_MS, iterations=DEFAULT_ITERATIONS):
+    """Runs every benchmark against a fake household, returning a dict of
+    the settings and a list of results."""
+    device = testhelpers.FakeSonos(fake_responses(players), latency=latency_ms / 1000)
+    responder = testhelpers.FakeSSDPResponder([
+        testhelpers.ssdp_response(_player_uuid(idx), '127.0.0.1')
+        for idx in range(players)
+    ])
+    original_template = sonos.BASE_URL_TEMPLATE
+    original_address = discovery.SSDP_ADDRESS
+    sonos.BASE_URL_TEMPLATE = 'http://%%s:%d' % device.port
+    discovery.SSDP_ADDRESS = responder.address
+    try:
+        def discover():
+            discovery.known_devices.clear()
+            coordinators = list(discovery.discover(timeout=1))
+            assert len(coordinators) == (players + 1) // 2
+            return coordinators
+
+        def topology():
+            return discovery.query_zone_group_topology('127.0.0.1')
+
+        coordinators = discover()
+        speakers = []
+        for coordinator in coordinators:
+            speakers.append(coordinator)
+            speakers.extend(coordinator.other_players)
+        speaker = speakers[0]
+
+        results = [
+            measure('discover', discover, iterations),
+            measure('query_zone_group_topology', topology, iterations),
+            measure('get_current_track_info', speaker.get_current_track_info, iterations),
+            measure('play', speaker.play, iterations),
+            measure(
+                'broadcast_play',
+                lambda: sonos.broadcast(speakers, 'Play'),
+                iterations, len(speakers)
+            ),
+        ]
+    finally:
+        sonos.BASE_URL_TEMPLATE = original_template
+        discovery.SSDP_ADDRESS = original_address
+        upnp.connection_pool.close()
+        responder.stop()
+        device.stop()
+    return dict(
+        implementation=sys.implementation.name,
+        players=players,
+        latency_ms=latency_ms,
+        results=results,
+    )
+
+
+def _parse_args(argv):
+    """Parses `--players N --latency MS --iterations N`. MicroPython doesn't
+    have argparse."""
+    options = dict(players=DEFAULT_PLAYERS, latency=DEFAULT_LATENCY_MS,
+                   iterations=DEFAULT_ITERATIONS)
+    args = list(argv)
+    while args:
+        name = args.pop(0)
+        if not name.startswith('--') or name[2:] not in options or not args:
+            raise SystemExit('usage: bench.py [--players N] [--latency MS] [--iterations N]')
+        options[name[2:]] = int(args.pop(0))
+    return options
+
+
+if __name__ == '__main__':
+    options = _parse_args(sys.argv[1:])
+    print(json.dumps(run(options['players'], options['latency'], options['iterations'])))
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""A small HTTP/JSON server which lets any number of clients share one
+view of the household, so that adding another dashboard doesn't add any
+load on the speakers.
+
+The bridge discovers the coordinators (through a TopologyCache) and polls
+each of them, using `Sonos.track_info()` so that the position is only
+resynced now and again. Clients get what it last saw:
+
+    GET /state              {"version": 3, "error": null, "devices": [...]}
+    GET /state?since=3      waits until the version isn't 3 (long-poll)
+    POST /devices/<uuid>/<command>[?value=N]
+
+Commands are those a `sonos.CommandQueue` understands ('Play', 'Pause',
+'Next', 'Previous', 'SetRelativeVolume', 'SetRelativeGroupVolume'), so a
+burst of them from several clients still turns into a few requests.
+
+Like `events.EventListener`, nothing happens in the background: call
+`step()` from your main loop, or `serve_forever()`.
+"""
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import uselect as select
+except ImportError:
+    import select
+
+import discovery
+import upnp
+
+
+DEFAULT_BRIDGE_PORT = 8080
+# How often each device is checked on, in milliseconds. Most of the time
+# this doesn't need a request (see `Sonos.track_info()`).
+DEFAULT_POLL_INTERVAL = 1000
+# How often the position is actually asked for, in milliseconds.
+DEFAULT_RESYNC_INTERVAL = 30000
+# How long to wait before trying discovery again after it fails, in
+# milliseconds. This doubles with each failure, up to the maximum.
+DISCOVERY_RETRY_INTERVAL = 5000
+MAX_DISCOVERY_RETRY_INTERVAL = 60000
+# How long a long-poll is held open before being answered anyway, in
+# milliseconds.
+LONG_POLL_TIMEOUT = 25000
+# Don't let long-polls pile up without limit.
+MAX_WAITING = 32
+# How much of a bad request to read before closing it.
+DRAIN_SIZE = 512
+MAX_DRAIN_READS = 8
+
+
+def _parse_query(query):
+    """Parses 'a=1&b=2' into a dict."""
+    params = {}
+    for pair in query.split('&'):
+        name, _, value = pair.partition('=')
+        if name:
+            params[name] = value
+    return params
+
+
+def _track_state(track_info):
+    if track_info is None:
+        return None
+    return dict(
+        title=track_info.title,
+        artist=track_info.artist,
+        album=track_info.album,
+        duration=track_info.duration,
+        # As of when it was sampled, rather than now, so that it doesn't
+        # change every second. Clients can count on from here while the
+        # state is PLAYING.
+        position=track_info.position,
+        state=track_info.state,
+    )
+
+
+class Bridge:
+    """Serves the state of a household, polled from one place, to any
+    number of clients."""
+
+    def __init__(self, port=DEFAULT_BRIDGE_PORT, poll_interval=DEFAULT_POLL_INTERVAL,
+                 resync_interval=DEFAULT_RESYNC_INTERVAL, discover=None):
+        self.poll_interval = poll_interval
+        self.resync_interval = resync_interval
+        self.cache = discovery.TopologyCache()
+        self._discover = discovery.discover if discover is None else discover
+        # Coordinators, keyed on UUID.
+        self.devices = dict()
+        # Why discovery last failed, or None if it didn't.
+        self.error = None
+        # When to try discovery again after a failure, and how long to wait
+        # after the next one.
+        self._next_discovery = None
+        self._discovery_retry = DISCOVERY_RETRY_INTERVAL
+        # What we last saw of each device, keyed on UUID.
+        self.state = dict()
+        # Bumped whenever `state` changes.
+        self.version = 0
+        # Long-polls: (client socket, version, when to give up) for each.
+        self._waiting = []
+        self._next_poll = upnp.ticks_ms()
+        self._running = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(socket.getaddrinfo('0.0.0.0', port)[0][-1])
+        self.sock.listen(5)
+        if port == 0:
+            port = self.sock.getsockname()[1]
+        self.port = port
+        self._poller = select.poll()
+        self._poller.register(self.sock, select.POLLIN)
+
+    def poll(self):
+        """Checks on every device, updating `state` (and `version`) with
+        anything that has changed. If discovery fails, the devices found
+        last time are checked on instead, the error kept in `error`, and
+        discovery isn't tried again for a while."""
+        changed = self._update_devices()
+        devices = self.devices
+        for uuid in list(self.state):
+            if uuid not in devices:
+                del self.state[uuid]
+                changed = True
+        for uuid, device in devices.items():
+            # Send anything clients have asked for, if the queue doesn't have
+            # a thread of its own to do it.
+            try:
+                device.commands.pump()
+                error = None
+            except Exception as e:
+                error = str(e)
+            try:
+                track = _track_state(device.track_info(self.resync_interval))
+            except Exception as e:
+                track = None
+                error = str(e)
+            state = dict(
+                uuid=uuid,
+                name=device.name,
+                ip=device.ip,
+                players=[player.name for player in device.other_players],
+                track=track,
+                volume=device.volume,
+                group_volume=device.group_volume,
+                error=error,
+            )
+            if self.state.get(uuid) != state:
+                self.state[uuid] = state
+                changed = True
+        if changed:
+            self.version += 1
+
+    def _update_devices(self):
+        """Discovers the coordinators, unless discovery failed recently.
+        Returns True if `error` has changed."""
+        now = upnp.ticks_ms()
+        if self._next_discovery is not None and upnp.ticks_diff(now, self._next_discovery) < 0:
+            return False
+        try:
+            devices = dict()
+            for coordinator in self._discover(cache=self.cache):
+                devices[coordinator.uuid] = coordinator
+        except Exception as e:
+            self._next_discovery = upnp.ticks_add(now, self._discovery_retry)
+            self._discovery_retry = min(self._discovery_retry * 2, MAX_DISCOVERY_RETRY_INTERVAL)
+            error = str(e)
+        else:
+            self._next_discovery = None
+            self._discovery_retry = DISCOVERY_RETRY_INTERVAL
+            self.devices = devices
+            error = None
+        if error == self.error:
+            return False
+        self.error = error
+        return True
+
+    def _body(self):
+        return json.dumps(dict(
+            version=self.version,
+            error=self.error,
+            devices=[self.state[uuid] for uuid in sorted(self.state)],
+        ))
+
+    def _respond(self, client, status, body):
+        body = body.encode('utf-8')
+        client.sendall((
+            'HTTP/1.1 %s\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: close\r\n\r\n' % (status, len(body))
+        ).encode('utf-8') + body)
+
+    def _handle(self, client):
+        """Handles a request, returning True if the client has been left
+        waiting for a long-poll (and so shouldn't be closed). Raises
+        ValueError if the request doesn't make sense."""
+        client.settimeout(5)
+        conn = upnp._Connection(None, None)
+        conn.sock = client
+        conn._attach()
+        request_line, headers = conn.read_head()
+        method, _, rest = request_line.partition(' ')
+        target = rest.partition(' ')[0]
+        path, _, query = target.partition('?')
+        params = _parse_query(query)
+        parts = [part for part in path.split('/') if part]
+
+        if method == 'GET' and parts == ['state']:
+            since = params.get('since')
+            if since is not None and int(since) == self.version:
+                if len(self._waiting) >= MAX_WAITING:
+                    # Answer the oldest, rather than turn this one away.
+                    self._answer(self._waiting.pop(0)[0])
+                self._waiting.append((
+                    client, self.version, upnp.ticks_add(upnp.ticks_ms(), LONG_POLL_TIMEOUT)
+                ))
+                return True
+            self._respond(client, '200 OK', self._body())
+        elif method == 'POST' and len(parts) == 3 and parts[0] == 'devices':
+            device = self.devices.get(parts[1])
+            if device is None:
+                self._respond(client, '404 Not Found', json.dumps(dict(error='No such device')))
+                return False
+            try:
+                device.submit(parts[2], int(params.get('value', 1)))
+            except ValueError as e:
+                self._respond(client, '400 Bad Request', json.dumps(dict(error=str(e))))
+                return False
+            self._respond(client, '202 Accepted', json.dumps(dict(queued=parts[2])))
+        else:
+            self._respond(client, '404 Not Found', json.dumps(dict(error='Not found')))
+        return False
+
+    def _reply_bad_request(self, client, e):
+        try:
+            self._respond(client, '400 Bad Request', json.dumps(dict(error=str(e))))
+            # Read whatever's left of the request that's already arrived, as
+            # closing with it unread would reset the connection, and the
+            # client might never see the reply.
+            client.settimeout(0)
+            for _ in range(MAX_DRAIN_READS):
+                if not client.recv(DRAIN_SIZE):
+                    break
+        except OSError:
+            pass
+
+    def _answer(self, client):
+        try:
+            self._respond(client, '200 OK', self._body())
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+    def step(self, timeout=0):
+        """Handles any requests which arrive within `timeout` milliseconds,
+        polls the devices if it's time to, and answers any long-polls that
+        have something new (or have waited long enough)."""
+        for _ in self._poller.poll(timeout):
+            client, _ = self.sock.accept()
+            waiting = False
+            try:
+                waiting = self._handle(client)
+            except ValueError as e:
+                self._reply_bad_request(client, e)
+            except OSError:
+                # They've gone away, or never finished asking.
+                pass
+            finally:
+                if not waiting:
+                    client.close()
+            timeout = 0
+
+        now = upnp.ticks_ms()
+        if upnp.ticks_diff(now, self._next_poll) >= 0:
+            self._next_poll = upnp.ticks_add(now, self.poll_interval)
+            self.poll()
+
+        still_waiting = []
+        for waiting in self._waiting:
+            client, version, expires = waiting
+            if self.version != version or upnp.ticks_diff(now, expires) >= 0:
+                self._answer(client)
+            else:
+                still_waiting.append(waiting)
+        self._waiting = still_waiting
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            self.step(min(self.poll_interval, 1000))
+
+    def close(self):
+        """Stops serving, answering anyone still waiting."""
+        self._running = False
+        for client, _, _ in self._waiting:
+            self._answer(client)
+        self._waiting = []
+        self._poller.unregister(self.sock)
+        self.sock.close()
+
+
+def main(port=DEFAULT_BRIDGE_PORT):
+    bridge = Bridge(port)
+    print('Serving on port %d' % bridge.port)
+    try:
+        bridge.serve_forever()
+    finally:
+        bridge.close()
@@ -1,79 +1,469 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import errno
-import io
-import socket
 import time
 
-import xmltok
+try:
+    import uos as os
+except ImportError:
+    import os
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import uselect as select
+except ImportError:
+    import select
 
+import instrument
 import upnp
 import sonos
+import xmlpull
 
 
 DEFAULT_DISCOVER_TIMEOUT = 2
+# How long a TopologyCache can be used before it is refreshed, in seconds.
+DEFAULT_TOPOLOGY_MAX_AGE = 300
+# Where discover_cached() keeps the topology between restarts.
+DEFAULT_BOOT_CACHE_PATH = 'sonos.cache'
 
 
-def _discover_ip(timeout=DEFAULT_DISCOVER_TIMEOUT):
-    """Discover the IP of a single Sonos device on the network."""
-    MCAST_GRP = '239.255.255.250'
-    MCAST_PORT = 1900
-    PLAYER_SEARCH = '\n'.join((
-        'M-SEARCH * HTTP/1.1',
-        'HOST: 239.255.255.250:1900',
-        'MAN: "ssdp:discover"',
-        'MX: 1',
-        'ST: urn:schemas-upnp-org:device:ZonePlayer:1',
-    )).encode('utf-8')
-
-    # We have to set non-blocking mode and poll the socket, as MicroPython
-    # doesn't give us anything better on the ESP8266
-    # TODO: #7 - see if provisional select.poll() PR works well enough.
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setblocking(False)
-    # Send a few times, just in case UDP gives us trouble.
-    for _ in range(3):
-        sock.sendto(PLAYER_SEARCH, (MCAST_GRP, MCAST_PORT))
+SSDP_ADDRESS = ('239.255.255.250', 1900)
+PLAYER_SEARCH = '\r\n'.join((
+    'M-SEARCH * HTTP/1.1',
+    'HOST: 239.255.255.250:1900',
+    'MAN: "ssdp:discover"',
+    'MX: 1',
+    'ST: urn:schemas-upnp-org:device:ZonePlayer:1',
+    '',
+    '',
+)).encode('utf-8')
+# Used if a device doesn't tell us how long to cache its response for.
+DEFAULT_SSDP_MAX_AGE = 1800
 
-    start_time = time.time()
-    end_time = start_time + timeout
-    while True:
-        if time.time() >= end_time:
-            break
+
+def _parse_ssdp_response(data):
+    """Parses an SSDP response from a ZonePlayer, returning a dict(uuid, ip,
+    location, household, max_age), or None if it isn't from a Sonos device
+    (or we can't make sense of it)."""
+    if b'Sonos' not in data:
+        return None
+    headers = dict()
+    try:
+        lines = data.decode('utf-8').split('\n')
+    except UnicodeError:
+        return None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if not headers.get('location', '').startswith('http://'):
+        return None
+
+    max_age = DEFAULT_SSDP_MAX_AGE
+    cache_control = headers.get('cache-control', '')
+    idx = cache_control.find('max-age')
+    if idx != -1:
+        _, _, value = cache_control[idx:].partition('=')
         try:
-            data, (ip, port) = sock.recvfrom(1024)
-        except OSError as e:
-            # MicroPython returns ETIMEDOUT, but CPython 3.5 returns EAGAIN.
-            if e.args[0] not in (errno.ETIMEDOUT, errno.EAGAIN):
-                raise
+            max_age = int(value.split(',')[0].strip())
+        except ValueError:
+            return None
+    # USN: uuid:RINCON_XXX::urn:schemas-upnp-org:device:ZonePlayer:1
+    usn = headers.get('usn', '')
+    uuid = usn[len('uuid:'):].split('::')[0] if usn.startswith('uuid:') else None
+    return dict(
+        uuid=uuid,
+        ip=_zone_group_topology_location_to_ip(headers['location']),
+        location=headers['location'],
+        household=headers.get('x-rincon-household'),
+        max_age=max_age
+    )
+
+
+def _device_key(device):
+    """Identifies a device from `_parse_ssdp_response()`: by its UUID, or
+    its LOCATION if it didn't send a USN."""
+    return device['uuid'] or device['location']
+
+
+class DeviceCache:
+    """Remembers the devices which have answered SSDP searches, for as long
+    as they told us to (with CACHE-CONTROL: max-age)."""
+
+    def __init__(self):
+        # Keyed on `_device_key()`. Values are (expiry time, device dict).
+        self._devices = dict()
+
+    def add(self, device):
+        self._devices[_device_key(device)] = (time.time() + device['max_age'], device)
+
+    def devices(self):
+        """Returns a list of the devices which haven't expired."""
+        now = time.time()
+        for key, (expires, _) in list(self._devices.items()):
+            if expires <= now:
+                del self._devices[key]
+        return [device for _, device in self._devices.values()]
+
+    def clear(self):
+        self._devices = dict()
+
+
+# Every device we've heard from.
+known_devices = DeviceCache()
+
+
+def discover_all(timeout=DEFAULT_DISCOVER_TIMEOUT, count=None, cache=None):
+    """Searches for Sonos devices, returning a list of the devices which
+    answer within `timeout` seconds (see `_parse_ssdp_response()`).
+
+    If `count` is given, returns as soon as that many devices have answered.
+    Everything that answers is added to `cache` (`known_devices` if not
+    given).
+    """
+    if cache is None:
+        cache = known_devices
+    timer = instrument.timer('ssdp', count)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Send a few times, just in case UDP gives us trouble.
+        for _ in range(3):
+            sock.sendto(PLAYER_SEARCH, SSDP_ADDRESS)
+        if timer is not None:
+            timer.lap('send', 3 * len(PLAYER_SEARCH))
+
+        # Rather than spin on a non-blocking socket, sleep in poll() until
+        # something arrives (or we run out of time).
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        devices = dict()
+        received = 0
+        deadline = upnp.ticks_add(upnp.ticks_ms(), int(timeout * 1000))
+        while count is None or len(devices) < count:
+            remaining = upnp.ticks_diff(deadline, upnp.ticks_ms())
+            if remaining <= 0:
+                break
+            if not poller.poll(remaining):
+                continue
+            data, _ = sock.recvfrom(1024)
+            received += len(data)
+            device = _parse_ssdp_response(data)
+            if device is not None and _device_key(device) not in devices:
+                devices[_device_key(device)] = device
+                cache.add(device)
+        if timer is not None:
+            timer.lap('wait', received)
+        return list(devices.values())
+    finally:
+        sock.close()
+
+
+def _discover_ip(timeout=DEFAULT_DISCOVER_TIMEOUT):
+    """Discover the IP of a single Sonos device on the network.
+
+    If we've heard from a device recently enough, it's used without doing a
+    search."""
+    devices = known_devices.devices()
+    if not devices:
+        devices = discover_all(timeout, count=1)
+    # Rather not ask a device that has stopped responding, if there's another.
+    for device in devices:
+        if _is_available(device['ip']):
+            return device['ip']
+    if devices:
+        return devices[0]['ip']
+
+
+def _is_available(ip):
+    """Checks that the device at `ip` hasn't stopped responding (i.e. that
+    its circuit breaker isn't open)."""
+    return upnp.connection_pool.is_available(sonos.BASE_URL_TEMPLATE % ip)
+
+
+def _build_coordinator(group, known_players=None, cls=None):
+    """Builds the Sonos instance for the coordinator of `group`, with the
+    other players in the group added to it.
+
+    Players in `known_players` (keyed on UUID) are re-used if they don't look
+    to have changed. New players are instances of `cls`, which defaults to
+    `sonos.Sonos`.
+    """
+    if cls is None:
+        cls = sonos.Sonos
+    coordinator_uuid = group['coordinator_uuid']
+    players = dict()
+    for player_uuid, player in group['players'].items():
+        existing = None
+        if known_players is not None:
+            existing = known_players.get(player_uuid)
+        if existing is not None and (
+            existing.boot_seq == player.get('boot_seq') and
+            existing.ip == player['ip'] and
+            existing.name == player['name']
+        ):
+            existing.other_players = []
+            players[player_uuid] = existing
         else:
-            if b'Sonos' in data:
-                return ip
-            time.sleep(0.1)
+            players[player_uuid] = cls(player_uuid, player['ip'], player['name'])
+            players[player_uuid].boot_seq = player.get('boot_seq')
+            players[player_uuid].software_version = player.get('software_version')
+    coordinator = players[coordinator_uuid]
+    for player_uuid, player in players.items():
+        if player_uuid != coordinator_uuid:
+            coordinator.add_player_to_group(player)
+    return coordinator
 
 
-def discover(timeout=DEFAULT_DISCOVER_TIMEOUT):
+def discover(timeout=DEFAULT_DISCOVER_TIMEOUT, cache=None):
     """Discover Sonos devices on local network. Yields a Sonos instance for
     each coordinator on the network.
 
     Accepts optional `timeout` parameter, which gives total timeout in seconds.
+
+    If a TopologyCache is given as `cache`, the coordinators it holds are
+    yielded without touching the network, unless it has been invalidated or
+    has expired.
+
+    Coordinators which have stopped responding to commands (see
+    `upnp.CircuitBreaker`) are left out.
     """
-    ip = _discover_ip(timeout)
-    assert ip is not None, 'Could not find Sonos device'
-
-    topology = query_zone_group_topology(ip)
-    for group in topology:
-        coordinator_uuid = group['coordinator_uuid']
-        players = {
-            player_uuid: sonos.Sonos(player_uuid, player['ip'], player['name'])
+    if cache is not None and cache.is_fresh():
+        for coordinator in cache.coordinators:
+            if _is_available(coordinator.ip):
+                yield coordinator
+        return
+
+    groups = None
+    if cache is not None and cache.ip is not None:
+        # Don't bother with SSDP if the device we asked last time is still
+        # around.
+        try:
+            groups = iter_zone_group_topology(cache.ip)
+            ip = cache.ip
+        except OSError:
+            pass
+    if groups is None:
+        ip = _discover_ip(timeout)
+        assert ip is not None, 'Could not find Sonos device'
+        try:
+            groups = iter_zone_group_topology(ip)
+        except OSError:
+            # We may have remembered a device which has since gone away, so
+            # forget everything and search again.
+            known_devices.clear()
+            ip = _discover_ip(timeout)
+            assert ip is not None, 'Could not find Sonos device'
+            groups = iter_zone_group_topology(ip)
+
+    # Coordinators are yielded as soon as their group has been parsed, rather
+    # than waiting for the whole topology.
+    if cache is not None:
+        coordinators = cache.update(ip, groups)
+    else:
+        coordinators = (_build_coordinator(group) for group in groups)
+    for coordinator in coordinators:
+        if _is_available(coordinator.ip):
+            yield coordinator
+
+
+class TopologyCache:
+    """Caches the Sonos instances built from the topology of a household, so
+    that repeated calls to `discover()` don't need to query it every time.
+
+    When the topology is queried again, only the groups which have changed
+    are rebuilt. The `ID` of each <ZoneGroup> ends in a sequence number
+    which changes whenever its membership does, and each player's `BootSeq`
+    changes whenever it restarts. A group is also rebuilt if any of its
+    players has a new name or IP. Anything else is left as it was, so the
+    same Sonos instances keep being used.
+
+    The cache expires after `max_age` seconds (if not None). Call
+    `invalidate()` if you know something has changed. Its signature means it
+    can be used as the callback for a ZoneGroupTopology subscription:
+
+        > sonos.subscribe('ZoneGroupTopology', cache.invalidate)
+    """
+
+    def __init__(self, max_age=DEFAULT_TOPOLOGY_MAX_AGE):
+        self.max_age = max_age
+        # The device we queried the topology from.
+        self.ip = None
+        self.coordinators = []
+        # Coordinators which were rebuilt by the last update.
+        self.changed = []
+        self._groups = dict()
+        self._players = dict()
+        self._updated = None
+
+    def __repr__(self):
+        return '<TopologyCache ip=%s, coordinators=%r>' % (self.ip, self.coordinators)
+
+    def invalidate(self, *unused):
+        """Marks the cache as stale, so that the next `discover()` queries the
+        topology again."""
+        self._updated = None
+
+    def is_fresh(self):
+        if self._updated is None:
+            return False
+        return self.max_age is None or time.time() - self._updated < self.max_age
+
+    @staticmethod
+    def _signature(group):
+        return sorted(
+            (player_uuid, player.get('boot_seq'), player['ip'], player['name'])
             for player_uuid, player in group['players'].items()
-        }
-        coordinator = players[coordinator_uuid]
-        for player_uuid, player in players.items():
-            if player_uuid != coordinator_uuid:
-                coordinator.add_player_to_group(player)
-        yield coordinator
+        )
+
+    def update(self, ip, groups):
+        """Updates the cache from the `groups` parsed out of the topology
+        queried from `ip`, yielding each coordinator as it goes.
+
+        The cache is only updated once all of the groups have been consumed.
+        """
+        coordinators = []
+        changed = []
+        cached_groups = dict()
+        players = dict()
+        for group in groups:
+            signature = self._signature(group)
+            cached = self._groups.get(group.get('id'))
+            if cached is not None and cached[0] == signature:
+                coordinator = cached[1]
+            else:
+                coordinator = _build_coordinator(group, self._players)
+                changed.append(coordinator)
+            cached_groups[group.get('id')] = (signature, coordinator)
+            players[coordinator.uuid] = coordinator
+            for player in coordinator.other_players:
+                players[player.uuid] = player
+            coordinators.append(coordinator)
+            yield coordinator
+
+        self.ip = ip
+        self.coordinators = coordinators
+        self.changed = changed
+        self._groups = cached_groups
+        self._players = players
+        self._updated = time.time()
+
+
+def save_topology(path, coordinators):
+    """Saves `coordinators` (and the other players in their groups) to
+    `path`, so that `discover_cached()` can use them after a restart.
+
+    The format is as compact as we can make it: a line per player, of
+    tab-separated coordinator UUID, UUID, IP, BootSeq, name and
+    SoftwareVersion.
+
+    It's written to a temporary file which then replaces `path`, so losing
+    power part-way through leaves the old cache rather than half of a new
+    one.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for coordinator in coordinators:
+            for player in [coordinator] + coordinator.other_players:
+                name = player.name.replace('\t', ' ').replace('\n', ' ')
+                boot_seq = '' if player.boot_seq is None else str(player.boot_seq)
+                f.write('\t'.join((
+                    coordinator.uuid, player.uuid, player.ip, boot_seq, name,
+                    player.software_version or ''
+                )) + '\n')
+    os.rename(tmp_path, path)
+
+
+def load_topology(path):
+    """Loads the topology saved by `save_topology()`, in the same form as
+    `query_zone_group_topology()` (but without group IDs). Raises ValueError
+    if the file has been cut short."""
+    groups = []
+    groups_by_coordinator = dict()
+    with open(path) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                raise ValueError('Truncated topology cache')
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            fields = line.split('\t')
+            coordinator_uuid, player_uuid, ip, boot_seq, name = fields[:5]
+            # Caches saved by older versions don't have a SoftwareVersion.
+            software_version = fields[5] if len(fields) > 5 else ''
+            group = groups_by_coordinator.get(coordinator_uuid)
+            if group is None:
+                group = dict(coordinator_uuid=coordinator_uuid, id=None, players=dict())
+                groups_by_coordinator[coordinator_uuid] = group
+                groups.append(group)
+            group['players'][player_uuid] = dict(
+                uuid=player_uuid,
+                name=name,
+                ip=ip,
+                boot_seq=int(boot_seq) if boot_seq else None,
+                software_version=software_version or None
+            )
+    return groups
+
+
+def _cached_player_rediscoverer(path, timeout, players):
+    """Returns a function to call when a player loaded from the cache at
+    `path` doesn't answer at the IP we think it has. The network is searched
+    again, the cache saved, and all of `players` (keyed on UUID) updated.
+    Raises an exception if the player can't be found."""
+    def rediscover(player):
+        coordinators = list(discover(timeout))
+        save_topology(path, coordinators)
+        for coordinator in coordinators:
+            for fresh in [coordinator] + coordinator.other_players:
+                cached = players.get(fresh.uuid)
+                if cached is not None:
+                    cached.set_ip(fresh.ip)
+                    cached.name = fresh.name
+                    cached.boot_seq = fresh.boot_seq
+                    cached.software_version = fresh.software_version
+                    cached._rediscover = None
+                    if cached is player:
+                        player = None
+        if player is not None:
+            raise Exception('%s is no longer on the network' % player.name)
+    return rediscover
+
+
+def discover_cached(path=DEFAULT_BOOT_CACHE_PATH, timeout=DEFAULT_DISCOVER_TIMEOUT):
+    """Returns a list of coordinators, like `discover()`, but from the cache
+    at `path` if there is one. This means no waiting around for SSDP or the
+    topology after a restart.
+
+    The cache isn't checked up front, as that would cost a request to each
+    device. Instead, if the first command sent to a device fails, we fall
+    back to `discover()`, update the cache, and (if the device has moved)
+    send the command again. A device which has been replaced by another at
+    the same IP isn't noticed, as nothing in a response says which device
+    sent it.
+
+    If there's no cache, `discover()` is used to create one.
+    """
+    try:
+        groups = load_topology(path)
+    except (OSError, ValueError, IndexError):
+        # Missing, or cut short by losing power part-way through a write.
+        # Either way, it'll be rebuilt.
+        groups = None
+    if not groups:
+        coordinators = list(discover(timeout))
+        save_topology(path, coordinators)
+        return coordinators
+
+    coordinators = [_build_coordinator(group) for group in groups]
+    players = dict()
+    for coordinator in coordinators:
+        for player in [coordinator] + coordinator.other_players:
+            players[player.uuid] = player
+    rediscover = _cached_player_rediscoverer(path, timeout, players)
+    for player in players.values():
+        player._rediscover = rediscover
+    return coordinators
 
 
 def _zone_group_topology_location_to_ip(location):
@@ -94,20 +484,25 @@ def query_zone_group_topology(ip):
 
         > [
         >     # One per connected group of players.
-        >     dict(coordinator_uuid, players=dict(
+        >     dict(coordinator_uuid, id, players=dict(
         >         # One per player in group, including coordinator. Keyed
         >         # on player UUID.
         >         player_uuid=dict(
-                      dict(uuid, ip, player_name)
+                      dict(uuid, ip, player_name, boot_seq, software_version)
         >         )
         >     )
         > ]
 
     This is quite an expensive operation, so recommend this be done once and
-    used to instantiate Sonos instances. This function is also very gnarly,
-    as the lack of XML parser for MicroPython makes it difficult. (I really
-    don't want to write an XML parser, as I'll do it wrong...)
+    used to instantiate Sonos instances. If you don't need the whole list at
+    once, `iter_zone_group_topology()` yields each group as it is parsed.
     """
+    return list(iter_zone_group_topology(ip))
+
+
+def iter_zone_group_topology(ip):
+    """Queries the Zone Group Topology and yields a dict for each group, in
+    the same form as `query_zone_group_topology()`."""
     base_url = sonos.BASE_URL_TEMPLATE % ip
     response = upnp.send_command(
         base_url + '/ZoneGroupTopology/Control',
@@ -115,55 +510,74 @@ def query_zone_group_topology(ip):
     )
 
     # Yes. This is XML serialized as a string inside an XML UPnP response.
-    xml_string = response['ZoneGroupState']
-    tokens = xmltok.tokenize(io.StringIO(xml_string))
+    # ZoneGroupState is unescaped as it is parsed.
+    return _parse_zone_groups(response.stream('ZoneGroupState'))
 
-    # This is getting silly. It might be time to write a very light-weight
-    # XML parser?
-    coordinators = []
-    token, value, *rest = next(tokens)
+
+# How much of the <ZoneGroups> document to read at a time.
+_TOPOLOGY_READ_SIZE = 512
+
+def _parse_zone_group(xml, start, end):
+    """Parses the <ZoneGroup> element found between `start` and `end` in
+    `xml`.
+
+    Rather than tokenize everything, we just look for the handful of
+    attributes that we care about. The other ~20 attributes on each
+    <ZoneGroupMember> are never copied out of `xml`.
+    """
+    parser = xmlpull.Parser(xml, start, end)
+    coordinator_uuid, group_id = parser.find('ZoneGroup', ('Coordinator', 'ID'))
+    players = dict()
     while True:
-        coordinator_uuid = None
-        # Find <ZoneGroup>, or give up if we've seen the last one (or none!)
-        try:
-            while not (token == xmltok.START_TAG and value == ('', 'ZoneGroup')):
-                token, value, *rest = next(tokens)
-        except StopIteration:
+        member = parser.find(
+            'ZoneGroupMember', ('UUID', 'Location', 'ZoneName', 'BootSeq', 'SoftwareVersion')
+        )
+        if member is None:
             break
-        # Find Coordinator= attribute.
-        while not (token == xmltok.ATTR and value == ('', 'Coordinator')):
-            token, value, *rest = next(tokens)
-        coordinator_uuid, *_ = rest
-        # Parse child-tags until we get </ZoneGroup>
-        players = dict()
-        while not (token == xmltok.END_TAG and value == ('', 'ZoneGroup')):
-            token, value, *rest = next(tokens)
-            # Find <ZoneGroupMember>
-            if token == xmltok.START_TAG and value == ('', 'ZoneGroupMember'):
-                # As this is a self-closing tag, xmltok never gives us an end
-                # token. Once we have all the attributes we need, move onto
-                # the next <ZoneGroupMember>.
-                player_uuid = player_name = player_ip = None
-                while not all((player_uuid, player_name, player_ip)):
-                    token, value, *rest = next(tokens)
-                    if token == xmltok.ATTR:
-                        if value == ('', 'UUID'):
-                            player_uuid, *_ = rest
-                        elif value == ('', 'ZoneName'):
-                            player_name, *_ = rest
-                        elif value == ('', 'Location'):
-                            location, *_ = rest
-                            player_ip = _zone_group_topology_location_to_ip(location)
-                players[player_uuid] = dict(
-                    uuid=player_uuid,
-                    name=player_name,
-                    ip=player_ip
-                )
-
-        # We've finished parsing information about the <ZoneGroup>.
-        coordinators.append(dict(
-            coordinator_uuid=coordinator_uuid,
-            players=players
-        ))
+        player_uuid, location, name, boot_seq, software_version = member
+        players[player_uuid] = dict(
+            uuid=player_uuid,
+            name=name,
+            ip=_zone_group_topology_location_to_ip(location),
+            boot_seq=int(boot_seq) if boot_seq is not None else None,
+            software_version=software_version
+        )
+    return dict(
+        coordinator_uuid=coordinator_uuid,
+        id=group_id,
+        players=players
+    )
 
-    return coordinators
+
+class _TimedReader:
+    """Wraps file-like `f`, telling `timer` how long each read took."""
+
+    def __init__(self, f, timer):
+        self._f = f
+        self._timer = timer
+
+    def read(self, size):
+        start = instrument.ticks_us()
+        data = self._f.read(size)
+        self._timer.add('read', instrument.ticks_diff(instrument.ticks_us(), start), len(data))
+        return data
+
+
+def _parse_zone_groups(f):
+    """Parses a <ZoneGroups> document read from file-like `f`, yielding a
+    dict for each <ZoneGroup> as soon as its closing tag has been read.
+
+    Only the <ZoneGroup> currently being parsed is held in memory, so this
+    doesn't get any more expensive per-group as the house gets bigger.
+    """
+    timer = instrument.timer('topology')
+    if timer is not None:
+        f = _TimedReader(f, timer)
+    for xml, start, end in xmlpull.elements(f, 'ZoneGroup', _TOPOLOGY_READ_SIZE):
+        group = _parse_zone_group(xml, start, end)
+        if timer is not None:
+            timer.lap('parse', end - start)
+        yield group
+        if timer is not None:
+            # Don't count whatever was done with the group.
+            timer.restart()
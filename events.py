@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""UPnP GENA event subscriptions, so that we're told when something changes
+rather than having to poll for it."""
+
+import io
+import time
+
+import xmltok
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import uselect as select
+except ImportError:
+    import select
+
+import upnp
+
+
+# Port we listen for NOTIFY requests on. Sonos controllers use 3400.
+DEFAULT_EVENT_PORT = 3400
+# How long we ask for subscriptions to last, in seconds. Sonos gives us what
+# we ask for, but we'll use whatever it says in its response.
+DEFAULT_SUBSCRIPTION_TIMEOUT = 3600
+# Subscriptions are renewed this many seconds before they are due to expire.
+RENEW_MARGIN = 60
+# If a subscription can't be renewed (or replaced), try again this many
+# seconds later.
+RENEW_RETRY_INTERVAL = 30
+
+# xmltok ends its input by raising StopIteration from inside its generator,
+# which PEP 479 turns into a RuntimeError on CPython.
+_END_OF_TOKENS = (StopIteration, RuntimeError)
+
+EVENT_PATHS = {
+    'AVTransport': '/MediaRenderer/AVTransport/Event',
+    'RenderingControl': '/MediaRenderer/RenderingControl/Event',
+    'ZoneGroupTopology': '/ZoneGroupTopology/Event',
+}
+
+
+def _local_ip(remote_ip):
+    """Returns the IP of the interface we'd use to talk to `remote_ip`, which
+    is where the device should send its events."""
+    try:
+        import network
+    except ImportError:
+        # CPython: a UDP connect() doesn't send anything, but does pick the
+        # interface.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((remote_ip, 1400))
+            return sock.getsockname()[0]
+        finally:
+            sock.close()
+    return network.WLAN(network.STA_IF).ifconfig()[0]
+
+
+def _parse_timeout(header):
+    """Parses a TIMEOUT: Second-NNN header."""
+    _, _, seconds = header.partition('-')
+    if seconds == 'infinite':
+        return DEFAULT_SUBSCRIPTION_TIMEOUT
+    return int(seconds)
+
+
+def parse_last_change(xml):
+    """Parses the <Event> document that AVTransport and RenderingControl put
+    in their LastChange variable, returning a dict of {name: value}.
+
+    Variables which are given per-channel (such as Volume) are keyed on
+    'name/channel', except for the Master channel which is just 'name'.
+    """
+    variables = dict()
+    name = channel = value = None
+    tokens = xmltok.tokenize(io.StringIO(xml))
+    try:
+        while True:
+            token, token_value, *rest = next(tokens)
+            if token == xmltok.START_TAG:
+                _, name = token_value
+                channel = value = None
+            elif token == xmltok.ATTR:
+                if token_value == ('', 'val'):
+                    value, *_ = rest
+                elif token_value == ('', 'channel'):
+                    channel, *_ = rest
+            elif token == xmltok.END_TAG:
+                if token_value[1] == 'InstanceID':
+                    break
+                if name is not None and value is not None:
+                    if channel is not None and channel != 'Master':
+                        name = name + '/' + channel
+                    variables[name] = upnp._unescape(value)
+                name = None
+    except _END_OF_TOKENS:
+        pass
+    except xmltok.XMLSyntaxError:
+        raise ValueError('Bad LastChange')
+    return variables
+
+
+def parse_propertyset(f):
+    """Parses the <e:propertyset> body of a NOTIFY request read from
+    file-like `f`, returning a dict of {variable: value}."""
+    variables = dict()
+    propertyset_tag = ('e', 'propertyset')
+    tokens = xmltok.tokenize(f)
+    name = None
+    try:
+        while True:
+            token, token_value, *_ = next(tokens)
+            if token == xmltok.START_TAG:
+                namespace, name = token_value
+                if namespace == 'e':
+                    name = None
+            elif token == xmltok.TEXT and name is not None:
+                variables[name] = upnp._unescape(token_value)
+                name = None
+            elif token == xmltok.END_TAG and token_value == propertyset_tag:
+                break
+    except _END_OF_TOKENS + (xmltok.XMLSyntaxError,):
+        raise ValueError('Bad NOTIFY request')
+    return variables
+
+
+class Subscription:
+    """A subscription to the events of one service on one device.
+
+    `callback(variables)` is called with a dict of the variables that have
+    changed, each time the device sends us an event. For AVTransport and
+    RenderingControl, the LastChange variable is parsed for you.
+    """
+
+    def __init__(self, listener, base_url, service, callback,
+                 timeout=DEFAULT_SUBSCRIPTION_TIMEOUT):
+        self.listener = listener
+        self.event_url = base_url + EVENT_PATHS[service]
+        self.service = service
+        self.callback = callback
+        self.requested_timeout = timeout
+        self.sid = None
+        self.expires = 0
+
+    def __repr__(self):
+        return '<Subscription service=%s, sid=%s>' % (self.service, self.sid)
+
+    def _send(self, method, headers):
+        status, resp_headers, body = upnp.connection_pool.request(
+            method, self.event_url, headers
+        )
+        if status != 200:
+            raise Exception('%s failed: %d %s' % (method, status, body.decode('utf-8')))
+        return resp_headers
+
+    def _update(self, resp_headers):
+        timeout = _parse_timeout(resp_headers.get('timeout', 'Second-%d' % self.requested_timeout))
+        self.expires = time.time() + timeout
+
+    def subscribe(self):
+        resp_headers = self._send('SUBSCRIBE', {
+            'CALLBACK': '<%s>' % self.listener.callback_url,
+            'NT': 'upnp:event',
+            'TIMEOUT': 'Second-%d' % self.requested_timeout,
+        })
+        self.sid = resp_headers['sid']
+        self._update(resp_headers)
+        self.listener._add(self)
+
+    def renew(self):
+        """Renews the subscription, or subscribes again if the device won't
+        (e.g. with a 412, because it has restarted and forgotten about us)."""
+        try:
+            resp_headers = self._send('SUBSCRIBE', {
+                'SID': self.sid,
+                'TIMEOUT': 'Second-%d' % self.requested_timeout,
+            })
+        except OSError:
+            # Unreachable, so there's no point subscribing again yet.
+            raise
+        except Exception:
+            old_sid = self.sid
+            # If this fails too, we're still known by the old SID, and so
+            # will be tried again.
+            self.subscribe()
+            if old_sid != self.sid:
+                self.listener.subscriptions.pop(old_sid, None)
+            return
+        self._update(resp_headers)
+
+    def unsubscribe(self):
+        self.listener._remove(self)
+        try:
+            self._send('UNSUBSCRIBE', {'SID': self.sid})
+        except OSError:
+            # The device has probably gone away, in which case it's forgotten
+            # about us anyway.
+            pass
+
+    def _dispatch(self, variables):
+        if 'LastChange' in variables:
+            try:
+                variables = parse_last_change(variables['LastChange'])
+            except ValueError:
+                # Nothing we can make sense of, so nothing to tell anyone.
+                return
+        self.callback(variables)
+
+
+def _reply(client, status):
+    try:
+        client.sendall(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\n\r\n')
+    except OSError:
+        # It's gone already.
+        pass
+
+
+class EventListener:
+    """A tiny HTTP server which receives NOTIFY requests from devices and
+    passes them on to the right Subscription.
+
+    Nothing happens in the background: call `handle_events()` from your main
+    loop (or `serve_forever()` from a thread). This also renews any
+    subscriptions which are about to expire.
+    """
+
+    def __init__(self, ip=None, port=DEFAULT_EVENT_PORT):
+        self.ip = ip
+        self.subscriptions = dict()
+        # Events can arrive before we've seen the response to SUBSCRIBE (and
+        # so before we know the SID), if we're being run from another thread.
+        self._early_events = dict()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(socket.getaddrinfo('0.0.0.0', port)[0][-1])
+        self.sock.listen(5)
+        if port == 0:
+            port = self.sock.getsockname()[1]
+        self.port = port
+        self._poller = select.poll()
+        self._poller.register(self.sock, select.POLLIN)
+
+    @property
+    def callback_url(self):
+        return 'http://%s:%d/notify' % (self.ip, self.port)
+
+    def subscribe(self, base_url, service, callback, timeout=DEFAULT_SUBSCRIPTION_TIMEOUT):
+        """Subscribes to events from `service` on the device at `base_url`.
+        Returns the Subscription."""
+        if self.ip is None:
+            host, _, _ = upnp._split_url(base_url)
+            self.ip = _local_ip(host)
+        subscription = Subscription(self, base_url, service, callback, timeout)
+        subscription.subscribe()
+        return subscription
+
+    def _add(self, subscription):
+        self.subscriptions[subscription.sid] = subscription
+        for variables in self._early_events.pop(subscription.sid, []):
+            subscription._dispatch(variables)
+
+    def _remove(self, subscription):
+        self.subscriptions.pop(subscription.sid, None)
+
+    def handle_events(self, timeout=0):
+        """Handles any NOTIFY requests which arrive within `timeout`
+        milliseconds, and renews any subscriptions which are due."""
+        self.renew_due()
+        for _ in self._poller.poll(timeout):
+            client, _ = self.sock.accept()
+            try:
+                event = self._read_event(client)
+            except Exception:
+                # Whether it's a port scan or a device sending something we
+                # can't parse, it mustn't stop events from everything else.
+                event = None
+                _reply(client, b'400 Bad Request')
+            finally:
+                client.close()
+            if event is not None:
+                self._dispatch(*event)
+            # Don't block on any more, just handle what's already arrived.
+            timeout = 0
+
+    def serve_forever(self):
+        while True:
+            self.handle_events(1000)
+
+    def renew_due(self):
+        """Renews any subscriptions which are about to expire. One which
+        can't be renewed (e.g. because the device is unreachable) is tried
+        again later, without holding up the others."""
+        now = time.time()
+        for subscription in list(self.subscriptions.values()):
+            if subscription.expires - now < RENEW_MARGIN:
+                try:
+                    subscription.renew()
+                except Exception:
+                    subscription.expires = now + RENEW_MARGIN + RENEW_RETRY_INTERVAL
+
+    def _read_event(self, client):
+        """Reads a NOTIFY request from `client` and acknowledges it,
+        returning (sid, variables), or None if it wasn't a NOTIFY."""
+        client.settimeout(5)
+        conn = upnp._Connection(None, None)
+        conn.sock = client
+        conn._attach()
+        request_line, headers = conn.read_head()
+        if not request_line.startswith('NOTIFY '):
+            _reply(client, b'405 Method Not Allowed')
+            return None
+        content_length = headers.get('content-length')
+        if content_length is not None:
+            content_length = int(content_length)
+        body = upnp._Response(
+            None, conn, None, content_length, False, upnp.DEFAULT_CHUNK_SIZE, headers
+        )
+        try:
+            variables = parse_propertyset(body)
+        finally:
+            body.close()
+        client.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        return headers.get('sid'), variables
+
+    def _dispatch(self, sid, variables):
+        subscription = self.subscriptions.get(sid)
+        if subscription is None:
+            # Don't hang on to events for subscriptions that we've forgotten
+            # about (e.g. from before a reboot) for ever.
+            if len(self._early_events) > 8:
+                self._early_events = dict()
+            self._early_events.setdefault(sid, []).append(variables)
+        else:
+            subscription._dispatch(variables)
+
+    def close(self):
+        """Unsubscribes from everything and stops listening."""
+        for subscription in list(self.subscriptions.values()):
+            subscription.unsubscribe()
+        self._poller.unregister(self.sock)
+        self.sock.close()
+
+
+_default_listener = None
+
+
+def default_listener():
+    """Returns an EventListener shared by all Sonos instances, creating it
+    if needed."""
+    global _default_listener
+    if _default_listener is None:
+        _default_listener = EventListener()
+    return _default_listener
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Timings of what goes on inside `upnp` and `discovery`, for working out
+where the time goes when a command is slow.
+
+Register a hook with `add_hook()` and it is called with a record for each
+phase of each request:
+
+    (name, detail, duration_us, nbytes, heap_delta)
+
+e.g. ('send_command.first_byte', 'Play', 41203, 0, 96). `heap_delta` is
+the change in allocated heap over the phase, from `gc.mem_alloc()` on
+MicroPython or tracemalloc on CPython (if it's tracing), and None if we
+can't tell.
+
+A RingBuffer can be used as a hook, to keep the last few records around
+without allocating any more memory as they arrive. With no hooks
+registered, all that's left in the hot paths is a check for None.
+"""
+
+import time
+
+try:
+    from gc import mem_alloc as _mem_alloc
+except ImportError:
+    _mem_alloc = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    # CPython.
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+
+DEFAULT_RING_BUFFER_SIZE = 64
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Calls `hook(record)` with each record from now on."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _heap():
+    if _mem_alloc is not None:
+        return _mem_alloc()
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return None
+
+
+def _emit(record):
+    for hook in _hooks:
+        hook(record)
+
+
+class Timer:
+    """Times the phases of one operation called `name`.
+
+    Each `lap()` records the time since the last one. Time given to `add()`
+    (e.g. reading from the socket while parsing a response) is recorded as
+    its own phase and left out of the next lap.
+    """
+
+    __slots__ = ('name', 'detail', '_start', '_last', '_heap_start', '_heap', '_excluded')
+
+    def __init__(self, name, detail):
+        self.name = name
+        self.detail = detail
+        self._start = self._last = ticks_us()
+        self._heap_start = self._heap = _heap()
+        self._excluded = 0
+
+    def restart(self):
+        """Starts the next lap now, forgetting the time since the last."""
+        self._last = ticks_us()
+        self._heap = _heap()
+        self._excluded = 0
+
+    def lap(self, phase, nbytes=0):
+        now = ticks_us()
+        heap = _heap()
+        _emit((
+            self.name + '.' + phase, self.detail,
+            ticks_diff(now, self._last) - self._excluded, nbytes,
+            None if heap is None else heap - self._heap
+        ))
+        self._last = now
+        self._heap = heap
+        self._excluded = 0
+
+    def add(self, phase, duration_us, nbytes=0):
+        _emit((self.name + '.' + phase, self.detail, duration_us, nbytes, None))
+        self._excluded += duration_us
+
+    def done(self, nbytes=0):
+        """Records the whole operation, from when the Timer was created."""
+        heap = _heap()
+        _emit((
+            self.name, self.detail, ticks_diff(ticks_us(), self._start), nbytes,
+            None if heap is None else heap - self._heap_start
+        ))
+
+
+def timer(name, detail=None):
+    """Returns a Timer for an operation, or None if there are no hooks to
+    tell about it."""
+    if not _hooks:
+        return None
+    return Timer(name, detail)
+
+
+class RingBuffer:
+    """A hook which keeps the last `size` records."""
+
+    def __init__(self, size=DEFAULT_RING_BUFFER_SIZE):
+        self._records = [None] * size
+        self._next = 0
+        self._count = 0
+
+    def __call__(self, record):
+        self._records[self._next] = record
+        self._next = (self._next + 1) % len(self._records)
+        self._count = min(self._count + 1, len(self._records))
+
+    def records(self):
+        """Returns the records, oldest first."""
+        size = len(self._records)
+        start = (self._next - self._count) % size
+        return [self._records[(start + idx) % size] for idx in range(self._count)]
+
+    def clear(self):
+        self._records = [None] * len(self._records)
+        self._next = 0
+        self._count = 0
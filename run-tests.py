@@ -11,5 +11,5 @@ if __name__ == '__main__':
     # Sad to have to define these here as well as in the Makefile, but ampy
     # doesn't seem to be able to pass arguments to scripts. We can't do
     # os.listdir(), as the modules are baked into the firmware image.
-    for module_name in ['test_sonos', 'test_discovery', 'test_upnp']:
+    for module_name in ['test_sonos', 'test_discovery', 'test_upnp', 'test_events', 'test_asyncsonos', 'test_scpd', 'test_bench', 'test_instrument', 'test_xmlpull', 'test_bridge', 'test_scheduler']:
         unittest.main(module_name)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Polls lots of devices for what they're playing, each about as often as
+it's worth polling it.
+
+Devices are kept in a heap, ordered by when they're next due, so each poll
+costs O(log n) however many devices there are. How long until a device is
+next due depends on what it's doing:
+
+- After something changes (a new track, or play/pause), it's polled again
+  soon, and then less and less often until it's back to...
+- PLAYING_INTERVAL while playing, but never later than just after the
+  current track should finish, so that track changes are seen promptly.
+- IDLE_INTERVAL when paused, stopped, or unreachable.
+
+Each interval gets some random jitter, so that devices added together
+don't stay in step. Requests from all devices together are held to
+`max_rate` per second.
+"""
+
+import time
+
+try:
+    import uheapq as heapq
+except ImportError:
+    import heapq
+try:
+    from urandom import getrandbits
+except ImportError:
+    from random import getrandbits
+
+import upnp
+
+
+# Intervals are in milliseconds.
+PLAYING_INTERVAL = 5000
+IDLE_INTERVAL = 60000
+CHANGED_INTERVAL = 1000
+# How long after a track should have finished to poll for the next one.
+END_OF_TRACK_MARGIN = 500
+# Intervals are moved by up to this fraction either way.
+DEFAULT_JITTER = 0.1
+# Requests per second, across all devices.
+DEFAULT_MAX_RATE = 10
+# Each poll is a GetTransportInfo and a GetPositionInfo.
+POLL_COST = 2
+
+
+class _Entry:
+
+    __slots__ = ('device', 'interval', 'track_info', 'state', 'removed')
+
+    def __init__(self, device):
+        self.device = device
+        self.interval = CHANGED_INTERVAL
+        self.track_info = None
+        self.state = None
+        self.removed = False
+
+
+class Scheduler:
+    """Polls `Sonos` devices with `track_info()`, calling
+    `on_change(device, track_info)` whenever one starts playing something
+    else, or starts or stops playing. `track_info` is None if nothing is
+    playing.
+
+    Nothing happens in the background: call `step()` from your main loop,
+    or `run_forever()`.
+    """
+
+    def __init__(self, devices=(), on_change=None, max_rate=DEFAULT_MAX_RATE,
+                 jitter=DEFAULT_JITTER):
+        self.on_change = on_change
+        self.max_rate = max_rate
+        self.jitter = jitter
+        # Entries for each device, keyed on UUID.
+        self._entries = dict()
+        # (due, sequence, entry), where due is in milliseconds of _clock().
+        # The sequence number keeps entries from ever being compared.
+        self._heap = []
+        self._sequence = 0
+        # ticks_ms() wraps around on MicroPython, so it can't be used to
+        # order the heap. Keep our own count of milliseconds instead.
+        self._elapsed = 0
+        self._last_ticks = upnp.ticks_ms()
+        # Token bucket for the rate limit.
+        self._tokens = self._capacity()
+        self._refilled = 0
+        # How many polls we've made, and how many failed.
+        self.polls = 0
+        self.errors = 0
+        for device in devices:
+            self.add(device)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _capacity(self):
+        return max(self.max_rate, POLL_COST)
+
+    def _clock(self):
+        now = upnp.ticks_ms()
+        self._elapsed += upnp.ticks_diff(now, self._last_ticks)
+        self._last_ticks = now
+        return self._elapsed
+
+    def _push(self, entry, due):
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, entry))
+
+    def add(self, device):
+        """Starts polling `device`, straight away."""
+        if device.uuid in self._entries:
+            return
+        entry = self._entries[device.uuid] = _Entry(device)
+        self._push(entry, self._clock())
+
+    def remove(self, device):
+        """Stops polling `device`."""
+        entry = self._entries.pop(device.uuid, None)
+        if entry is not None:
+            # It's left in the heap, and dropped when it comes up.
+            entry.removed = True
+
+    def _jittered(self, interval):
+        if not self.jitter:
+            return interval
+        # A random fraction between -1 and 1.
+        fraction = getrandbits(16) / 32768 - 1
+        return int(interval * (1 + self.jitter * fraction))
+
+    def _next_interval(self, entry, track_info, changed, now_ticks):
+        playing = track_info is not None and track_info.state == 'PLAYING'
+        base = PLAYING_INTERVAL if playing else IDLE_INTERVAL
+        if changed:
+            interval = CHANGED_INTERVAL
+        else:
+            interval = min(base, entry.interval * 2)
+        entry.interval = interval
+        interval = self._jittered(interval)
+        if playing and track_info.duration is not None:
+            # Be there just after the track finishes, rather than up to a
+            # whole interval later.
+            remaining = track_info.duration - track_info.estimated_position(now_ticks)
+            if remaining > 0:
+                interval = min(interval, remaining * 1000 + END_OF_TRACK_MARGIN)
+        return interval
+
+    def _poll(self, entry):
+        self.polls += 1
+        device = entry.device
+        try:
+            track_info = device.track_info(0)
+        except Exception:
+            # Whether it's gone away or its circuit breaker is open, there's
+            # no point trying again soon.
+            self.errors += 1
+            entry.interval = IDLE_INTERVAL
+            self._push(entry, self._clock() + self._jittered(IDLE_INTERVAL))
+            return
+        state = None if track_info is None else track_info.state
+        changed = track_info != entry.track_info or state != entry.state
+        entry.track_info = track_info
+        entry.state = state
+        interval = self._next_interval(entry, track_info, changed, upnp.ticks_ms())
+        self._push(entry, self._clock() + interval)
+        if changed and self.on_change is not None:
+            self.on_change(device, track_info)
+
+    def _refill(self, now):
+        elapsed = now - self._refilled
+        self._refilled = now
+        self._tokens = min(self._capacity(), self._tokens + elapsed * self.max_rate / 1000)
+
+    def step(self):
+        """Polls every device that's due, as far as the rate limit allows.
+        Returns how many milliseconds until something else is due, or None
+        if there are no devices."""
+        heap = self._heap
+        now = self._clock()
+        self._refill(now)
+        while heap and heap[0][0] <= now:
+            if self._tokens < POLL_COST:
+                # Wait until there's enough for another poll.
+                return int((POLL_COST - self._tokens) * 1000 / self.max_rate) + 1
+            _, _, entry = heapq.heappop(heap)
+            if entry.removed:
+                continue
+            self._tokens -= POLL_COST
+            self._poll(entry)
+            now = self._clock()
+            self._refill(now)
+        if not heap:
+            return None
+        return max(0, heap[0][0] - now)
+
+    def run_forever(self):
+        while True:
+            wait = self.step()
+            time.sleep((1000 if wait is None else wait) / 1000)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Actions generated from a device's own service descriptions (SCPDs), so
+that any action on any service can be called without hand-writing it.
+
+Fetching and parsing the descriptions is slow, so the result is cached on
+disk (or flash), keyed on the model and software version of the device. It
+is only done again when the firmware changes.
+"""
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import xmltok
+
+import upnp
+
+
+DEVICE_DESCRIPTION_PATH = '/xml/device_description.xml'
+DEFAULT_DESCRIPTION_CACHE_PATH = 'sonos-scpd.json'
+
+# xmltok ends its input by raising StopIteration from inside its generator,
+# which PEP 479 turns into a RuntimeError on CPython.
+_END_OF_TOKENS = (StopIteration, RuntimeError)
+
+_INTEGER_TYPES = ('ui1', 'ui2', 'ui4', 'ui8', 'i1', 'i2', 'i4', 'i8', 'int')
+
+
+def _get(url, parse):
+    """Makes a GET request for `url`, passing the response to `parse()` as
+    it is read."""
+    resp = upnp.connection_pool.stream('GET', url, {})
+    try:
+        if resp.status != 200:
+            raise Exception('GET %s failed: %d' % (url, resp.status))
+        return parse(resp)
+    finally:
+        resp.close()
+
+
+def parse_device_description(f):
+    """Parses a device_description.xml read from file-like `f`, returning
+    dict(model, software_version, services).
+
+    `services` is a list of dict(serviceType, controlURL, SCPDURL) for every
+    service on the device and its embedded devices. The model and software
+    version are those of the root device.
+    """
+    description = dict(model=None, software_version=None, services=[])
+    root_fields = dict(modelNumber='model', softwareVersion='software_version')
+    service_fields = ('serviceType', 'controlURL', 'SCPDURL')
+    service = None
+    name = None
+    tokens = xmltok.tokenize(f)
+    try:
+        while True:
+            token, value, *_ = next(tokens)
+            if token == xmltok.START_TAG:
+                name = value[1]
+                if name == 'service':
+                    service = dict()
+            elif token == xmltok.TEXT and name is not None:
+                if service is not None:
+                    if name in service_fields:
+                        service[name] = upnp._unescape(value.strip())
+                elif name in root_fields and description[root_fields[name]] is None:
+                    description[root_fields[name]] = upnp._unescape(value.strip())
+            elif token == xmltok.END_TAG:
+                name = None
+                if value[1] == 'service':
+                    description['services'].append(service)
+                    service = None
+                elif value[1] == 'root':
+                    break
+    except _END_OF_TOKENS + (xmltok.XMLSyntaxError,):
+        raise Exception('Bad device description')
+    return description
+
+
+def parse_scpd(f):
+    """Parses a service description read from file-like `f`, returning a
+    dict of {action: [arguments, results]}.
+
+    `arguments` and `results` are lists of [name, data_type], in the order
+    that the action takes/gives them.
+    """
+    actions = dict()
+    # Keyed on name, values are data types.
+    variables = dict()
+    action = argument = variable = None
+    name = None
+    tokens = xmltok.tokenize(f)
+    try:
+        while True:
+            token, value, *_ = next(tokens)
+            if token == xmltok.START_TAG:
+                name = value[1]
+                if name == 'action':
+                    action = dict(arguments=[])
+                elif name == 'argument':
+                    argument = dict()
+                elif name == 'stateVariable':
+                    variable = dict()
+            elif token == xmltok.TEXT and name is not None:
+                value = value.strip()
+                if argument is not None:
+                    argument[name] = value
+                elif variable is not None:
+                    variable[name] = value
+                elif action is not None and name == 'name':
+                    action['name'] = value
+            elif token == xmltok.END_TAG:
+                name = None
+                if value[1] == 'argument':
+                    action['arguments'].append(argument)
+                    argument = None
+                elif value[1] == 'action':
+                    actions[action['name']] = action['arguments']
+                    action = None
+                elif value[1] == 'stateVariable':
+                    variables[variable.get('name')] = variable.get('dataType', 'string')
+                    variable = None
+                elif value[1] == 'scpd':
+                    break
+    except _END_OF_TOKENS + (xmltok.XMLSyntaxError,):
+        raise Exception('Bad service description')
+
+    for action_name, action_arguments in actions.items():
+        arguments = []
+        results = []
+        for argument in action_arguments:
+            data_type = variables.get(argument.get('relatedStateVariable'), 'string')
+            if argument.get('direction') == 'out':
+                results.append([argument['name'], data_type])
+            else:
+                arguments.append([argument['name'], data_type])
+        actions[action_name] = [arguments, results]
+    return actions
+
+
+def _service_name(control_url):
+    """Names a service after its control URL, which is unique on the device
+    (unlike its type). e.g. '/MediaRenderer/AVTransport/Control' gives
+    'MediaRenderer/AVTransport'."""
+    name = control_url.strip('/')
+    if name.endswith('/Control'):
+        name = name[:-len('/Control')]
+    return name
+
+
+def fetch_description(base_url):
+    """Fetches the device description and every service's SCPD from the
+    device at `base_url`, returning dict(model, software_version, services).
+
+    `services` is keyed on `_service_name()`, and each is
+    dict(service_type, control_url, actions) where `service_type` is the
+    full URN and `actions` is as returned by `parse_scpd()`.
+    """
+    description = _get(base_url + DEVICE_DESCRIPTION_PATH, parse_device_description)
+    description['services'] = _fetch_services(base_url, description['services'])
+    return description
+
+
+def _fetch_services(base_url, services):
+    fetched = dict()
+    for service in services:
+        scpd_url = service['SCPDURL']
+        if not scpd_url.startswith('/'):
+            scpd_url = '/' + scpd_url
+        fetched[_service_name(service['controlURL'])] = dict(
+            service_type=service['serviceType'],
+            control_url=service['controlURL'],
+            actions=_get(base_url + scpd_url, parse_scpd),
+        )
+    return fetched
+
+
+class DescriptionCache:
+    """Descriptions saved by `describe()`, keyed on model and software
+    version, along with the model of each device we've seen (keyed on UUID).
+
+    Knowing a device's UUID and software version (which are both in the
+    topology) is then enough to find its description, without talking to
+    the device at all. Only the latest software version of each model is
+    kept.
+    """
+
+    def __init__(self, path=DEFAULT_DESCRIPTION_CACHE_PATH):
+        self.path = path
+        self._data = None
+
+    def __repr__(self):
+        return '<DescriptionCache path=%s>' % self.path
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                # Missing, or corrupted by losing power part-way through a
+                # write. Either way, it'll be rebuilt.
+                self._data = dict(models=dict(), descriptions=dict())
+        return self._data
+
+    def _save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self._data, f)
+
+    def get(self, uuid, software_version):
+        """Returns the cached description for device `uuid`, if it is still
+        running `software_version`."""
+        data = self._load()
+        model = data['models'].get(uuid)
+        if model is None:
+            return None
+        return self.get_model(model, software_version)
+
+    def get_model(self, model, software_version):
+        description = self._load()['descriptions'].get(model)
+        if description is not None and description['software_version'] == software_version:
+            return description
+        return None
+
+    def put(self, uuid, description):
+        data = self._load()
+        model = description['model']
+        if data['models'].get(uuid) == model and data['descriptions'].get(model) is description:
+            return
+        data['models'][uuid] = model
+        data['descriptions'][model] = description
+        self._save()
+
+    def clear(self):
+        self._data = dict(models=dict(), descriptions=dict())
+        self._save()
+
+
+# Shared by all devices, unless a different cache is passed to describe().
+description_cache = DescriptionCache()
+
+
+def describe(base_url, uuid=None, software_version=None, cache=None):
+    """Returns the description of the device at `base_url` (see
+    `fetch_description()`), from `cache` if possible.
+
+    If `uuid` and `software_version` are given (e.g. from the topology) and
+    the cache has a description for them, the device isn't contacted at
+    all. Otherwise only the device description is fetched, unless this is
+    the first device we've seen of its model and software version.
+    """
+    if cache is None:
+        cache = description_cache
+    if uuid is not None and software_version is not None:
+        description = cache.get(uuid, software_version)
+        if description is not None:
+            return description
+
+    description = _get(base_url + DEVICE_DESCRIPTION_PATH, parse_device_description)
+    cached = cache.get_model(description['model'], description['software_version'])
+    if cached is not None:
+        description = cached
+    else:
+        description['services'] = _fetch_services(base_url, description['services'])
+    if uuid is not None:
+        cache.put(uuid, description)
+    return description
+
+
+def _to_upnp(value, data_type):
+    if data_type == 'boolean':
+        if isinstance(value, str):
+            return value
+        return '1' if value else '0'
+    if data_type in _INTEGER_TYPES:
+        return int(value)
+    return value
+
+
+def _from_upnp(value, data_type):
+    if data_type == 'boolean':
+        return value in ('1', 'true', 'yes')
+    if data_type in _INTEGER_TYPES:
+        return int(value) if value else None
+    return value
+
+
+class Action:
+    """A callable SOAP action.
+
+    Arguments can be given positionally (in the order the SCPD lists them)
+    or by name, and are converted to the types the SCPD gives for them. The
+    results are returned as a dict, converted in the same way: integers are
+    ints and booleans are bools.
+    """
+
+    def __init__(self, service, name, arguments, results):
+        self.service = service
+        self.name = name
+        # Lists of [name, data_type].
+        self.arguments = arguments
+        self.results = results
+
+    def __repr__(self):
+        return '<Action %s.%s(%s)>' % (
+            self.service.name, self.name,
+            ', '.join(name for name, _ in self.arguments)
+        )
+
+    def __call__(self, *args, **kwargs):
+        response = self.service._send(
+            self.service.control_url, self.service.service_type, self.name,
+            self._arguments(args, kwargs)
+        )
+        return self._results(response)
+
+    def _arguments(self, args, kwargs):
+        """Returns the [(name, value)] to send, from the arguments given."""
+        if len(args) > len(self.arguments):
+            raise TypeError('%s takes %d arguments' % (self.name, len(self.arguments)))
+        values = dict(kwargs)
+        for (name, _), value in zip(self.arguments, args):
+            values[name] = value
+        arguments = []
+        for name, data_type in self.arguments:
+            if name not in values:
+                raise TypeError('%s missing argument %s' % (self.name, name))
+            arguments.append((name, _to_upnp(values.pop(name), data_type)))
+        if values:
+            raise TypeError('%s got unexpected arguments %s' % (
+                self.name, ', '.join(values)
+            ))
+        return arguments
+
+    def _results(self, response):
+        return dict(
+            (name, _from_upnp(response[name], data_type))
+            for name, data_type in self.results
+            if name in response
+        )
+
+
+class Service:
+    """One of a device's services, with each of its actions available as an
+    attribute. e.g. `service.Play(InstanceID=0, Speed=1)`.
+
+    `send(control_url, service_type, action, arguments)` makes the request,
+    and is usually `Sonos._send_command`. Actions are made with
+    `action_class`, which is Action unless given.
+    """
+
+    def __init__(self, name, description, send, action_class=Action):
+        self.name = name
+        self.service_type = description['service_type']
+        self.control_url = description['control_url']
+        self._send = send
+        self.actions = dict(
+            (action, action_class(self, action, arguments, results))
+            for action, (arguments, results) in description['actions'].items()
+        )
+
+    def __repr__(self):
+        return '<Service %s>' % self.name
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['actions'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def services(description, send, action_class=Action):
+    """Returns a dict of Service for each service in `description`, with
+    actions made with `action_class`.
+
+    Services are keyed on their `_service_name()`, and also on their type
+    alone (e.g. 'AVTransport') unless another service has the same type.
+    """
+    result = dict()
+    types = dict()
+    for name, service in description['services'].items():
+        result[name] = Service(name, service, send, action_class)
+        service_type = service['service_type'].split(':')[-2]
+        types[service_type] = None if service_type in types else result[name]
+    for service_type, service in types.items():
+        if service is not None and service_type not in result:
+            result[service_type] = service
+    return result
@@ -1,57 +1,198 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import errno
-import io
-import socket
-import time
-
-import xmltok
+try:
+    import _thread
+except ImportError:
+    _thread = None
 
 import upnp
 import discovery
+import events
+import scpd
+import xmlpull
 
 
 BASE_URL_TEMPLATE = 'http://%s:1400'
 
+# The most URIs a device will take in one AddMultipleURIsToQueue.
+MAX_URIS_PER_ADD = 16
+
+# How many items `Sonos.browse()` asks for at a time.
+DEFAULT_BROWSE_PAGE_SIZE = 20
+# Object IDs to pass to `Sonos.browse()`.
+QUEUE = 'Q:0'
+FAVORITES = 'FV:2'
+
+# How often `Sonos.track_info()` asks the device for the position, rather
+# than working it out for itself.
+DEFAULT_RESYNC_INTERVAL_MS = 30000
+
+
+def _parse_time(value):
+    """Parses a 'H:MM:SS' time into seconds, or None if it isn't one (e.g.
+    'NOT_IMPLEMENTED', which is what we get for radio streams)."""
+    if not value:
+        return None
+    parts = value.split(':')
+    if len(parts) != 3:
+        return None
+    try:
+        return int(parts[0]) * 3600 + int(parts[1]) * 60 + int(parts[2])
+    except ValueError:
+        return None
+
 
 class TrackInfo:
-    """Information about the currently playing track."""
+    """Information about the currently playing track.
+
+    The DIDL-Lite metadata isn't parsed until one of `artist`, `album` or
+    `title` is first read, so it costs next to nothing if you only want the
+    position. Two TrackInfos compare equal if they're for the same track,
+    which is decided from a fingerprint of the metadata without parsing it.
+
+    `duration` and `position` are `total_time` and `current_time` in seconds
+    (or None), as they were at `sampled_at` (in `upnp.ticks_ms()`). If we
+    know the device is PLAYING, `estimated_position()` carries on counting
+    from there, so a progress display needn't ask the device every second.
+    """
 
-    def __init__(self, metadata, total_time, current_time):
+    __slots__ = (
+        'total_time', 'current_time', 'duration', 'position', 'state', 'sampled_at',
+        '_metadata', '_fields', '_fingerprint',
+    )
+
+    def __init__(self, metadata, total_time, current_time, state=None, sampled_at=None):
         self.total_time = total_time
         self.current_time = current_time
-        self._parse_metadata(metadata)
-
-    def _parse_metadata(self, metadata):
-        """Parse the relevant metadata out of a <DIDL-Lite> document."""
-        tags_of_interest = {
-            ('dc', 'creator'): 'artist',
-            ('upnp', 'album'): 'album',
-            ('dc', 'title'): 'title',
-        }
-        tokens = xmltok.tokenize(io.StringIO(metadata))
-        token, value, *_ = next(tokens)
-        while True:
-            if token == xmltok.START_TAG:
-                attrib = tags_of_interest.get(value)
-                if attrib is not None:
-                    # Assume the next token is the TEXT token. None of the tags
-                    # we're interested in have any attributes, so this is probably true.
-                    token, value, *_ = next(tokens)
-                    assert token == xmltok.TEXT
-                    setattr(self, attrib, value)
-            try:
-                token, value, *_ = next(tokens)
-            except StopIteration:
-                break
+        self.duration = _parse_time(total_time)
+        self.position = _parse_time(current_time)
+        # The transport state ('PLAYING', 'PAUSED_PLAYBACK', ...), if known.
+        self.state = state
+        self.sampled_at = upnp.ticks_ms() if sampled_at is None else sampled_at
+        self._metadata = metadata
+        # (artist, album, title), once parsed.
+        self._fields = None
+        self._fingerprint = (len(metadata), hash(metadata))
+
+    @property
+    def artist(self):
+        return self._parse()[0]
+
+    @property
+    def album(self):
+        return self._parse()[1]
+
+    @property
+    def title(self):
+        return self._parse()[2]
+
+    def estimated_position(self, now=None):
+        """Returns the position in seconds at `now` (in `upnp.ticks_ms()`),
+        assuming the device has carried on playing since `sampled_at`. It
+        never goes past the end of the track."""
+        if self.position is None or self.state != 'PLAYING':
+            return self.position
+        if now is None:
+            now = upnp.ticks_ms()
+        position = self.position + upnp.ticks_diff(now, self.sampled_at) // 1000
+        if self.duration is not None and position > self.duration:
+            return self.duration
+        return position
+
+    def _parse(self):
+        if self._fields is None:
+            self._fields = self._parse_metadata(self._metadata)
+            # We don't need it any more, so let it be freed.
+            self._metadata = None
+        return self._fields
+
+    @staticmethod
+    def _parse_metadata(metadata):
+        """Parse the relevant metadata out of a <DIDL-Lite> document, returning
+        (artist, album, title). Any that are missing are None."""
+        # Stop at the end of the <item>, rather than looking through the
+        # rest of the document.
+        parser = xmlpull.Parser(metadata)
+        return tuple(parser.texts(('dc:creator', 'upnp:album', 'dc:title'), until='item'))
+
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return False
+        return self._fingerprint == other._fingerprint
+
+    def __hash__(self):
+        return hash(self._fingerprint)
 
     def __repr__(self):
-        return '<TrackInfo artist=\'%s\' album=\'%s\ title=\'%s\' position=%s/%s>' % (
+        return '<TrackInfo artist=%r album=%r title=%r position=%s/%s>' % (
             self.artist, self.album, self.title, self.current_time, self.total_time
         )
 
 
+class BrowseItem:
+    """An <item> from `Sonos.browse()`.
+
+    Like TrackInfo, the DIDL-Lite isn't parsed until one of `title`,
+    `artist`, `album` or `uri` is first read. Only the item's own XML is
+    kept, not the rest of the page it came from.
+    """
+
+    __slots__ = ('item_id', '_xml', '_fields')
+
+    def __init__(self, xml):
+        self.item_id = xmlpull.Parser(xml).find('item', ('id',))[0]
+        self._xml = xml
+        # (title, artist, album, uri), once parsed.
+        self._fields = None
+
+    @property
+    def title(self):
+        return self._parse()[0]
+
+    @property
+    def artist(self):
+        return self._parse()[1]
+
+    @property
+    def album(self):
+        return self._parse()[2]
+
+    @property
+    def uri(self):
+        return self._parse()[3]
+
+    def _parse(self):
+        if self._fields is None:
+            parser = xmlpull.Parser(self._xml)
+            self._fields = tuple(parser.texts(('dc:title', 'dc:creator', 'upnp:album', 'res')))
+            self._xml = None
+        return self._fields
+
+    def __repr__(self):
+        return '<BrowseItem id=%s title=%r>' % (self.item_id, self.title)
+
+
+def _next_page_start(response, start):
+    """Returns where the page after a Browse `response` (for the page at
+    `start`) starts, or None if there are no more."""
+    returned = int(response.get('NumberReturned', 0))
+    start += returned
+    if returned and start < int(response.get('TotalMatches', 0)):
+        return start
+    return None
+
+
+def _browse_items(response):
+    """Yields a BrowseItem for each <item> in a Browse `response`."""
+    if 'Result' not in response:
+        return
+    # The DIDL-Lite is unescaped as it's parsed, and only one <item> is ever
+    # copied out of it at a time.
+    for xml, start, end in xmlpull.elements(response.stream('Result'), 'item'):
+        yield BrowseItem(xml[start:end])
+
+
 class Sonos:
     """Represents a Sonos device (usually a speaker).
 
@@ -68,7 +209,29 @@ class Sonos:
         self.ip = ip
         self.name = name
         self.other_players = []
+        # BootSeq from the topology, which changes each time the device
+        # restarts.
+        self.boot_seq = None
+        # SoftwareVersion from the topology, which lets us find the device's
+        # service descriptions in the cache without asking it for them.
+        self.software_version = None
+        self._services = None
         self._base_url = BASE_URL_TEMPLATE % self.ip
+        # If set, called if the first command fails, to find out whether the
+        # device has moved. Used for instances which came from a cache (see
+        # `discovery.discover_cached()`).
+        self._rediscover = None
+        # The last TrackInfo from track_info(), with the transport state,
+        # and when we asked for it.
+        self._track_info = None
+        self._track_info_at = None
+        self._commands = None
+        # How long each command has, in seconds.
+        self.timeout = upnp.DEFAULT_TIMEOUT
+        # The volume of this device, and of the group it coordinates, as of
+        # the last time we set or asked for them (or None if we haven't).
+        self.volume = None
+        self.group_volume = None
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -90,13 +253,51 @@ class Sonos:
     def add_player_to_group(self, player):
         self.other_players.append(player)
 
+    def set_ip(self, ip):
+        self.ip = ip
+        self._base_url = BASE_URL_TEMPLATE % self.ip
+
+    def _send_command(self, path, service_type, action, args):
+        if self._rediscover is None:
+            return self._send(path, service_type, action, args)
+        rediscover, self._rediscover = self._rediscover, None
+        ip = self.ip
+        try:
+            return self._send(path, service_type, action, args)
+        except Exception:
+            rediscover(self)
+            if self.ip == ip:
+                # It's still there, so this is nothing to do with the cache
+                # (and the command might have been carried out).
+                raise
+        return self._send(path, service_type, action, args)
+
+    def _send(self, path, service_type, action, args):
+        return upnp.send_command(
+            self._base_url + path, service_type, 1, action, args,
+            timeout=self.timeout
+        )
+
+    @property
+    def services(self):
+        """A dict of `scpd.Service` for each of the device's services, keyed
+        on their name (e.g. 'AlarmClock' or 'MediaRenderer/AVTransport') and,
+        where it's unambiguous, their type (e.g. 'AVTransport').
+
+        These let you call any action the device has, e.g.
+        `sonos.services['RenderingControl'].GetVolume(0, 'Master')`.
+        """
+        if self._services is None:
+            description = scpd.describe(self._base_url, self.uuid, self.software_version)
+            self._services = scpd.services(description, self._send_command)
+        return self._services
+
     def _issue_av_transport_command(self, command, args=None):
         if args is None:
             args = [('InstanceID', 0), ('Speed', 1)]
         # Play/Pause/Next are all very similar.
-        return upnp.send_command(
-            self._base_url + '/MediaRenderer/AVTransport/Control',
-            'AVTransport', 1, command, args
+        return self._send_command(
+            '/MediaRenderer/AVTransport/Control', 'AVTransport', command, args
         )
 
     def play(self):
@@ -105,22 +306,541 @@ class Sonos:
         self._issue_av_transport_command('Pause')
     def next(self):
         self._issue_av_transport_command('Next')
+    def previous(self):
+        self._issue_av_transport_command('Previous')
 
-    def get_current_track_info(self):
-        response = self._issue_av_transport_command('GetPositionInfo', [
+    def _skip(self, tracks):
+        """Skips `tracks` tracks forward (or back, if negative), with as few
+        requests as we can."""
+        if tracks == 1:
+            self.next()
+        elif tracks == -1:
+            self.previous()
+        else:
+            # Seek straight to the track we'd have ended up on.
+            response = self._get_position_info()
+            self._seek_track(max(1, int(response['Track']) + tracks))
+
+    def _seek_track(self, track):
+        return self._issue_av_transport_command('Seek', [
+            ('InstanceID', 0),
+            ('Unit', 'TRACK_NR'),
+            ('Target', track),
+        ])
+
+    def add_uris_to_queue(self, tracks, position=0, as_next=False,
+                          chunk_size=MAX_URIS_PER_ADD):
+        """Adds `tracks`, an iterable of (uri, metadata) pairs, to the queue.
+        `metadata` is a DIDL-Lite document, or '' if there isn't any.
+
+        Tracks are added `chunk_size` at a time with AddMultipleURIsToQueue,
+        and each request body is streamed out rather than built in memory.
+        Only a chunk of `tracks` is taken at a time, so a generator (e.g.
+        reading a playlist from a file) needn't be held in memory either.
+
+        They are added at `position` in the queue (counting from 1), or the
+        end if it's 0. Returns (first track number, number of tracks added).
+        """
+        enqueuer = _Enqueuer(position, as_next)
+        for chunk in _chunks(tracks, chunk_size):
+            enqueuer.added_chunk(self._issue_av_transport_command(
+                'AddMultipleURIsToQueue', enqueuer.arguments(chunk)
+            ), len(chunk))
+        return enqueuer.first, enqueuer.added
+
+    def _browse(self, object_id, start, count):
+        return self._send_command(
+            '/MediaServer/ContentDirectory/Control', 'ContentDirectory', 'Browse', [
+                ('ObjectID', object_id),
+                ('BrowseFlag', 'BrowseDirectChildren'),
+                ('Filter', '*'),
+                ('StartingIndex', start),
+                ('RequestedCount', count),
+                ('SortCriteria', ''),
+            ]
+        )
+
+    def browse(self, object_id=QUEUE, page_size=DEFAULT_BROWSE_PAGE_SIZE):
+        """Yields a BrowseItem for each item in a container, such as the
+        queue (QUEUE) or Sonos favorites (FAVORITES).
+
+        Items are asked for `page_size` at a time, and (where we have
+        threads) the next page is fetched while the current one is being
+        yielded. At most two pages are held in memory, however big the
+        container is.
+        """
+        start = 0
+        wait = _prefetch(lambda: self._browse(object_id, 0, page_size))
+        while wait is not None:
+            response = wait()
+            start = _next_page_start(response, start)
+            if start is None:
+                wait = None
+            else:
+                wait = _prefetch(lambda start=start: self._browse(object_id, start, page_size))
+            for item in _browse_items(response):
+                yield item
+
+    def _issue_rendering_control_command(self, command, args):
+        return self._send_command(
+            '/MediaRenderer/RenderingControl/Control', 'RenderingControl', command, args
+        )
+
+    def _issue_group_rendering_control_command(self, command, args):
+        return self._send_command(
+            '/MediaRenderer/GroupRenderingControl/Control', 'GroupRenderingControl',
+            command, [('InstanceID', 0)] + args
+        )
+
+    def get_volume(self):
+        response = self._issue_rendering_control_command('GetVolume', [
+            ('InstanceID', 0),
+            ('Channel', 'Master'),
+        ])
+        self.volume = int(response['CurrentVolume'])
+        return self.volume
+
+    def set_volume(self, volume):
+        volume = max(0, min(100, volume))
+        self._issue_rendering_control_command('SetVolume', [
+            ('InstanceID', 0),
+            ('Channel', 'Master'),
+            ('DesiredVolume', volume),
+        ])
+        self.volume = volume
+
+    def adjust_volume(self, adjustment):
+        """Changes the volume by `adjustment` (e.g. +2 or -2) in one request,
+        without having to ask what it is first. Returns the new volume."""
+        response = self._issue_rendering_control_command('SetRelativeVolume', [
+            ('InstanceID', 0),
+            ('Channel', 'Master'),
+            ('Adjustment', adjustment),
+        ])
+        self.volume = int(response['NewVolume'])
+        return self.volume
+
+    def get_group_volume(self):
+        """Returns the volume of the group this device coordinates, which is
+        the average of its players' volumes."""
+        response = self._issue_group_rendering_control_command('GetGroupVolume', [])
+        self.group_volume = int(response['CurrentVolume'])
+        return self.group_volume
+
+    def set_group_volume(self, volume):
+        """Sets the volume of the whole group, keeping the players' volumes
+        in proportion to each other."""
+        volume = max(0, min(100, volume))
+        # The device works out each player's share from a snapshot of their
+        # volumes, so take one in case they've changed.
+        self._issue_group_rendering_control_command('SnapshotGroupVolume', [])
+        self._issue_group_rendering_control_command('SetGroupVolume', [
+            ('DesiredVolume', volume),
+        ])
+        self.group_volume = volume
+
+    def adjust_group_volume(self, adjustment):
+        """Changes the volume of the whole group by `adjustment`, with one
+        request to the coordinator rather than one per player. Returns the
+        new group volume."""
+        response = self._issue_group_rendering_control_command('SetRelativeGroupVolume', [
+            ('Adjustment', adjustment),
+        ])
+        self.group_volume = int(response['NewVolume'])
+        return self.group_volume
+
+    @property
+    def commands(self):
+        """This device's `CommandQueue`, for when commands might arrive
+        faster than the device can be told about them."""
+        if self._commands is None:
+            self._commands = CommandQueue(self)
+        return self._commands
+
+    def submit(self, command, value=1):
+        """Queues a command, combining it with any others still waiting. See
+        `CommandQueue`."""
+        self.commands.submit(command, value)
+
+    def subscribe(self, service, callback, listener=None):
+        """Subscribes to events from one of this device's services
+        ('AVTransport', 'RenderingControl' or 'ZoneGroupTopology').
+
+        `callback(variables)` is called with a dict of the variables which
+        have changed, whenever `listener.handle_events()` sees an event. If
+        no listener is given, one shared by all devices is used. Returns the
+        `events.Subscription`, which should be `unsubscribe()`d when done.
+        """
+        if listener is None:
+            listener = events.default_listener()
+        return listener.subscribe(self._base_url, service, callback)
+
+    def subscribe_track_info(self, callback, listener=None):
+        """Calls `callback(track_info)` whenever the current track changes,
+        without any polling. `track_info` is None if nothing is playing.
+
+        Events don't include the current position, so `current_time` is
+        always None.
+        """
+        def on_av_transport_event(variables):
+            if 'CurrentTrackMetaData' not in variables:
+                return
+            metadata = variables['CurrentTrackMetaData']
+            if not metadata:
+                callback(None)
+            else:
+                callback(TrackInfo(
+                    metadata, variables.get('CurrentTrackDuration'), None
+                ))
+        return self.subscribe('AVTransport', on_av_transport_event, listener)
+
+    def _get_position_info(self):
+        return self._issue_av_transport_command('GetPositionInfo', [
             ('InstanceID', 0),
             ('Channel', 'Master')
         ])
+
+    def get_current_track_info(self):
+        response = self._get_position_info()
+        return self._track_info_from_response(response)
+
+    def get_transport_state(self):
+        """Returns 'PLAYING', 'PAUSED_PLAYBACK', 'STOPPED' or 'TRANSITIONING'."""
+        response = self._issue_av_transport_command('GetTransportInfo', [
+            ('InstanceID', 0),
+        ])
+        return response['CurrentTransportState']
+
+    def track_info(self, resync_interval=DEFAULT_RESYNC_INTERVAL_MS):
+        """Like `get_current_track_info()`, but only asks the device when the
+        last answer is more than `resync_interval` ms old, or when the track
+        should have finished playing. In between, the same TrackInfo is
+        returned, and its `estimated_position()` keeps counting while it's
+        PLAYING. This costs two requests each time it does ask.
+        """
+        now = upnp.ticks_ms()
+        if self._track_info_due(resync_interval, now):
+            state = self.get_transport_state()
+            response = self._get_position_info()
+            self._track_info = self._track_info_from_response(response, state)
+            self._track_info_at = now
+        return self._track_info
+
+    def _track_info_due(self, resync_interval, now):
+        """Checks whether `track_info()` needs to ask the device."""
+        track_info = self._track_info
+        return (self._track_info_at is None or
+                upnp.ticks_diff(now, self._track_info_at) >= resync_interval or
+                (track_info is not None and track_info.state == 'PLAYING' and
+                 track_info.duration is not None and
+                 track_info.estimated_position(now) >= track_info.duration))
+
+    @staticmethod
+    def _track_info_from_response(response, state=None):
+        """Builds a TrackInfo from the response to GetPositionInfo."""
         if 'TrackMetaData' not in response:
             # Nothing playing.
             return None
-        print('hm')
         return TrackInfo(
             response['TrackMetaData'], # DIDL-Lite XML
             response['TrackDuration'], # Total length
-            response['RelTime'] # Current position
+            response['RelTime'], # Current position
+            state
         )
 
 
+def _chunks(items, size):
+    """Yields lists of up to `size` of `items`, only taking each one from
+    `items` when it's needed."""
+    items = iter(items)
+    while True:
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == size:
+                break
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+
+
+class _Enqueuer:
+    """Keeps track of adding tracks to the queue a chunk at a time, for
+    `Sonos.add_uris_to_queue()`."""
+
+    def __init__(self, position, as_next):
+        self.position = position
+        self.as_next = as_next
+        self.update_id = 0
+        self.first = None
+        self.added = 0
+
+    def arguments(self, chunk):
+        """Returns the arguments to AddMultipleURIsToQueue for a chunk of
+        (uri, metadata) pairs."""
+        position = self.position
+        return [
+            ('InstanceID', 0),
+            ('UpdateID', self.update_id),
+            ('NumberOfURIs', len(chunk)),
+            ('EnqueuedURIs', upnp.Joined(' ', [uri for uri, _ in chunk])),
+            ('EnqueuedURIsMetaData', upnp.Joined(' ', [didl or '' for _, didl in chunk])),
+            ('ContainerURI', ''),
+            ('ContainerMetaData', ''),
+            ('DesiredFirstTrackNumberEnqueued', position + self.added if position else 0),
+            ('EnqueueAsNext', 1 if self.as_next else 0),
+        ]
+
+    def added_chunk(self, response, count):
+        """Takes note of the response to adding a chunk of `count` tracks."""
+        self.update_id = response.get('NewUpdateID', 0)
+        if self.first is None:
+            self.first = int(response.get('FirstTrackNumberEnqueued', 0))
+            if self.as_next and not self.position:
+                # Put the rest after this chunk, rather than each in turn in
+                # front of the last.
+                self.position = self.first
+        self.added += int(response.get('NumTracksAdded', count))
+
+
+class CommandQueue:
+    """Queues up commands for a device, so that a burst of button presses
+    turns into as few requests as possible.
+
+    Commands that are still waiting when another arrives are combined:
+
+    - 'Play'/'Pause': only the latest is sent.
+    - 'Next'/'Previous': counted, and sent as a single Seek if there's more
+      than one to do.
+    - 'SetRelativeVolume'/'SetRelativeGroupVolume': the adjustments are
+      added together.
+
+    Only one request is made to the device at a time. `pump()` sends
+    whatever is waiting, until there's nothing left. If `threaded` (and we
+    have threads), `submit()` starts a thread to do this, so it never
+    blocks. Otherwise, `pump()` should be called from the main loop.
+    """
+
+    def __init__(self, device, threaded=True):
+        self._device = device
+        self._threaded = threaded and _thread is not None
+        self._lock = upnp.allocate_lock()
+        # 'Play' or 'Pause', if one is waiting.
+        self._transport = None
+        # How many tracks to skip: negative for Previous.
+        self._skip = 0
+        self._volume = 0
+        self._group_volume = 0
+        # Whether something is already sending commands.
+        self._busy = False
+        # The last exception raised by a background thread, if any.
+        self.error = None
+
+    def submit(self, command, value=1):
+        """Queues `command`. `value` is the number of tracks for 'Next' and
+        'Previous', and the adjustment for the volume commands."""
+        with self._lock:
+            if command in ('Play', 'Pause'):
+                self._transport = command
+            elif command == 'Next':
+                self._skip += value
+            elif command == 'Previous':
+                self._skip -= value
+            elif command == 'SetRelativeVolume':
+                self._volume += value
+            elif command == 'SetRelativeGroupVolume':
+                self._group_volume += value
+            else:
+                raise ValueError('Cannot queue %s' % command)
+            if not self._threaded or self._busy:
+                return
+            self._busy = True
+        _thread.start_new_thread(self._run, ())
+
+    def pending(self):
+        """Returns whether there are commands waiting to be sent."""
+        return (self._transport is not None or self._skip != 0 or
+                self._volume != 0 or self._group_volume != 0)
+
+    def _take(self):
+        """Takes everything that's waiting, as (transport, skip, volume,
+        group_volume), or None if there's nothing."""
+        with self._lock:
+            if not self.pending():
+                self._busy = False
+                return None
+            taken = (self._transport, self._skip, self._volume, self._group_volume)
+            self._transport = None
+            self._skip = self._volume = self._group_volume = 0
+            return taken
+
+    def _run(self):
+        try:
+            self._pump()
+        except Exception as e:
+            self.error = e
+            with self._lock:
+                self._busy = False
+
+    def pump(self):
+        """Sends everything that's waiting, returning how many requests were
+        made. Does nothing if a background thread is already doing this."""
+        with self._lock:
+            if self._busy:
+                return 0
+            self._busy = True
+        try:
+            return self._pump()
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def _calls(self, taken):
+        """Returns what to call on the device to send what `_take()` took, in
+        order, as a list of (function, number of requests it makes)."""
+        device = self._device
+        transport, skip, volume, group_volume = taken
+        calls = []
+        if skip:
+            calls.append((lambda: device._skip(skip), 1 if skip in (1, -1) else 2))
+        if volume:
+            calls.append((lambda: device.adjust_volume(volume), 1))
+        if group_volume:
+            calls.append((lambda: device.adjust_group_volume(group_volume), 1))
+        if transport is not None:
+            calls.append((lambda: device._issue_av_transport_command(transport), 1))
+        return calls
+
+    def _pump(self):
+        requests = 0
+        while True:
+            taken = self._take()
+            if taken is None:
+                return requests
+            for call, cost in self._calls(taken):
+                call()
+                requests += cost
+
+
+def _prefetch(call):
+    """Starts `call()` in a thread, if we have threads, and returns a
+    function which waits for it to finish and returns what it returned (or
+    raises what it raised). Without threads, `call()` is made when waited
+    for."""
+    if _thread is None:
+        return call
+    result = [None, None]
+    done = _thread.allocate_lock()
+    done.acquire()
+
+    def run():
+        try:
+            result[0] = call()
+        except Exception as e:
+            result[1] = e
+        done.release()
+
+    def wait():
+        done.acquire()
+        if result[1] is not None:
+            raise result[1]
+        return result[0]
+
+    _thread.start_new_thread(run, ())
+    return wait
+
+
+# How many requests broadcast() makes at once.
+DEFAULT_BROADCAST_WORKERS = 8
+
+
+def _fan_out(calls, max_workers=DEFAULT_BROADCAST_WORKERS):
+    """Calls each of `calls` (functions taking no arguments) concurrently,
+    from a pool of at most `max_workers` threads. Returns a list of what each
+    returned (or the exception it raised), in the same order."""
+    results = [None] * len(calls)
+
+    def call(idx):
+        try:
+            results[idx] = calls[idx]()
+        except Exception as e:
+            results[idx] = e
+
+    if _thread is None or len(calls) < 2:
+        for idx in range(len(calls)):
+            call(idx)
+        return results
+
+    lock = _thread.allocate_lock()
+    finished = _thread.allocate_lock()
+    finished.acquire()
+    # Index of the next call to make, and how many have finished.
+    state = [0, 0]
+
+    def worker():
+        while True:
+            with lock:
+                idx = state[0]
+                if idx >= len(calls):
+                    return
+                state[0] += 1
+            call(idx)
+            with lock:
+                state[1] += 1
+                if state[1] == len(calls):
+                    finished.release()
+
+    for _ in range(min(max_workers, len(calls))):
+        _thread.start_new_thread(worker, ())
+    finished.acquire()
+    return results
+
+
+def broadcast(speakers, command, args=None, max_workers=DEFAULT_BROADCAST_WORKERS):
+    """Sends an AVTransport `command` (e.g. 'Pause') to each of `speakers` at
+    the same time, so that it takes about as long as the slowest of them
+    rather than all of them added together. This uses a pool of threads, or
+    uasyncio where there are no threads.
+
+    Returns a list of (speaker, result) tuples in the same order as
+    `speakers`, where result is the response arguments or the exception
+    that was raised for that speaker. Nothing is raised.
+    """
+    speakers = list(speakers)
+    if _thread is None:
+        # No threads (e.g. the ESP8266), so overlap the requests with
+        # uasyncio instead.
+        import asyncsonos
+        return asyncsonos.run(asyncsonos.broadcast(speakers, command, args))
+    results = _fan_out([
+        (lambda speaker=speaker: speaker._issue_av_transport_command(command, args))
+        for speaker in speakers
+    ], max_workers)
+    return list(zip(speakers, results))
+
+
+def broadcast_to_groups(coordinators, command, args=None, members=False,
+                        max_workers=DEFAULT_BROADCAST_WORKERS):
+    """Like `broadcast()`, but for groups of speakers.
+
+    Commands that affect the whole group (like Play/Pause/Next) only need to
+    go to each coordinator. If `members` is True, the command is also sent
+    to every player in `other_players`.
+    """
+    speakers = []
+    for coordinator in coordinators:
+        speakers.append(coordinator)
+        if members:
+            speakers.extend(coordinator.other_players)
+    return broadcast(speakers, command, args, max_workers)
+
+
 if __name__ == '__main__':
-    print([s.get_current_track_info() for s in discovery.discover()])
+    import sys
+    if sys.argv[1:2] == ['bridge']:
+        # python sonos.py bridge [port]
+        import bridge
+        bridge.main(*[int(arg) for arg in sys.argv[2:3]])
+    else:
+        print([s.get_current_track_info() for s in discovery.discover()])
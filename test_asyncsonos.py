@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import time
+import unittest
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import asyncsonos
+import discovery
+import events
+import scpd
+import sonos
+import testhelpers
+import upnp
+
+from test_discovery import ACTUAL_TOPOLOGY_XML
+from test_scpd import FILES
+
+
+class AsyncSonosTests(unittest.TestCase):
+
+    def setUp(self):
+        self.device = testhelpers.FakeSonos({
+            'Play': [],
+            'Pause': [],
+            'Previous': [],
+            'Seek': [],
+            'AddMultipleURIsToQueue': [
+                ('FirstTrackNumberEnqueued', '5'),
+                ('NumTracksAdded', '16'),
+                ('NewQueueLength', '20'),
+                ('NewUpdateID', '1'),
+            ],
+            'GetTransportInfo': [('CurrentTransportState', 'PLAYING')],
+            'GetPositionInfo': [
+                ('Track', '3'),
+                ('TrackDuration', '0:04:21'),
+                ('RelTime', '0:00:42'),
+                ('TrackMetaData', '&lt;DIDL-Lite&gt;&lt;item&gt;&lt;dc:title&gt;'
+                                  'Knees to the Floor&lt;/dc:title&gt;&lt;/item&gt;'
+                                  '&lt;/DIDL-Lite&gt;'),
+            ],
+            'GetZoneGroupState': [('ZoneGroupState', ACTUAL_TOPOLOGY_XML)],
+        })
+        self.pool = asyncsonos.ConnectionPool()
+        self.original_pool = asyncsonos.connection_pool
+        asyncsonos.connection_pool = self.pool
+
+    def tearDown(self):
+        asyncsonos.connection_pool = self.original_pool
+        self.pool.close()
+        self.device.stop()
+
+    def speaker(self):
+        speaker = asyncsonos.AsyncSonos('RINCON_1', self.device.ip, 'Fake')
+        speaker._base_url = self.device.base_url
+        return speaker
+
+    def test_send_command(self):
+        """The async send_command() should give the same as the blocking one"""
+        url = self.device.base_url + '/MediaRenderer/AVTransport/Control'
+        args = [('InstanceID', 0), ('Channel', 'Master')]
+        arguments = asyncsonos.run(asyncsonos.send_command(
+            url, 'AVTransport', 1, 'GetPositionInfo', args
+        ))
+        self.assertEqual(
+            arguments,
+            upnp.send_command(url, 'AVTransport', 1, 'GetPositionInfo', args)
+        )
+
+    def test_connection_reused(self):
+        """Commands should share a keep-alive connection"""
+        speaker = self.speaker()
+
+        async def commands():
+            for _ in range(3):
+                await speaker.play()
+        asyncsonos.run(commands())
+        self.assertEqual(len(self.device.requests), 3)
+        self.assertEqual(self.device.connections, 1)
+
+    def test_get_current_track_info(self):
+        """AsyncSonos methods should be coroutines giving the same results"""
+        track_info = asyncsonos.run(self.speaker().get_current_track_info())
+        self.assertIsInstance(track_info, sonos.TrackInfo)
+        self.assertEqual(track_info.title, 'Knees to the Floor')
+        self.assertEqual(track_info.current_time, '0:00:42')
+
+    def actions(self):
+        return [
+            headers['soapaction'].rpartition('#')[2]
+            for _, _, headers, _ in self.device.requests
+        ]
+
+    def test_previous(self):
+        """previous() should be a coroutine which sends Previous"""
+        asyncsonos.run(self.speaker().previous())
+        self.assertEqual(self.actions(), ['Previous'])
+
+    def test_commands(self):
+        """Commands submitted together should be combined, and sent from a
+        task"""
+        speaker = self.speaker()
+
+        async def commands():
+            for _ in range(3):
+                speaker.submit('Next')
+            speaker.submit('Pause')
+            self.assertEqual(self.device.requests, [])
+            while speaker.commands._busy:
+                await asyncio.sleep(0.01)
+        asyncsonos.run(commands())
+        self.assertIsInstance(speaker.commands, asyncsonos.CommandQueue)
+        self.assertIs(speaker.commands.error, None)
+        self.assertEqual(self.actions(), ['GetPositionInfo', 'Seek', 'Pause'])
+        self.assertIn(b'<Target>6</Target>', self.device.requests[1][3])
+
+    def test_pump(self):
+        """pump() should be a coroutine which sends what's waiting"""
+        speaker = self.speaker()
+        # Queued without starting a task, as if one were already running.
+        sonos.CommandQueue.submit(speaker.commands, 'Previous')
+        self.assertEqual(asyncsonos.run(speaker.commands.pump()), 1)
+        self.assertEqual(self.actions(), ['Previous'])
+
+    def test_add_uris_to_queue(self):
+        """Tracks should be added a chunk at a time, with each body
+        streamed out as the blocking client would send it"""
+        tracks = [('x-file-cifs://nas/%d.mp3' % idx, '') for idx in range(20)]
+        first, _ = asyncsonos.run(self.speaker().add_uris_to_queue(tracks))
+        self.assertEqual(first, 5)
+        self.assertEqual(self.actions(), ['AddMultipleURIsToQueue'] * 2)
+        _, body = upnp.build_command('AVTransport', 1, 'AddMultipleURIsToQueue', [
+            (name, ' '.join(value.values) if isinstance(value, upnp.Joined) else value)
+            for name, value in sonos._Enqueuer(0, False).arguments(tracks[:16])
+        ])
+        self.assertEqual(self.device.requests[0][3], body)
+
+    def test_track_info(self):
+        """track_info() should only ask the device when it's due to"""
+        speaker = self.speaker()
+
+        async def track_info():
+            first = await speaker.track_info()
+            second = await speaker.track_info()
+            return first, second
+        first, second = asyncsonos.run(track_info())
+        self.assertIs(first, second)
+        self.assertEqual((first.state, first.position), ('PLAYING', 42))
+        self.assertEqual(len(self.device.requests), 2)
+
+    def test_discover(self):
+        """Async discovery should give AsyncSonos coordinators"""
+        async def _discover_ip(timeout):
+            return self.device.ip
+
+        original_template = sonos.BASE_URL_TEMPLATE
+        original_discover_ip = asyncsonos._discover_ip
+        sonos.BASE_URL_TEMPLATE = 'http://%s:' + str(self.device.port)
+        asyncsonos._discover_ip = _discover_ip
+        try:
+            coordinators = asyncsonos.run(asyncsonos.discover())
+        finally:
+            sonos.BASE_URL_TEMPLATE = original_template
+            asyncsonos._discover_ip = original_discover_ip
+        self.assertEqual(len(coordinators), 3)
+        for coordinator in coordinators:
+            self.assertIsInstance(coordinator, asyncsonos.AsyncSonos)
+        self.assertEqual(coordinators[0].name, 'Michael\'s Room')
+
+
+class AsyncSonosMethodTests(unittest.TestCase):
+    """Every public method and property of Sonos should work on an
+    AsyncSonos, either as a coroutine or (where it doesn't talk to the
+    device itself) as-is."""
+
+    path = 'test_asyncsonos_scpd.cache'
+
+    # Each method or property, how to use it, and the requests it should make.
+    METHODS = {
+        'add_player_to_group': (
+            lambda s, _: s.add_player_to_group(sonos.Sonos('RINCON_2', '127.0.0.1', 'Other')), []
+        ),
+        'set_ip': (lambda s, _: s.set_ip(s.ip), []),
+        'play': (lambda s, _: s.play(), ['Play']),
+        'pause': (lambda s, _: s.pause(), ['Pause']),
+        'next': (lambda s, _: s.next(), ['Next']),
+        'previous': (lambda s, _: s.previous(), ['Previous']),
+        'add_uris_to_queue': (
+            lambda s, _: s.add_uris_to_queue([('x-file-cifs://nas/1.mp3', '')]),
+            ['AddMultipleURIsToQueue']
+        ),
+        'browse': (lambda s, _: _collect(s.browse()), ['Browse']),
+        'get_volume': (lambda s, _: s.get_volume(), ['GetVolume']),
+        'set_volume': (lambda s, _: s.set_volume(10), ['SetVolume']),
+        'adjust_volume': (lambda s, _: s.adjust_volume(2), ['SetRelativeVolume']),
+        'get_group_volume': (lambda s, _: s.get_group_volume(), ['GetGroupVolume']),
+        'set_group_volume': (
+            lambda s, _: s.set_group_volume(10), ['SnapshotGroupVolume', 'SetGroupVolume']
+        ),
+        'adjust_group_volume': (lambda s, _: s.adjust_group_volume(2), ['SetRelativeGroupVolume']),
+        'submit': (lambda s, _: _submit(s, 'Pause'), ['Pause']),
+        'subscribe': (
+            lambda s, listener: s.subscribe('AVTransport', print, listener), ['SUBSCRIBE']
+        ),
+        'subscribe_track_info': (
+            lambda s, listener: s.subscribe_track_info(print, listener), ['SUBSCRIBE']
+        ),
+        'get_current_track_info': (lambda s, _: s.get_current_track_info(), ['GetPositionInfo']),
+        'get_transport_state': (lambda s, _: s.get_transport_state(), ['GetTransportInfo']),
+        'track_info': (lambda s, _: s.track_info(), ['GetTransportInfo', 'GetPositionInfo']),
+        'commands': (lambda s, _: s.commands.pump(), []),
+        # The device description, then each of its four SCPDs.
+        'services': (lambda s, _: _get_volume_action(s), ['GET'] * 5 + ['GetVolume']),
+    }
+
+    def setUp(self):
+        self.device = testhelpers.FakeSonos({
+            'Play': [], 'Pause': [], 'Next': [], 'Previous': [],
+            'AddMultipleURIsToQueue': [
+                ('FirstTrackNumberEnqueued', '1'), ('NumTracksAdded', '1'), ('NewUpdateID', '1'),
+            ],
+            'Browse': [
+                ('Result', upnp._escape('<DIDL-Lite><item id="Q:0/1"></item></DIDL-Lite>')),
+                ('NumberReturned', '1'), ('TotalMatches', '1'),
+            ],
+            'GetVolume': [('CurrentVolume', '20')],
+            'SetVolume': [],
+            'SetRelativeVolume': [('NewVolume', '22')],
+            'GetGroupVolume': [('CurrentVolume', '30')],
+            'SnapshotGroupVolume': [],
+            'SetGroupVolume': [],
+            'SetRelativeGroupVolume': [('NewVolume', '32')],
+            'GetPositionInfo': [('TrackDuration', '0:04:21'), ('RelTime', '0:00:42'),
+                                ('TrackMetaData', '')],
+            'GetTransportInfo': [('CurrentTransportState', 'PLAYING')],
+        }, files=FILES)
+        self.original_cache = scpd.description_cache
+        scpd.description_cache = scpd.DescriptionCache(self.path)
+        self.listener = events.EventListener(ip='127.0.0.1', port=0)
+        self.pool = asyncsonos.ConnectionPool()
+        self.original_pool = asyncsonos.connection_pool
+        asyncsonos.connection_pool = self.pool
+        self.original_template = sonos.BASE_URL_TEMPLATE
+        sonos.BASE_URL_TEMPLATE = 'http://%s:' + str(self.device.port)
+
+    def tearDown(self):
+        sonos.BASE_URL_TEMPLATE = self.original_template
+        asyncsonos.connection_pool = self.original_pool
+        self.pool.close()
+        self.listener.close()
+        self.device.stop()
+        scpd.description_cache = self.original_cache
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_every_method(self):
+        """Each method should make the requests it's meant to"""
+        public = set(name for name in dir(sonos.Sonos) if not name.startswith('_'))
+        self.assertEqual(public, set(self.METHODS))
+        for name in sorted(self.METHODS):
+            call, expected = self.METHODS[name]
+            self.device.requests = []
+            speaker = asyncsonos.AsyncSonos('RINCON_1', self.device.ip, 'Fake')
+            result = call(speaker, self.listener)
+            if hasattr(result, 'send'):
+                # A coroutine.
+                result = asyncsonos.run(result)
+            actions = [
+                headers['soapaction'].rpartition('#')[2] if method == 'POST' else method
+                for method, _, headers, _ in self.device.requests
+            ]
+            self.assertEqual(actions, expected, name)
+            if isinstance(result, events.Subscription):
+                result.unsubscribe()
+
+    def test_services(self):
+        """Actions should be coroutines, with typed results, and the
+        description should only be fetched once"""
+        speaker = asyncsonos.AsyncSonos('RINCON_1', self.device.ip, 'Fake')
+        self.assertEqual(asyncsonos.run(_get_volume_action(speaker)), dict(CurrentVolume=20))
+        self.device.requests = []
+        self.assertEqual(asyncsonos.run(_get_volume_action(speaker)), dict(CurrentVolume=20))
+        self.assertEqual([method for method, _, _, _ in self.device.requests], ['POST'])
+
+
+async def _get_volume_action(speaker):
+    services = await speaker.services
+    return await services['RenderingControl'].GetVolume(0, 'Master')
+
+
+async def _collect(items):
+    collected = []
+    async for item in items:
+        collected.append(item)
+    return collected
+
+
+async def _submit(speaker, command):
+    speaker.submit(command)
+    while speaker.commands._busy:
+        await asyncio.sleep(0.01)
+
+
+class AsyncBrowseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.total = 45
+        self.speaker = asyncsonos.AsyncSonos('', '', '')
+        self.speaker._browse = self.browse
+
+    async def browse(self, object_id, start, count):
+        self.requests.append((object_id, start, count))
+        items = [
+            '<item id="Q:0/%d"><dc:title>Track %d</dc:title></item>' % (idx + 1, idx)
+            for idx in range(start, min(start + count, self.total))
+        ]
+        return upnp.Arguments({
+            'Result': upnp._escape('<DIDL-Lite>%s</DIDL-Lite>' % ''.join(items)),
+            'NumberReturned': str(len(items)),
+            'TotalMatches': str(self.total),
+        })
+
+    def items(self, object_id=sonos.QUEUE):
+        """Goes through browse() with `async for`, returning the items and
+        how many pages had been asked for as each was reached."""
+        async def browse():
+            items = []
+            requested = []
+            async for item in self.speaker.browse(object_id, page_size=20):
+                # Let the prefetch get going.
+                await asyncio.sleep(0)
+                items.append(item)
+                requested.append(len(self.requests))
+            return items, requested
+        return asyncsonos.run(browse())
+
+    def test_paged(self):
+        """Every item should be given, with the next page asked for before
+        this one is used up"""
+        items, requested = self.items()
+        self.assertEqual(len(items), 45)
+        self.assertEqual(items[44].title, 'Track 44')
+        self.assertEqual(self.requests, [('Q:0', 0, 20), ('Q:0', 20, 20), ('Q:0', 40, 20)])
+        self.assertEqual((requested[0], requested[20]), (2, 3))
+
+    def test_empty(self):
+        """An empty container should give nothing"""
+        self.total = 0
+        self.assertEqual(self.items(sonos.FAVORITES), ([], []))
+        self.assertEqual(len(self.requests), 1)
+
+
+class AsyncDeadlineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.device = testhelpers.FakeSonos({'Play': []}, latency=0.3)
+        self.pool = asyncsonos.ConnectionPool()
+
+    def tearDown(self):
+        upnp.connection_pool.breakers.pop('%s:%d' % (self.device.ip, self.device.port), None)
+        self.pool.close()
+        self.device.stop()
+
+    def send(self, timeout):
+        return asyncsonos.run(self.send_async(timeout))
+
+    def send_async(self, timeout):
+        return asyncsonos.send_command(
+            self.device.base_url + '/MediaRenderer/AVTransport/Control',
+            'AVTransport', 1, 'Play', [('InstanceID', 0)], pool=self.pool, timeout=timeout
+        )
+
+    def test_timeout(self):
+        """A device that's too slow should raise Timeout by the deadline"""
+        start = time.time()
+        with self.assertRaises(upnp.Timeout):
+            self.send(0.1)
+        self.assertLess(time.time() - start, 0.25)
+
+    def test_circuit_breaker(self):
+        """After repeated timeouts, commands should fail without waiting,
+        for the blocking client as well"""
+        for _ in range(upnp.DEFAULT_BREAKER_THRESHOLD):
+            with self.assertRaises(upnp.Timeout):
+                self.send(0.05)
+        self.assertFalse(upnp.connection_pool.is_available(self.device.base_url))
+        with self.assertRaises(upnp.CircuitOpen):
+            self.send(0.05)
+        self.assertEqual(len(self.device.requests), upnp.DEFAULT_BREAKER_THRESHOLD)
+
+        self.device.latency = 0
+        self.pool.breaker(self.device.ip, self.device.port).cooldown = 0
+        self.assertEqual(self.send(1), dict())
+        self.assertTrue(upnp.connection_pool.is_available(self.device.base_url))
+
+    def test_cancelled_probe(self):
+        """A probe that's cancelled shouldn't keep the breaker from being
+        probed again"""
+        breaker = self.pool.breaker(self.device.ip, self.device.port)
+        breaker.cooldown = 0
+        for _ in range(upnp.DEFAULT_BREAKER_THRESHOLD):
+            breaker.failed()
+
+        async def cancel_probe():
+            task = asyncio.create_task(self.send_async(None))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        asyncsonos.run(cancel_probe())
+        self.assertTrue(breaker.is_open())
+        self.assertTrue(breaker.allow())
+
+    def test_speaker_timeout(self):
+        """AsyncSonos commands should be given the speaker's timeout"""
+        speaker = asyncsonos.AsyncSonos('RINCON_1', self.device.ip, 'Fake')
+        speaker._base_url = self.device.base_url
+        speaker.timeout = 0.1
+        original_pool = asyncsonos.connection_pool
+        asyncsonos.connection_pool = self.pool
+        try:
+            with self.assertRaises(upnp.Timeout):
+                asyncsonos.run(speaker.play())
+        finally:
+            asyncsonos.connection_pool = original_pool
+
+
+class AsyncDiscoverIPTests(unittest.TestCase):
+
+    def setUp(self):
+        self.original_address = discovery.SSDP_ADDRESS
+        self.original_cache = discovery.known_devices
+        discovery.known_devices = discovery.DeviceCache()
+
+    def tearDown(self):
+        discovery.SSDP_ADDRESS = self.original_address
+        discovery.known_devices = self.original_cache
+
+    def test_discover_ip(self):
+        """The first device to answer should be found, without holding up
+        other tasks while we wait for it"""
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+
+        async def search():
+            task = asyncio.create_task(ticker())
+            try:
+                return await asyncsonos._discover_ip(1)
+            finally:
+                task.cancel()
+
+        responses = [testhelpers.ssdp_response('RINCON_1', '192.168.1.10')]
+        with testhelpers.FakeSSDPResponder(responses, delay=0.2) as responder:
+            discovery.SSDP_ADDRESS = responder.address
+            self.assertEqual(asyncsonos.run(search()), '192.168.1.10')
+        self.assertGreater(len(ticks), 5)
+
+    def test_nothing_answers(self):
+        """If nothing answers, None should be returned after the timeout"""
+        with testhelpers.FakeSSDPResponder([]) as responder:
+            discovery.SSDP_ADDRESS = responder.address
+            start = time.time()
+            self.assertIs(asyncsonos.run(asyncsonos._discover_ip(0.2)), None)
+            self.assertLess(time.time() - start, 1)
+
+
+class AsyncBroadcastTests(unittest.TestCase):
+
+    latency = 0.2
+
+    def test_broadcast_concurrently(self):
+        """Commands should be sent to every speaker at once"""
+        devices = [
+            testhelpers.FakeSonos({'Pause': []}, latency=self.latency)
+            for _ in range(4)
+        ]
+        devices[1].responses = {}
+        try:
+            speakers = []
+            for device in devices:
+                speaker = sonos.Sonos('RINCON_1', device.ip, 'Fake')
+                speaker._base_url = device.base_url
+                speakers.append(speaker)
+            start = time.time()
+            results = asyncsonos.run(asyncsonos.broadcast(speakers, 'Pause'))
+            self.assertLess(time.time() - start, self.latency * 2.5)
+        finally:
+            for device in devices:
+                device.stop()
+        self.assertEqual([speaker for speaker, _ in results], speakers)
+        self.assertIsInstance(results[1][1], Exception)
+        self.assertEqual(results[0][1], dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
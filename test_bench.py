@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import io
+import unittest
+
+import bench
+import discovery
+
+
+class BenchTests(unittest.TestCase):
+
+    def test_topology_xml(self):
+        """The fake household should parse into groups of two"""
+        groups = list(discovery._parse_zone_groups(io.StringIO(bench.topology_xml(5))))
+        self.assertEqual([len(group['players']) for group in groups], [2, 2, 1])
+
+    def test_run(self):
+        """Every benchmark should run and give its timings and heap usage"""
+        results = bench.run(players=3, iterations=1)
+        self.assertEqual(results['players'], 3)
+        self.assertEqual(
+            [result['name'] for result in results['results']],
+            ['discover', 'query_zone_group_topology', 'get_current_track_info',
+             'play', 'broadcast_play']
+        )
+        for result in results['results']:
+            self.assertGreater(result['heap_bytes'], 0)
+            self.assertGreaterEqual(result['max_ms'], result['min_ms'])
+
+    def test_parse_args(self):
+        """Options should be parsed without argparse"""
+        self.assertEqual(
+            bench._parse_args(['--players', '12', '--latency', '5']),
+            dict(players=12, latency=5, iterations=bench.DEFAULT_ITERATIONS)
+        )
+        with self.assertRaises(SystemExit):
+            bench._parse_args(['--bogus', '1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
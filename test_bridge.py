@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import socket
+import time
+import unittest
+
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+import bridge
+import sonos
+import upnp
+
+from test_sonos import GET_POSITION_INFO_RESPONSE
+
+
+class FakeSpeaker(sonos.Sonos):
+    """A Sonos which answers AVTransport commands itself, counting them.
+    Commands in `refused` fail as if the device had gone away."""
+
+    def __init__(self, uuid, name):
+        super().__init__(uuid, '127.0.0.1', name)
+        self.requests = []
+        self.state = 'PLAYING'
+        self.refused = ()
+        self._commands = sonos.CommandQueue(self, threaded=False)
+
+    def _issue_av_transport_command(self, command, args=None):
+        self.requests.append(command)
+        if command in self.refused:
+            raise OSError(111, 'Connection refused')
+        if command == 'GetTransportInfo':
+            return {'CurrentTransportState': self.state}
+        if command == 'GetPositionInfo':
+            return GET_POSITION_INFO_RESPONSE
+        return dict()
+
+
+def _request(port, method, path, headers=''):
+    """Makes a request to the bridge, returning (status, JSON body).
+    `headers` are any extra header lines, each ending in CRLF."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    try:
+        sock.connect(('127.0.0.1', port))
+        sock.sendall((
+            '%s %s HTTP/1.1\r\nHost: localhost\r\n%s\r\n' % (method, path, headers)
+        ).encode('utf-8'))
+        response = b''
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                break
+            response += data
+    finally:
+        sock.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]), json.loads(body.decode('utf-8'))
+
+
+@unittest.skipIf(_thread is None, 'needs threads')
+class BridgeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.speakers = [FakeSpeaker('RINCON_1', 'Kitchen'), FakeSpeaker('RINCON_2', 'Study')]
+        self.original_retry = bridge.DISCOVERY_RETRY_INTERVAL
+        bridge.DISCOVERY_RETRY_INTERVAL = 20
+        self.bridge = bridge.Bridge(
+            port=0, poll_interval=20, resync_interval=60000,
+            discover=self.discover
+        )
+        self.discovery_error = None
+        self.stopped = _thread.allocate_lock()
+        self.stopped.acquire()
+
+        def serve():
+            try:
+                self.bridge.serve_forever()
+            finally:
+                self.stopped.release()
+
+        _thread.start_new_thread(serve, ())
+
+    def tearDown(self):
+        self.bridge._running = False
+        self.stopped.acquire()
+        self.bridge.close()
+        bridge.DISCOVERY_RETRY_INTERVAL = self.original_retry
+
+    def discover(self, cache):
+        if self.discovery_error is not None:
+            raise self.discovery_error
+        return iter(self.speakers)
+
+    def wait_for_version(self):
+        for _ in range(100):
+            if self.bridge.version:
+                return
+            time.sleep(0.01)
+
+    def test_state(self):
+        """The state of every device should be served as JSON"""
+        self.wait_for_version()
+        status, state = _request(self.bridge.port, 'GET', '/state')
+        self.assertEqual(status, 200)
+        self.assertEqual([device['name'] for device in state['devices']], ['Kitchen', 'Study'])
+        track = state['devices'][0]['track']
+        self.assertEqual(track['title'], 'Knees to the Floor')
+        self.assertEqual((track['position'], track['duration'], track['state']), (42, 261, 'PLAYING'))
+
+    def test_upstream_independent_of_clients(self):
+        """However many clients ask, each device should only be asked once"""
+        self.wait_for_version()
+        for _ in range(10):
+            _request(self.bridge.port, 'GET', '/state')
+        self.assertEqual(self.speakers[0].requests, ['GetTransportInfo', 'GetPositionInfo'])
+
+    def test_command(self):
+        """Commands should be queued for the device"""
+        self.wait_for_version()
+        status, body = _request(self.bridge.port, 'POST', '/devices/RINCON_2/Next?value=1')
+        self.assertEqual((status, body), (202, dict(queued='Next')))
+        for _ in range(100):
+            if 'Next' in self.speakers[1].requests:
+                break
+            time.sleep(0.01)
+        self.assertIn('Next', self.speakers[1].requests)
+        self.assertEqual(_request(self.bridge.port, 'POST', '/devices/RINCON_3/Next')[0], 404)
+        self.assertEqual(_request(self.bridge.port, 'POST', '/devices/RINCON_2/Stop')[0], 400)
+
+    def test_long_poll(self):
+        """A long-poll should be answered as soon as something changes"""
+        self.wait_for_version()
+        version = self.bridge.version
+        start = time.time()
+
+        def change():
+            time.sleep(0.2)
+            self.speakers[0].state = 'PAUSED_PLAYBACK'
+            self.speakers[0]._track_info_at = None
+
+        _thread.start_new_thread(change, ())
+        status, state = _request(self.bridge.port, 'GET', '/state?since=%d' % version)
+        self.assertEqual(status, 200)
+        self.assertGreater(state['version'], version)
+        self.assertEqual(state['devices'][0]['track']['state'], 'PAUSED_PLAYBACK')
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_bad_request(self):
+        """A request that doesn't make sense should get a 400"""
+        self.wait_for_version()
+        status, body = _request(self.bridge.port, 'GET', '/state?since=x')
+        self.assertEqual(status, 400)
+        self.assertIn('error', body)
+        self.assertEqual(_request(self.bridge.port, 'GET', '/state')[0], 200)
+
+    def test_header_too_long(self):
+        """A header too long to read should get a 400, not stop the bridge"""
+        self.wait_for_version()
+        status, _ = _request(self.bridge.port, 'GET', '/state', 'Cookie: %s\r\n' % ('x' * 900))
+        self.assertEqual(status, 400)
+        self.assertEqual(_request(self.bridge.port, 'GET', '/state')[0], 200)
+
+    def test_discovery_failure(self):
+        """If discovery fails, the devices found before should still be
+        served, along with the error"""
+        self.wait_for_version()
+        self.discovery_error = OSError('Network is unreachable')
+        for _ in range(100):
+            if self.bridge.error is not None:
+                break
+            time.sleep(0.01)
+        status, state = _request(self.bridge.port, 'GET', '/state')
+        self.assertEqual(status, 200)
+        self.assertEqual(state['error'], 'Network is unreachable')
+        self.assertEqual([device['name'] for device in state['devices']], ['Kitchen', 'Study'])
+        self.discovery_error = None
+        for _ in range(100):
+            if self.bridge.error is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(_request(self.bridge.port, 'GET', '/state')[1]['error'])
+
+
+class PollTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.original_ticks_ms = upnp.ticks_ms
+        upnp.ticks_ms = lambda: self.now
+        self.speakers = [FakeSpeaker('RINCON_1', 'Kitchen'), FakeSpeaker('RINCON_2', 'Study')]
+        self.discoveries = 0
+        self.discovery_error = None
+        self.bridge = bridge.Bridge(port=0, resync_interval=60000, discover=self.discover)
+
+    def tearDown(self):
+        self.bridge.close()
+        upnp.ticks_ms = self.original_ticks_ms
+
+    def discover(self, cache):
+        self.discoveries += 1
+        if self.discovery_error is not None:
+            raise self.discovery_error
+        return iter(self.speakers)
+
+    def test_discovery_backs_off(self):
+        """Discovery shouldn't be tried on every poll while it's failing"""
+        self.bridge.poll()
+        self.discovery_error = OSError('Network is unreachable')
+        for _ in range(10):
+            self.bridge.poll()
+            self.now += 1000
+        # At 0, then 5000 (and next at 15000).
+        self.assertEqual(self.discoveries, 3)
+        self.assertEqual(sorted(self.bridge.devices), ['RINCON_1', 'RINCON_2'])
+        self.discovery_error = None
+        self.now = 15000
+        self.bridge.poll()
+        self.assertIsNone(self.bridge.error)
+        self.now += 1000
+        self.bridge.poll()
+        self.assertEqual(self.discoveries, 5)
+
+    def test_command_failure(self):
+        """A command that fails should be reported in that device's state,
+        without keeping the others from being polled"""
+        self.speakers[0].refused = ('Next',)
+        self.speakers[0].submit('Next')
+        self.bridge.poll()
+        self.assertIn('refused', self.bridge.state['RINCON_1']['error'])
+        self.assertEqual(self.bridge.state['RINCON_1']['track']['state'], 'PLAYING')
+        self.assertIsNone(self.bridge.state['RINCON_2']['error'])
+        self.assertIn('GetPositionInfo', self.speakers[1].requests)
+        # It's only reported until the next poll.
+        self.bridge.poll()
+        self.assertIsNone(self.bridge.state['RINCON_1']['error'])
+
+
+class QueryTests(unittest.TestCase):
+
+    def test_parse_query(self):
+        """Query strings should be split into a dict"""
+        self.assertEqual(bridge._parse_query('since=3&value=-2'), dict(since='3', value='-2'))
+        self.assertEqual(bridge._parse_query(''), dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
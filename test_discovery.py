@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import io
+import os
+import time
 import types
 import unittest
 
@@ -50,37 +53,152 @@ ACTUAL_TOPOLOGY_XML = (
 ACTUAL_TOPOLOGY_PARSED = [
     {
         'coordinator_uuid': 'RINCON_5CAA0000000000001',
+        'id': 'RINCON_5CAA0000000000001:13',
         'players': {
             'RINCON_5CAA0000000000001': {
                 'ip': '192.168.1.100',
                 'name': 'Michael\'s Room',
-                'uuid': 'RINCON_5CAA0000000000001'
+                'uuid': 'RINCON_5CAA0000000000001',
+                'boot_seq': 13,
+                'software_version': '34.7-33240-Wilco_Release'
             }
         }
     },
     {
         'coordinator_uuid': 'RINCON_B8E90000000000002',
+        'id': 'RINCON_B8E90000000000002:67',
         'players': {
             'RINCON_B8E90000000000002': {
                 'ip': '192.168.1.67',
                 'name': 'Living Room',
-                'uuid': 'RINCON_B8E90000000000002'
+                'uuid': 'RINCON_B8E90000000000002',
+                'boot_seq': 92,
+                'software_version': '34.7-33240-Wilco_Release'
             }
         }
     },
     {
         'coordinator_uuid': 'RINCON_B8E90000000000003',
+        'id': 'RINCON_B8E90000000000003:49',
         'players': {
             'RINCON_B8E90000000000003': {
                 'ip': '192.168.1.69',
                 'name': 'Dining Room',
-                'uuid': 'RINCON_B8E90000000000003'
+                'uuid': 'RINCON_B8E90000000000003',
+                'boot_seq': 113,
+                'software_version': '34.7-33240-Wilco_Release'
             }
         }
     }
 ]
 
 
+class SSDPTests(unittest.TestCase):
+
+    def setUp(self):
+        self.original_address = discovery.SSDP_ADDRESS
+        self.cache = discovery.DeviceCache()
+
+    def tearDown(self):
+        discovery.SSDP_ADDRESS = self.original_address
+
+    def responder(self, responses, delay=0):
+        responder = testhelpers.FakeSSDPResponder(responses, delay)
+        discovery.SSDP_ADDRESS = responder.address
+        return responder
+
+    def test_parse_ssdp_response(self):
+        """The interesting headers of an SSDP response should be parsed"""
+        response = testhelpers.ssdp_response('RINCON_1', '192.168.1.10', max_age=900)
+        self.assertEqual(discovery._parse_ssdp_response(response), {
+            'uuid': 'RINCON_1',
+            'ip': '192.168.1.10',
+            'location': 'http://192.168.1.10:1400/xml/device_description.xml',
+            'household': 'Sonos_fake',
+            'max_age': 900,
+        })
+        self.assertIs(discovery._parse_ssdp_response(b'HTTP/1.1 200 OK\r\n\r\n'), None)
+
+    def test_discover_all(self):
+        """Every device that answers should be returned once, and cached"""
+        responses = [
+            testhelpers.ssdp_response('RINCON_1', '192.168.1.10'),
+            testhelpers.ssdp_response('RINCON_2', '192.168.1.11', max_age=0),
+        ]
+        with self.responder(responses):
+            devices = discovery.discover_all(0.5, cache=self.cache)
+        self.assertEqual(
+            sorted(device['uuid'] for device in devices),
+            ['RINCON_1', 'RINCON_2']
+        )
+        # RINCON_2 told us not to remember it.
+        self.assertEqual(
+            [device['uuid'] for device in self.cache.devices()],
+            ['RINCON_1']
+        )
+
+    def test_bad_responses_skipped(self):
+        """Responses we can't parse should be skipped, rather than stopping
+        the search"""
+        good = testhelpers.ssdp_response('RINCON_1', '192.168.1.10')
+        responses = [
+            good.replace(b'max-age = 1800', b'max-age=abc'),
+            good.replace(b'LOCATION: http://', b'LOCATION: https://'),
+            b'\xff' + good,
+            good,
+        ]
+        for response in responses[:3]:
+            self.assertIs(discovery._parse_ssdp_response(response), None)
+        with self.responder(responses):
+            devices = discovery.discover_all(0.5, cache=self.cache)
+        self.assertEqual([device['uuid'] for device in devices], ['RINCON_1'])
+
+    def test_responses_without_usn(self):
+        """Devices that don't send a USN should be told apart by their
+        LOCATION"""
+        responses = [
+            b'\r\n'.join(
+                line for line in testhelpers.ssdp_response('RINCON_1', ip).split(b'\r\n')
+                if not line.startswith(b'USN:')
+            )
+            for ip in ('192.168.1.10', '192.168.1.11')
+        ]
+        with self.responder(responses):
+            devices = discovery.discover_all(0.5, cache=self.cache)
+        self.assertEqual(
+            sorted(device['ip'] for device in devices),
+            ['192.168.1.10', '192.168.1.11']
+        )
+        self.assertEqual(len(self.cache.devices()), 2)
+
+    def test_discover_all_returns_after_count(self):
+        """discover_all() should return as soon as enough devices answer"""
+        responses = [
+            testhelpers.ssdp_response('RINCON_%d' % i, '192.168.1.%d' % i)
+            for i in range(4)
+        ]
+        with self.responder(responses, delay=0.05):
+            start = time.time()
+            devices = discovery.discover_all(5, count=2, cache=self.cache)
+            self.assertLess(time.time() - start, 2)
+        self.assertEqual(len(devices), 2)
+
+    def test_discover_ip_uses_cache(self):
+        """_discover_ip() shouldn't search if we know about a device"""
+        responses = [testhelpers.ssdp_response('RINCON_1', '192.168.1.10')]
+        original_cache = discovery.known_devices
+        discovery.known_devices = self.cache
+        try:
+            with self.responder(responses):
+                self.assertEqual(discovery._discover_ip(0.5), '192.168.1.10')
+            # Nothing is answering searches now.
+            self.assertEqual(discovery._discover_ip(0.5), '192.168.1.10')
+            self.cache.clear()
+            self.assertIs(discovery._discover_ip(0.1), None)
+        finally:
+            discovery.known_devices = original_cache
+
+
 class ZoneGroupTopologyTests(unittest.TestCase):
 
     def test_location_to_ip(self):
@@ -91,17 +209,68 @@ class ZoneGroupTopologyTests(unittest.TestCase):
 
     def test_zone_group_topology(self):
         """Parsing the Zone Group State from my local network gives the right output."""
-        xml = upnp._unescape(ACTUAL_TOPOLOGY_XML)
-        resp_arguments = {'ZoneGroupState': xml}
+        resp_arguments = upnp.Arguments({'ZoneGroupState': ACTUAL_TOPOLOGY_XML})
         with testhelpers.mock(upnp, 'send_command', resp_arguments):
             topology = discovery.query_zone_group_topology('0.0.0.0')
         self.assertEqual(topology, ACTUAL_TOPOLOGY_PARSED)
 
+    def test_zone_groups_yielded_as_parsed(self):
+        """Each group should be yielded as soon as it has been read, no matter
+        how the document is split into reads."""
+        xml = upnp._unescape(ACTUAL_TOPOLOGY_XML)
+
+        class Reader:
+            def __init__(self, read_size):
+                self.read_size = read_size
+                self.pos = 0
+            def read(self, size):
+                data = xml[self.pos:self.pos + min(size, self.read_size)]
+                self.pos += len(data)
+                return data
+
+        for read_size in (1, 7, 100, len(xml)):
+            reader = Reader(read_size)
+            groups = discovery._parse_zone_groups(reader)
+            self.assertIsInstance(groups, types.GeneratorType)
+            first = next(groups)
+            self.assertEqual(first, ACTUAL_TOPOLOGY_PARSED[0])
+            if read_size < 100:
+                self.assertLess(reader.pos, len(xml) // 2)
+            self.assertEqual([first] + list(groups), ACTUAL_TOPOLOGY_PARSED)
+
+    def test_zone_groups_with_satellites_and_vanished_devices(self):
+        """Satellites and vanished devices aren't players in their own right."""
+        xml = (
+            '<ZoneGroupState><ZoneGroups>'
+            '<ZoneGroup Coordinator="RINCON_1" ID="RINCON_1:5">'
+            '<ZoneGroupMember UUID="RINCON_1" Location="http://192.168.1.10:1400/xml/device_description.xml" ZoneName="Lounge" BootSeq="3">'
+            '<Satellite UUID="RINCON_2" Location="http://192.168.1.11:1400/xml/device_description.xml" ZoneName="Lounge" BootSeq="7"/>'
+            '</ZoneGroupMember>'
+            '</ZoneGroup>'
+            '</ZoneGroups>'
+            '<VanishedDevices><Device UUID="RINCON_3" ZoneName="Garage" Reason="powered off"/></VanishedDevices>'
+            '</ZoneGroupState>'
+        )
+        groups = list(discovery._parse_zone_groups(io.StringIO(xml)))
+        self.assertEqual(groups, [{
+            'coordinator_uuid': 'RINCON_1',
+            'id': 'RINCON_1:5',
+            'players': {
+                'RINCON_1': {
+                    'ip': '192.168.1.10',
+                    'name': 'Lounge',
+                    'uuid': 'RINCON_1',
+                    'boot_seq': 3,
+                    'software_version': None
+                }
+            }
+        }])
+
     def test_discover_actual_topology(self):
         """Given a topology, sonos.discover() should return Sonos instances for
         each speaker in the network."""
         with testhelpers.mock(discovery, '_discover_ip', '0.0.0.0'):
-            with testhelpers.mock(discovery, 'query_zone_group_topology', ACTUAL_TOPOLOGY_PARSED):
+            with testhelpers.mock(discovery, 'iter_zone_group_topology', ACTUAL_TOPOLOGY_PARSED):
                 speakers = discovery.discover()
                 self.assertIsInstance(speakers, types.GeneratorType)
                 speakers = list(speakers)
@@ -133,7 +302,7 @@ class ZoneGroupTopologyTests(unittest.TestCase):
             }
         }]
         with testhelpers.mock(discovery, '_discover_ip', '0.0.0.0'):
-            with testhelpers.mock(discovery, 'query_zone_group_topology', FAKE_TOPOLOGY_PARSED):
+            with testhelpers.mock(discovery, 'iter_zone_group_topology', FAKE_TOPOLOGY_PARSED):
                 speakers = list(discovery.discover())
                 self.assertEqual(speakers, [
                     sonos.Sonos('RINCON_5CAA0000000000001', '192.168.1.100', 'Michael\'s Room'),
@@ -142,6 +311,219 @@ class ZoneGroupTopologyTests(unittest.TestCase):
                     sonos.Sonos('RINCON_B8E90000000000002', '192.168.1.67', 'Living Room'),
                 ])
 
+    def test_discover_skips_unresponsive_coordinators(self):
+        """Coordinators whose circuit breaker is open shouldn't be yielded"""
+        breaker = upnp.connection_pool.breaker('192.168.1.67', 1400)
+        for _ in range(breaker.threshold):
+            breaker.failed()
+        try:
+            with testhelpers.mock(discovery, '_discover_ip', '0.0.0.0'):
+                with testhelpers.mock(discovery, 'iter_zone_group_topology', ACTUAL_TOPOLOGY_PARSED):
+                    speakers = list(discovery.discover())
+        finally:
+            breaker.succeeded()
+        self.assertEqual(len(speakers), 2)
+        self.assertNotIn('192.168.1.67', [speaker.ip for speaker in speakers])
+
+
+class TopologyCacheTests(unittest.TestCase):
+
+    def discover(self, cache, topology):
+        with testhelpers.mock(discovery, '_discover_ip', '0.0.0.0'):
+            with testhelpers.mock(discovery, 'iter_zone_group_topology', topology):
+                return list(discovery.discover(cache=cache))
+
+    def test_fresh_cache_does_not_query(self):
+        """While the cache is fresh, discover() shouldn't query the topology"""
+        cache = discovery.TopologyCache()
+        speakers = self.discover(cache, ACTUAL_TOPOLOGY_PARSED)
+        self.assertEqual(len(speakers), 3)
+        self.assertEqual(cache.ip, '0.0.0.0')
+        # An empty topology would give no speakers if we were to query it.
+        self.assertEqual(self.discover(cache, []), speakers)
+
+        cache.invalidate()
+        self.assertEqual(self.discover(cache, []), [])
+
+    def test_expired_cache_queries(self):
+        """The topology should be queried again once the cache has expired"""
+        cache = discovery.TopologyCache(max_age=0)
+        self.discover(cache, ACTUAL_TOPOLOGY_PARSED)
+        self.assertFalse(cache.is_fresh())
+        self.assertEqual(self.discover(cache, []), [])
+
+    def test_unchanged_groups_reused(self):
+        """Groups which haven't changed should keep the same Sonos instances"""
+        cache = discovery.TopologyCache()
+        before = self.discover(cache, ACTUAL_TOPOLOGY_PARSED)
+        self.assertEqual(cache.changed, before)
+
+        cache.invalidate()
+        after = self.discover(cache, ACTUAL_TOPOLOGY_PARSED)
+        self.assertEqual(len(after), 3)
+        for old, new in zip(before, after):
+            self.assertIs(old, new)
+        self.assertEqual(cache.changed, [])
+
+    def test_changed_groups_rebuilt(self):
+        """Only the groups with a new ID or BootSeq should be rebuilt, and
+        players which haven't restarted should be re-used"""
+        cache = discovery.TopologyCache()
+        before = self.discover(cache, ACTUAL_TOPOLOGY_PARSED)
+
+        # Living Room joins Michael's Room, and Dining Room restarts.
+        michaels_room, living_room, dining_room = [
+            dict(group, players=dict(group['players']))
+            for group in ACTUAL_TOPOLOGY_PARSED
+        ]
+        michaels_room['id'] = 'RINCON_5CAA0000000000001:14'
+        michaels_room['players'].update(living_room['players'])
+        dining_room['players']['RINCON_B8E90000000000003'] = dict(
+            dining_room['players']['RINCON_B8E90000000000003'], boot_seq=114
+        )
+
+        cache.invalidate()
+        after = self.discover(cache, [michaels_room, dining_room])
+        self.assertEqual(cache.changed, after)
+        self.assertIs(after[0], before[0])
+        self.assertEqual(after[0].other_players, [before[1]])
+        self.assertIs(after[0].other_players[0], before[1])
+        self.assertIsNot(after[1], before[2])
+        self.assertEqual(after[1].boot_seq, 114)
+
+    def test_renamed_and_moved(self):
+        """A player that's been renamed or has a new IP should be rebuilt,
+        even if its group and BootSeq haven't changed"""
+        cache = discovery.TopologyCache()
+        before = self.discover(cache, ACTUAL_TOPOLOGY_PARSED)
+        topology = [
+            dict(group, players=dict(group['players']))
+            for group in ACTUAL_TOPOLOGY_PARSED
+        ]
+        uuid = before[0].uuid
+        topology[0]['players'][uuid] = dict(
+            topology[0]['players'][uuid], name='Kitchen', ip='10.0.0.2'
+        )
+
+        cache.invalidate()
+        after = self.discover(cache, topology)
+        self.assertEqual((after[0].name, after[0].ip), ('Kitchen', '10.0.0.2'))
+        self.assertEqual(cache.changed, [after[0]])
+        self.assertIs(after[1], before[1])
+
+
+class BootCacheTests(unittest.TestCase):
+
+    path = 'test_sonos.cache'
+
+    def setUp(self):
+        self.device = testhelpers.FakeSonos({'Play': []})
+        # Point everything at our fake device, whatever IP it has.
+        self.original_template = sonos.BASE_URL_TEMPLATE
+        sonos.BASE_URL_TEMPLATE = 'http://%s:' + str(self.device.port)
+
+    def tearDown(self):
+        sonos.BASE_URL_TEMPLATE = self.original_template
+        self.device.stop()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def actions(self):
+        return [
+            headers['soapaction'].rpartition('#')[2]
+            for _, _, headers, _ in self.device.requests
+        ]
+
+    def test_save_and_load(self):
+        """Saving and loading the topology should give the same groups"""
+        coordinators = [
+            discovery._build_coordinator(group)
+            for group in ACTUAL_TOPOLOGY_PARSED
+        ]
+        discovery.save_topology(self.path, coordinators)
+        self.assertEqual(discovery.load_topology(self.path), [
+            dict(group, id=None) for group in ACTUAL_TOPOLOGY_PARSED
+        ])
+
+    def test_no_cache(self):
+        """With no cache, we should discover() and save what we find"""
+        with testhelpers.mock(discovery, '_discover_ip', '0.0.0.0'):
+            with testhelpers.mock(discovery, 'iter_zone_group_topology', ACTUAL_TOPOLOGY_PARSED):
+                coordinators = discovery.discover_cached(self.path)
+        self.assertEqual(len(coordinators), 3)
+        self.assertEqual(len(discovery.load_topology(self.path)), 3)
+
+    def test_truncated_cache(self):
+        """A cache cut short part-way through a line should be rebuilt"""
+        coordinators = [
+            discovery._build_coordinator(group)
+            for group in ACTUAL_TOPOLOGY_PARSED
+        ]
+        discovery.save_topology(self.path, coordinators)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        with open(self.path) as f:
+            saved = f.read()
+        for length in (saved.index('\t') + 1, len(saved) - 3):
+            with open(self.path, 'w') as f:
+                f.write(saved[:length])
+            with self.assertRaises(ValueError):
+                discovery.load_topology(self.path)
+            with testhelpers.mock(discovery, '_discover_ip', '0.0.0.0'):
+                with testhelpers.mock(discovery, 'iter_zone_group_topology', ACTUAL_TOPOLOGY_PARSED):
+                    self.assertEqual(discovery.discover_cached(self.path), coordinators)
+            with open(self.path) as f:
+                self.assertEqual(f.read(), saved)
+
+    def test_cached_players_not_checked(self):
+        """Players from the cache should be sent commands straight away"""
+        coordinator = sonos.Sonos('RINCON_5CAA0000000000001', '127.0.0.1', 'Michael\'s Room')
+        discovery.save_topology(self.path, [coordinator])
+        with testhelpers.mock(discovery, '_discover_ip', None):
+            coordinators = discovery.discover_cached(self.path)
+            self.assertEqual(coordinators, [coordinator])
+            self.assertEqual(self.device.requests, [])
+            coordinators[0].play()
+            coordinators[0].play()
+        self.assertEqual(self.actions(), ['Play', 'Play'])
+
+    def test_failed_command_not_resent(self):
+        """If a cached player is where we expected, a failed command should
+        be raised rather than sent again"""
+        coordinator = sonos.Sonos('RINCON_5CAA0000000000001', '127.0.0.1', 'Michael\'s Room')
+        discovery.save_topology(self.path, [coordinator])
+        topology = discovery.load_topology(self.path)
+        coordinator, = discovery.discover_cached(self.path)
+        with testhelpers.mock(discovery, '_discover_ip', '127.0.0.1'):
+            with testhelpers.mock(discovery, 'iter_zone_group_topology', topology):
+                with self.assertRaises(Exception):
+                    coordinator.pause()
+        self.assertEqual(self.actions(), ['Pause'])
+
+    def test_stale_cache_rediscovered(self):
+        """If a cached player isn't where we expected, we should search again"""
+        # Nothing is listening on 127.0.0.2.
+        stale = sonos.Sonos('RINCON_5CAA0000000000001', '127.0.0.2', 'Michael\'s Room')
+        discovery.save_topology(self.path, [stale])
+        topology = [dict(
+            coordinator_uuid='RINCON_5CAA0000000000001',
+            id='RINCON_5CAA0000000000001:1',
+            players=dict(RINCON_5CAA0000000000001=dict(
+                uuid='RINCON_5CAA0000000000001', ip='127.0.0.1',
+                name='Michael\'s Room', boot_seq=14, software_version='34.7-33240'
+            ))
+        )]
+        coordinator, = discovery.discover_cached(self.path)
+        with testhelpers.mock(discovery, '_discover_ip', '127.0.0.1'):
+            with testhelpers.mock(discovery, 'iter_zone_group_topology', topology):
+                coordinator.play()
+        self.assertEqual(coordinator.ip, '127.0.0.1')
+        self.assertEqual(self.actions(), ['Play'])
+        self.assertEqual(discovery.load_topology(self.path), [
+            dict(group, id=None) for group in topology
+        ])
+
 
 if __name__ == '__main__':
     unittest.main()
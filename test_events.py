@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import io
+import socket
+import unittest
+
+import events
+import sonos
+import testhelpers
+
+
+AV_TRANSPORT_LAST_CHANGE = (
+    '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/AVT/">'
+        '<InstanceID val="0">'
+            '<TransportState val="PLAYING"/>'
+            '<CurrentTrackDuration val="0:04:21"/>'
+            '<CurrentTrackMetaData val="&lt;DIDL-Lite&gt;&lt;/DIDL-Lite&gt;"/>'
+        '</InstanceID>'
+    '</Event>'
+)
+RENDERING_CONTROL_LAST_CHANGE = (
+    '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/RCS/">'
+        '<InstanceID val="0">'
+            '<Volume channel="Master" val="21"/>'
+            '<Volume channel="LF" val="100"/>'
+            '<Mute channel="Master" val="0"/>'
+        '</InstanceID>'
+    '</Event>'
+)
+
+
+def escape(xml):
+    return (xml
+        .replace('&', '&amp;')
+        .replace('<', '&lt;')
+        .replace('>', '&gt;')
+        .replace('"', '&quot;')
+    )
+
+
+class LastChangeTests(unittest.TestCase):
+
+    def test_av_transport_last_change(self):
+        """The variables in an AVTransport LastChange should be unescaped"""
+        self.assertEqual(events.parse_last_change(AV_TRANSPORT_LAST_CHANGE), {
+            'TransportState': 'PLAYING',
+            'CurrentTrackDuration': '0:04:21',
+            'CurrentTrackMetaData': '<DIDL-Lite></DIDL-Lite>',
+        })
+
+    def test_rendering_control_last_change(self):
+        """Per-channel variables should be keyed on their channel"""
+        self.assertEqual(events.parse_last_change(RENDERING_CONTROL_LAST_CHANGE), {
+            'Volume': '21',
+            'Volume/LF': '100',
+            'Mute': '0',
+        })
+
+    def test_bad_propertyset(self):
+        """A propertyset that's cut short should raise ValueError"""
+        with self.assertRaises(ValueError):
+            events.parse_propertyset(io.StringIO(
+                '<e:propertyset><e:property><LastChange>'
+            ))
+
+    def test_parse_timeout(self):
+        """TIMEOUT headers should be parsed into seconds"""
+        self.assertEqual(events._parse_timeout('Second-1800'), 1800)
+        self.assertEqual(
+            events._parse_timeout('Second-infinite'),
+            events.DEFAULT_SUBSCRIPTION_TIMEOUT
+        )
+
+
+class SubscriptionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.device = testhelpers.FakeSonos()
+        self.listener = events.EventListener(ip='127.0.0.1', port=0)
+        self.sonos = sonos.Sonos('RINCON_1', self.device.ip, 'Fake')
+        self.sonos._base_url = self.device.base_url
+        self.received = []
+
+    def tearDown(self):
+        self.listener.close()
+        self.device.stop()
+
+    def wait_for_events(self, count):
+        for _ in range(50):
+            if len(self.received) >= count:
+                return
+            self.listener.handle_events(100)
+        self.fail('Timed out waiting for events')
+
+    def test_subscribe_and_notify(self):
+        """NOTIFYs from the device should be passed to the callback"""
+        subscription = self.sonos.subscribe(
+            'AVTransport', self.received.append, self.listener
+        )
+        path, callback_url = self.device.subscriptions[subscription.sid]
+        self.assertEqual(path, '/MediaRenderer/AVTransport/Event')
+        self.assertEqual(callback_url, self.listener.callback_url)
+
+        self.device.notify(subscription.sid, {
+            'LastChange': escape(AV_TRANSPORT_LAST_CHANGE),
+        })
+        self.wait_for_events(1)
+        self.assertEqual(self.received[0]['TransportState'], 'PLAYING')
+
+    def test_zone_group_topology_variables(self):
+        """Services without LastChange should give their variables as-is"""
+        subscription = self.sonos.subscribe(
+            'ZoneGroupTopology', self.received.append, self.listener
+        )
+        self.device.notify(subscription.sid, {
+            'ZoneGroupState': escape('<ZoneGroups></ZoneGroups>'),
+            'ThirdPartyMediaServersX': '',
+        })
+        self.wait_for_events(1)
+        self.assertEqual(self.received, [{'ZoneGroupState': '<ZoneGroups></ZoneGroups>'}])
+
+    def test_renew_and_unsubscribe(self):
+        """Subscriptions about to expire should be renewed, and unsubscribing
+        should tell the device"""
+        subscription = self.sonos.subscribe(
+            'RenderingControl', self.received.append, self.listener
+        )
+        subscription.expires = 0
+        self.listener.handle_events()
+        self.assertGreater(subscription.expires, 0)
+        self.assertEqual(self.device.requests[-1][2]['sid'], subscription.sid)
+
+        subscription.unsubscribe()
+        self.assertEqual(self.device.subscriptions, {})
+        self.assertEqual(self.listener.subscriptions, {})
+
+    def send_to_listener(self, request):
+        """Sends `request` to the listener, returning its response."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        try:
+            sock.connect(('127.0.0.1', self.listener.port))
+            if request:
+                sock.sendall(request)
+            else:
+                # Just go away again, like a port scan.
+                return b''
+            self.listener.handle_events(1000)
+            return sock.recv(1024)
+        finally:
+            sock.close()
+
+    def test_bad_requests_ignored(self):
+        """Clients that go away or send nonsense should be answered with a
+        400, without stopping other events"""
+        subscription = self.sonos.subscribe(
+            'ZoneGroupTopology', self.received.append, self.listener
+        )
+        self.send_to_listener(b'')
+        self.listener.handle_events(100)
+        body = b'<e:propertyset><e:property><Zone'
+        response = self.send_to_listener((
+            'NOTIFY /notify HTTP/1.1\r\nSID: %s\r\nContent-Length: %d\r\n\r\n'
+            % (subscription.sid, len(body))
+        ).encode('utf-8') + body)
+        self.assertTrue(response.startswith(b'HTTP/1.1 400 '))
+
+        self.device.notify(subscription.sid, {'ZoneGroupState': 'x'})
+        self.wait_for_events(1)
+        self.assertEqual(self.received, [{'ZoneGroupState': 'x'}])
+
+    def test_resubscribe_when_renewal_refused(self):
+        """If the device has forgotten a subscription, renewing it should
+        subscribe again"""
+        subscription = self.sonos.subscribe(
+            'RenderingControl', self.received.append, self.listener
+        )
+        # As if it had restarted.
+        self.device.subscriptions = {}
+        subscription.expires = 0
+        self.listener.handle_events()
+        _, _, headers, _ = self.device.requests[-1]
+        self.assertNotIn('sid', headers)
+        self.assertEqual(headers['callback'], '<%s>' % self.listener.callback_url)
+        self.assertEqual(list(self.listener.subscriptions), [subscription.sid])
+        self.assertIn(subscription.sid, self.device.subscriptions)
+
+    def test_renewal_failure_retried(self):
+        """A subscription that can't be renewed should be tried again later,
+        without stopping the others from being renewed"""
+        unreachable = self.sonos.subscribe(
+            'AVTransport', self.received.append, self.listener
+        )
+        unreachable.event_url = 'http://127.0.0.1:1/MediaRenderer/AVTransport/Event'
+        other = self.sonos.subscribe(
+            'RenderingControl', self.received.append, self.listener
+        )
+        unreachable.expires = other.expires = 0
+        self.listener.handle_events()
+        self.assertGreater(unreachable.expires, 0)
+        self.assertGreater(other.expires, unreachable.expires)
+        self.assertEqual(self.device.requests[-1][2]['sid'], other.sid)
+
+    def test_subscribe_track_info_nothing_playing(self):
+        """Track change callbacks should be given None when nothing is playing"""
+        subscription = self.sonos.subscribe_track_info(
+            self.received.append, self.listener
+        )
+        last_change = AV_TRANSPORT_LAST_CHANGE.replace(
+            '&lt;DIDL-Lite&gt;&lt;/DIDL-Lite&gt;', ''
+        )
+        self.device.notify(subscription.sid, {'LastChange': escape(last_change)})
+        self.wait_for_events(1)
+        self.assertEqual(self.received, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import io
+import unittest
+
+import discovery
+import instrument
+import testhelpers
+import upnp
+
+
+class RingBufferTests(unittest.TestCase):
+
+    def test_keeps_last_records(self):
+        """Only the most recent records should be kept, oldest first"""
+        ring = instrument.RingBuffer(3)
+        for idx in range(5):
+            ring(idx)
+        self.assertEqual(ring.records(), [2, 3, 4])
+        ring.clear()
+        self.assertEqual(ring.records(), [])
+
+    def test_no_hooks(self):
+        """Without any hooks, there should be nothing to time with"""
+        self.assertIs(instrument.timer('send_command'), None)
+
+
+class HookTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = instrument.RingBuffer()
+        instrument.add_hook(self.ring)
+
+    def tearDown(self):
+        instrument.remove_hook(self.ring)
+
+    def names(self):
+        return [record[0] for record in self.ring.records()]
+
+    def test_send_command_phases(self):
+        """Each phase of send_command() should be recorded, with connect only
+        when a new connection is made"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos({'Play': []}) as device:
+            for _ in range(2):
+                upnp.send_command(
+                    device.base_url + '/MediaRenderer/AVTransport/Control',
+                    'AVTransport', 1, 'Play', [('InstanceID', 0)], pool=pool
+                )
+        pool.close()
+        phases = [
+            'send_command.build', 'send_command.send', 'send_command.first_byte',
+            'send_command.body', 'send_command.parse', 'send_command',
+        ]
+        self.assertEqual(self.names(), phases[:1] + ['send_command.connect'] + phases[1:] + phases)
+        for name, detail, duration_us, nbytes, _ in self.ring.records():
+            self.assertEqual(detail, 'Play')
+            self.assertGreaterEqual(duration_us, 0)
+        body = self.ring.records()[4]
+        self.assertGreater(body[3], 0)
+
+    def test_ssdp_wait(self):
+        """Time spent waiting for SSDP responses should be recorded"""
+        original = discovery.SSDP_ADDRESS
+        responses = [testhelpers.ssdp_response('RINCON_1', '192.168.1.10')]
+        with testhelpers.FakeSSDPResponder(responses) as responder:
+            discovery.SSDP_ADDRESS = responder.address
+            try:
+                discovery.discover_all(timeout=1, count=1, cache=discovery.DeviceCache())
+            finally:
+                discovery.SSDP_ADDRESS = original
+        self.assertEqual(self.names(), ['ssdp.send', 'ssdp.wait'])
+        self.assertEqual(self.ring.records()[1][3], len(responses[0]))
+
+    def test_topology_parse(self):
+        """Parsing each group should be recorded, without counting the time
+        spent by whoever is consuming the groups"""
+        xml = (
+            '<ZoneGroups>'
+            '<ZoneGroup Coordinator="RINCON_1" ID="RINCON_1:1">'
+            '<ZoneGroupMember UUID="RINCON_1" Location="http://192.168.1.10:1400/" ZoneName="A"/>'
+            '</ZoneGroup>'
+            '<ZoneGroup Coordinator="RINCON_2" ID="RINCON_2:1">'
+            '<ZoneGroupMember UUID="RINCON_2" Location="http://192.168.1.11:1400/" ZoneName="B"/>'
+            '</ZoneGroup>'
+            '</ZoneGroups>'
+        )
+        groups = list(discovery._parse_zone_groups(io.StringIO(xml)))
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(self.names().count('topology.parse'), 2)
+        self.assertIn('topology.read', self.names())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import unittest
+
+import scheduler
+import sonos
+import upnp
+
+from test_sonos import DIDL_XML
+
+
+class FakeSpeaker(sonos.Sonos):
+    """A Sonos whose transport state can be set by the test. The position
+    (in seconds) moves on with `upnp.ticks_ms()` while it's PLAYING."""
+
+    def __init__(self, uuid, state='PLAYING', position=42):
+        super().__init__(uuid, '127.0.0.1', uuid)
+        self.transport_state = state
+        self.position = position
+        self.started = upnp.ticks_ms()
+        self.requests = 0
+
+    def _issue_av_transport_command(self, command, args=None):
+        self.requests += 1
+        if command == 'GetTransportInfo':
+            return {'CurrentTransportState': self.transport_state}
+        position = self.position
+        if self.transport_state == 'PLAYING':
+            position += upnp.ticks_diff(upnp.ticks_ms(), self.started) // 1000
+        return {
+            'TrackMetaData': DIDL_XML,
+            'TrackDuration': '0:04:21',
+            'RelTime': '0:%02d:%02d' % (position // 60, position % 60),
+        }
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.original_ticks_ms = upnp.ticks_ms
+        upnp.ticks_ms = lambda: self.now
+        self.changes = []
+
+    def tearDown(self):
+        upnp.ticks_ms = self.original_ticks_ms
+
+    def scheduler(self, devices, **kwargs):
+        kwargs.setdefault('jitter', 0)
+        return scheduler.Scheduler(
+            devices, lambda device, track_info: self.changes.append(device.uuid), **kwargs
+        )
+
+    def run_for(self, s, ms):
+        """Steps the scheduler, jumping the clock to whenever it's next due,
+        until `ms` have passed. Returns the times at which it polled."""
+        polled = []
+        end = self.now + ms
+        while True:
+            polls = s.polls
+            wait = s.step()
+            if s.polls != polls:
+                polled.append(self.now)
+            if wait is None or self.now + wait > end:
+                self.now = end
+                return polled
+            self.now += max(wait, 1)
+
+    def test_backs_off_after_change(self):
+        """A device should be polled soon after it changes, then less often
+        until it's back to the PLAYING_INTERVAL"""
+        speaker = FakeSpeaker('RINCON_1')
+        s = self.scheduler([speaker])
+        self.assertEqual(self.run_for(s, 20000), [0, 1000, 3000, 7000, 12000, 17000])
+        self.assertEqual(self.changes, ['RINCON_1'])
+
+    def test_idle_polled_less(self):
+        """A paused device should be polled much less often"""
+        speaker = FakeSpeaker('RINCON_1', state='PAUSED_PLAYBACK')
+        s = self.scheduler([speaker])
+        self.run_for(s, 20000)
+        speaker.transport_state = 'PLAYING'
+        self.assertEqual(self.run_for(s, 120000)[:2], [31000, 32000])
+        self.assertEqual(self.changes, ['RINCON_1', 'RINCON_1'])
+
+    def test_polls_at_end_of_track(self):
+        """A device should be polled just after its track should finish"""
+        speaker = FakeSpeaker('RINCON_1', position=250)
+        s = self.scheduler([speaker])
+        # At 7000, there are 4s left.
+        self.assertEqual(self.run_for(s, 12000), [0, 1000, 3000, 7000, 11500])
+
+    def test_rate_limited(self):
+        """However many devices there are, requests should be kept to
+        max_rate a second"""
+        speakers = [FakeSpeaker('RINCON_%d' % idx) for idx in range(100)]
+        s = self.scheduler(speakers, max_rate=10)
+        self.run_for(s, 10000)
+        requests = sum(speaker.requests for speaker in speakers)
+        self.assertLessEqual(requests, 10 * 10 + 10)
+        self.assertGreaterEqual(requests, 10 * 10 - 10)
+
+    def test_remove(self):
+        """Removed devices shouldn't be polled"""
+        speakers = [FakeSpeaker('RINCON_1'), FakeSpeaker('RINCON_2')]
+        s = self.scheduler(speakers)
+        s.remove(speakers[0])
+        self.run_for(s, 5000)
+        self.assertEqual(speakers[0].requests, 0)
+        self.assertGreater(speakers[1].requests, 0)
+        self.assertEqual(len(s), 1)
+
+    def test_errors_back_off(self):
+        """A device that can't be reached should be left alone for a while"""
+        speaker = FakeSpeaker('RINCON_1')
+
+        def fail(command, args=None):
+            raise upnp.Timeout('Timed out')
+
+        speaker._issue_av_transport_command = fail
+        s = self.scheduler([speaker])
+        self.assertEqual(self.run_for(s, 100000), [0, 60000])
+        self.assertEqual(s.errors, 2)
+
+    def test_jitter(self):
+        """Jitter should keep intervals within the given fraction"""
+        s = self.scheduler([], jitter=0.1)
+        for _ in range(100):
+            interval = s._jittered(10000)
+            self.assertGreaterEqual(interval, 9000)
+            self.assertLessEqual(interval, 11000)
+
+
+if __name__ == '__main__':
+    unittest.main()
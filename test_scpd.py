@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import io
+import os
+import unittest
+
+import scpd
+import sonos
+import testhelpers
+
+
+# Cut down from a Play:1, with most services and all icons removed.
+DEVICE_DESCRIPTION_XML = (
+    '<?xml version="1.0" encoding="utf-8" ?>'
+    '<root xmlns="urn:schemas-upnp-org:device-1-0">'
+        '<specVersion><major>1</major><minor>0</minor></specVersion>'
+        '<device>'
+            '<deviceType>urn:schemas-upnp-org:device:ZonePlayer:1</deviceType>'
+            '<friendlyName>192.168.1.69 - Sonos PLAY:1</friendlyName>'
+            '<modelNumber>S12</modelNumber>'
+            '<softwareVersion>34.7-33240</softwareVersion>'
+            '<serviceList>'
+                '<service>'
+                    '<serviceType>urn:schemas-upnp-org:service:AlarmClock:1</serviceType>'
+                    '<serviceId>urn:upnp-org:serviceId:AlarmClock</serviceId>'
+                    '<controlURL>/AlarmClock/Control</controlURL>'
+                    '<eventSubURL>/AlarmClock/Event</eventSubURL>'
+                    '<SCPDURL>/xml/AlarmClock1.xml</SCPDURL>'
+                '</service>'
+            '</serviceList>'
+            '<deviceList>'
+                '<device>'
+                    '<deviceType>urn:schemas-upnp-org:device:MediaServer:1</deviceType>'
+                    '<modelNumber>S12</modelNumber>'
+                    '<serviceList>'
+                        '<service>'
+                            '<serviceType>urn:schemas-upnp-org:service:ConnectionManager:1</serviceType>'
+                            '<controlURL>/MediaServer/ConnectionManager/Control</controlURL>'
+                            '<SCPDURL>/xml/ConnectionManager1.xml</SCPDURL>'
+                        '</service>'
+                    '</serviceList>'
+                '</device>'
+                '<device>'
+                    '<deviceType>urn:schemas-upnp-org:device:MediaRenderer:1</deviceType>'
+                    '<serviceList>'
+                        '<service>'
+                            '<serviceType>urn:schemas-upnp-org:service:RenderingControl:1</serviceType>'
+                            '<controlURL>/MediaRenderer/RenderingControl/Control</controlURL>'
+                            '<SCPDURL>/xml/RenderingControl1.xml</SCPDURL>'
+                        '</service>'
+                        '<service>'
+                            '<serviceType>urn:schemas-upnp-org:service:ConnectionManager:1</serviceType>'
+                            '<controlURL>/MediaRenderer/ConnectionManager/Control</controlURL>'
+                            '<SCPDURL>/xml/ConnectionManager1.xml</SCPDURL>'
+                        '</service>'
+                    '</serviceList>'
+                '</device>'
+            '</deviceList>'
+        '</device>'
+    '</root>'
+)
+
+
+def scpd_xml(actions, variables):
+    return (
+        '<?xml version="1.0" encoding="utf-8" ?>'
+        '<scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+            '<specVersion><major>1</major><minor>0</minor></specVersion>'
+            '<actionList>' + ''.join(
+                '<action><name>%s</name><argumentList>%s</argumentList></action>' % (
+                    name, ''.join(
+                        '<argument><name>%s</name><direction>%s</direction>'
+                        '<relatedStateVariable>%s</relatedStateVariable></argument>'
+                        % argument for argument in arguments
+                    )
+                )
+                for name, arguments in actions
+            ) + '</actionList>'
+            '<serviceStateTable>' + ''.join(
+                '<stateVariable sendEvents="no"><name>%s</name><dataType>%s</dataType>'
+                '</stateVariable>' % variable for variable in variables
+            ) + '</serviceStateTable>'
+        '</scpd>'
+    )
+
+
+RENDERING_CONTROL_SCPD_XML = scpd_xml([
+    ('GetVolume', [
+        ('InstanceID', 'in', 'A_ARG_TYPE_InstanceID'),
+        ('Channel', 'in', 'A_ARG_TYPE_Channel'),
+        ('CurrentVolume', 'out', 'Volume'),
+    ]),
+    ('GetMute', [
+        ('InstanceID', 'in', 'A_ARG_TYPE_InstanceID'),
+        ('Channel', 'in', 'A_ARG_TYPE_Channel'),
+        ('CurrentMute', 'out', 'Mute'),
+    ]),
+], [
+    ('A_ARG_TYPE_InstanceID', 'ui4'),
+    ('A_ARG_TYPE_Channel', 'string'),
+    ('Volume', 'ui2'),
+    ('Mute', 'boolean'),
+])
+ALARM_CLOCK_SCPD_XML = scpd_xml([
+    ('GetTimeZone', [('Index', 'out', 'TimeZoneIndex')]),
+], [('TimeZoneIndex', 'i4')])
+CONNECTION_MANAGER_SCPD_XML = scpd_xml([
+    ('GetCurrentConnectionIDs', [('ConnectionIDs', 'out', 'CurrentConnectionIDs')]),
+], [('CurrentConnectionIDs', 'string')])
+
+FILES = {
+    scpd.DEVICE_DESCRIPTION_PATH: DEVICE_DESCRIPTION_XML.encode('utf-8'),
+    '/xml/AlarmClock1.xml': ALARM_CLOCK_SCPD_XML.encode('utf-8'),
+    '/xml/RenderingControl1.xml': RENDERING_CONTROL_SCPD_XML.encode('utf-8'),
+    '/xml/ConnectionManager1.xml': CONNECTION_MANAGER_SCPD_XML.encode('utf-8'),
+}
+
+
+class ParseTests(unittest.TestCase):
+
+    def test_parse_device_description(self):
+        """Services of embedded devices should be found, with the model and
+        software version of the root device"""
+        description = scpd.parse_device_description(io.StringIO(DEVICE_DESCRIPTION_XML))
+        self.assertEqual(description['model'], 'S12')
+        self.assertEqual(description['software_version'], '34.7-33240')
+        self.assertEqual(
+            [service['controlURL'] for service in description['services']],
+            [
+                '/AlarmClock/Control',
+                '/MediaServer/ConnectionManager/Control',
+                '/MediaRenderer/RenderingControl/Control',
+                '/MediaRenderer/ConnectionManager/Control',
+            ]
+        )
+
+    def test_parse_scpd(self):
+        """Arguments should be split into in and out, with their data types"""
+        actions = scpd.parse_scpd(io.StringIO(RENDERING_CONTROL_SCPD_XML))
+        self.assertEqual(actions['GetVolume'], [
+            [['InstanceID', 'ui4'], ['Channel', 'string']],
+            [['CurrentVolume', 'ui2']],
+        ])
+        self.assertEqual(actions['GetMute'][1], [['CurrentMute', 'boolean']])
+
+    def test_truncated(self):
+        """Truncated descriptions should be reported as bad, not crash"""
+        with self.assertRaises(Exception) as cm:
+            scpd.parse_device_description(io.StringIO(DEVICE_DESCRIPTION_XML[:500]))
+        self.assertEqual(str(cm.exception), 'Bad device description')
+        with self.assertRaises(Exception) as cm:
+            scpd.parse_scpd(io.StringIO(RENDERING_CONTROL_SCPD_XML[:500]))
+        self.assertEqual(str(cm.exception), 'Bad service description')
+
+
+class DescribeTests(unittest.TestCase):
+
+    path = 'test_scpd.cache'
+
+    def setUp(self):
+        self.device = testhelpers.FakeSonos({
+            'GetVolume': [('CurrentVolume', '21')],
+            'GetMute': [('CurrentMute', '1')],
+        }, files=FILES)
+        self.cache = scpd.DescriptionCache(self.path)
+
+    def tearDown(self):
+        self.device.stop()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def gets(self):
+        return [path for method, path, _, _ in self.device.requests if method == 'GET']
+
+    def test_describe_cached(self):
+        """Descriptions should be fetched once, and then found from the UUID
+        and software version alone"""
+        description = scpd.describe(self.device.base_url, 'RINCON_1', None, self.cache)
+        self.assertEqual(sorted(description['services']), [
+            'AlarmClock',
+            'MediaRenderer/ConnectionManager',
+            'MediaRenderer/RenderingControl',
+            'MediaServer/ConnectionManager',
+        ])
+        self.assertEqual(len(self.gets()), 5)
+
+        # A new cache, as if after a restart.
+        cache = scpd.DescriptionCache(self.path)
+        again = scpd.describe(self.device.base_url, 'RINCON_1', '34.7-33240', cache)
+        self.assertEqual(again, description)
+        self.assertEqual(len(self.gets()), 5)
+
+    def test_same_model_shares_description(self):
+        """Another device of the same model and version shouldn't need its
+        SCPDs fetching"""
+        scpd.describe(self.device.base_url, 'RINCON_1', None, self.cache)
+        scpd.describe(self.device.base_url, 'RINCON_2', '34.7-33240', self.cache)
+        self.assertEqual(self.gets()[5:], [scpd.DEVICE_DESCRIPTION_PATH])
+
+    def test_new_software_version(self):
+        """Descriptions for an older software version shouldn't be used"""
+        scpd.describe(self.device.base_url, 'RINCON_1', None, self.cache)
+        self.cache._data['descriptions']['S12']['software_version'] = '33.0'
+        scpd.describe(self.device.base_url, 'RINCON_1', '34.7-33240', self.cache)
+        self.assertEqual(len(self.gets()), 10)
+
+    def test_sonos_services(self):
+        """Actions should be callable, with typed arguments and results"""
+        speaker = sonos.Sonos('RINCON_1', self.device.ip, 'Fake')
+        speaker._base_url = self.device.base_url
+        original, scpd.description_cache = scpd.description_cache, self.cache
+        try:
+            services = speaker.services
+        finally:
+            scpd.description_cache = original
+        rendering_control = services['RenderingControl']
+        self.assertIs(rendering_control, services['MediaRenderer/RenderingControl'])
+        self.assertNotIn('ConnectionManager', services)
+
+        self.assertEqual(rendering_control.GetVolume(0, 'Master'), dict(CurrentVolume=21))
+        self.assertEqual(
+            rendering_control.GetMute(InstanceID=0, Channel='Master'),
+            dict(CurrentMute=True)
+        )
+        _, path, headers, body = self.device.requests[-1]
+        self.assertEqual(path, '/MediaRenderer/RenderingControl/Control')
+        self.assertEqual(
+            headers['soapaction'], 'urn:schemas-upnp-org:service:RenderingControl:1#GetMute'
+        )
+        self.assertIn(b'<InstanceID>0</InstanceID><Channel>Master</Channel>', body)
+
+        with self.assertRaises(TypeError):
+            rendering_control.GetVolume(0)
+        with self.assertRaises(AttributeError):
+            rendering_control.SetVolume
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import types
+import time
 import unittest
 
-import discovery
 import sonos
 import upnp
 import testhelpers
@@ -59,5 +58,380 @@ class SonosTests(unittest.TestCase):
             self.assertIs(track_info, None)
 
 
+class TrackInfoResyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.requests = []
+        self.original_ticks_ms = upnp.ticks_ms
+        upnp.ticks_ms = lambda: self.now
+        self.speaker = sonos.Sonos('', '', '')
+        self.speaker._issue_av_transport_command = self.issue
+
+    def tearDown(self):
+        upnp.ticks_ms = self.original_ticks_ms
+
+    def issue(self, command, args=None):
+        self.requests.append(command)
+        if command == 'GetTransportInfo':
+            return {'CurrentTransportState': 'PLAYING'}
+        return GET_POSITION_INFO_RESPONSE
+
+    def test_interpolates_between_resyncs(self):
+        """The position should be worked out locally until the resync
+        interval has passed"""
+        track_info = self.speaker.track_info(resync_interval=10000)
+        self.assertEqual((track_info.position, track_info.duration), (42, 261))
+        self.assertEqual(track_info.state, 'PLAYING')
+        self.assertEqual(len(self.requests), 2)
+        self.now += 5500
+        track_info = self.speaker.track_info(resync_interval=10000)
+        self.assertEqual(track_info.estimated_position(), 47)
+        self.assertEqual(len(self.requests), 2)
+        self.now += 5000
+        self.speaker.track_info(resync_interval=10000)
+        self.assertEqual(len(self.requests), 4)
+
+    def test_resync_at_end_of_track(self):
+        """We should ask again once the track should have finished"""
+        self.speaker.track_info(resync_interval=600000)
+        self.now += 218000
+        self.speaker.track_info(resync_interval=600000)
+        self.assertEqual(len(self.requests), 2)
+        self.now += 1000
+        self.speaker.track_info(resync_interval=600000)
+        self.assertEqual(len(self.requests), 4)
+
+
+class QueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.speaker = sonos.Sonos('', '', '')
+        self.speaker._issue_av_transport_command = self.issue
+
+    def issue(self, command, args=None):
+        args = dict(args)
+        self.requests.append(args)
+        return {
+            'FirstTrackNumberEnqueued': str(args['DesiredFirstTrackNumberEnqueued'] or 5),
+            'NumTracksAdded': str(args['NumberOfURIs']),
+            'NewUpdateID': str(len(self.requests)),
+        }
+
+    def tracks(self, count):
+        for idx in range(count):
+            yield 'x-file-cifs://nas/%d.mp3' % idx, DIDL_XML if idx % 2 else ''
+
+    def test_chunked(self):
+        """Tracks should be added a chunk at a time, each chunk after the
+        last"""
+        self.assertEqual(self.speaker.add_uris_to_queue(self.tracks(40)), (5, 40))
+        self.assertEqual([args['NumberOfURIs'] for args in self.requests], [16, 16, 8])
+        self.assertEqual([args['UpdateID'] for args in self.requests], [0, '1', '2'])
+        self.assertEqual(self.requests[2]['EnqueuedURIs'].values[0], 'x-file-cifs://nas/32.mp3')
+        self.assertEqual(self.requests[2]['EnqueuedURIsMetaData'].values[1], DIDL_XML)
+
+    def test_as_next(self):
+        """Chunks enqueued as next should stay in order"""
+        self.speaker.add_uris_to_queue(self.tracks(20), as_next=True)
+        self.assertEqual(
+            [args['DesiredFirstTrackNumberEnqueued'] for args in self.requests], [0, 21]
+        )
+
+    def test_exact_chunks(self):
+        """A whole number of chunks shouldn't need an empty request"""
+        self.speaker.add_uris_to_queue(self.tracks(32))
+        self.assertEqual(len(self.requests), 2)
+
+
+class BrowseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.total = 45
+        self.speaker = sonos.Sonos('', '', '')
+        self.speaker._browse = self.browse
+
+    def item(self, idx):
+        return DIDL_XML[DIDL_XML.index('<item '):DIDL_XML.index('</item>') + 7].replace(
+            'id="-1"', 'id="Q:0/%d"' % (idx + 1)
+        ).replace('Knees to the Floor', 'Track %d &amp; more' % idx)
+
+    def browse(self, object_id, start, count):
+        self.requests.append((object_id, start, count))
+        items = [self.item(idx) for idx in range(start, min(start + count, self.total))]
+        result = '<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">%s</DIDL-Lite>' % ''.join(items)
+        return upnp.Arguments({
+            'Result': upnp._escape(result),
+            'NumberReturned': str(len(items)),
+            'TotalMatches': str(self.total),
+        })
+
+    def test_paged(self):
+        """Every item should be yielded, a page at a time"""
+        items = list(self.speaker.browse(sonos.QUEUE, page_size=20))
+        self.assertEqual(len(items), 45)
+        self.assertEqual(self.requests, [('Q:0', 0, 20), ('Q:0', 20, 20), ('Q:0', 40, 20)])
+        self.assertEqual(items[44].item_id, 'Q:0/45')
+        self.assertEqual(items[44].title, 'Track 44 & more')
+        self.assertEqual(items[0].artist, 'Francis and the Lights')
+        self.assertTrue(items[0].uri.startswith('x-sonos-spotify:'))
+
+    def test_items_parsed_lazily(self):
+        """An item's DIDL-Lite shouldn't be parsed until it's needed"""
+        item = next(self.speaker.browse(sonos.QUEUE))
+        self.assertIs(item._fields, None)
+        self.assertEqual(item.album, 'It\'ll Be Better')
+        self.assertIs(item._xml, None)
+        with self.assertRaises(AttributeError):
+            item.something_else = 1
+
+    def test_empty(self):
+        """An empty container should yield nothing"""
+        self.total = 0
+        self.assertEqual(list(self.speaker.browse(sonos.FAVORITES)), [])
+        self.assertEqual(len(self.requests), 1)
+
+    @unittest.skipIf(sonos._thread is None, 'needs threads')
+    def test_prefetch(self):
+        """The next page should be asked for before this one is used up"""
+        items = self.speaker.browse(sonos.QUEUE, page_size=20)
+        next(items)
+        for _ in range(100):
+            if len(self.requests) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.requests, [('Q:0', 0, 20), ('Q:0', 20, 20)])
+
+
+class VolumeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.speaker = sonos.Sonos('', '', '')
+        self.speaker._send_command = self.send
+
+    def send(self, path, service_type, action, args):
+        self.requests.append((service_type, action, args))
+        if action == 'SetRelativeVolume':
+            return {'NewVolume': str(31 + dict(args)['Adjustment'])}
+        if action == 'SetRelativeGroupVolume':
+            return {'NewVolume': str(20 + dict(args)['Adjustment'])}
+        if action in ('GetVolume', 'GetGroupVolume'):
+            return {'CurrentVolume': '12'}
+        return dict()
+
+    def test_relative_volume(self):
+        """Changing the volume should be one request, and keep track of the
+        new volume"""
+        self.assertIs(self.speaker.volume, None)
+        self.assertEqual(self.speaker.adjust_volume(2), 33)
+        self.assertEqual(self.speaker.volume, 33)
+        self.assertEqual(self.requests, [
+            ('RenderingControl', 'SetRelativeVolume',
+             [('InstanceID', 0), ('Channel', 'Master'), ('Adjustment', 2)]),
+        ])
+
+    def test_group_volume(self):
+        """Group volume should be changed with one request to the
+        coordinator"""
+        self.assertEqual(self.speaker.adjust_group_volume(-5), 15)
+        self.assertEqual(self.speaker.group_volume, 15)
+        self.assertEqual(self.requests, [
+            ('GroupRenderingControl', 'SetRelativeGroupVolume',
+             [('InstanceID', 0), ('Adjustment', -5)]),
+        ])
+        self.assertEqual(self.speaker.get_group_volume(), 12)
+
+    def test_set_volume(self):
+        """Volumes should be kept between 0 and 100"""
+        self.speaker.set_volume(150)
+        self.assertEqual(self.speaker.volume, 100)
+        self.assertEqual(self.requests[0][2][-1], ('DesiredVolume', 100))
+        self.speaker.set_group_volume(-1)
+        self.assertEqual(self.speaker.group_volume, 0)
+        self.assertEqual([action for _, action, _ in self.requests[1:]],
+                         ['SnapshotGroupVolume', 'SetGroupVolume'])
+
+
+class CommandQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.speaker = sonos.Sonos('', '', '')
+        self.speaker._issue_av_transport_command = self.issue
+        self.speaker._issue_rendering_control_command = self.issue
+
+    def issue(self, command, args=None):
+        self.requests.append((command, args))
+        if command == 'GetPositionInfo':
+            return GET_POSITION_INFO_RESPONSE
+        if command == 'SetRelativeVolume':
+            return {'NewVolume': '30'}
+        return dict()
+
+    def test_coalesces(self):
+        """A burst of commands should be combined into as few requests as
+        possible"""
+        queue = sonos.CommandQueue(self.speaker, threaded=False)
+        for command in ['Play', 'Pause', 'Play', 'Next', 'Next', 'Previous', 'Next']:
+            queue.submit(command)
+        for _ in range(12):
+            queue.submit('SetRelativeVolume', 2)
+        queue.submit('SetRelativeVolume', -4)
+        self.assertTrue(queue.pending())
+        self.assertEqual(queue.pump(), 4)
+        self.assertFalse(queue.pending())
+        self.assertEqual([command for command, _ in self.requests],
+                         ['GetPositionInfo', 'Seek', 'SetRelativeVolume', 'Play'])
+        self.assertIn(('Target', 5), self.requests[1][1])
+        self.assertIn(('Adjustment', 20), self.requests[2][1])
+        self.assertEqual(queue.pump(), 0)
+
+    def test_single_skip(self):
+        """A single Next or Previous shouldn't need a Seek"""
+        queue = sonos.CommandQueue(self.speaker, threaded=False)
+        queue.submit('Previous')
+        queue.pump()
+        self.assertEqual(self.requests, [('Previous', None)])
+
+    def test_unknown_command(self):
+        """Commands we can't combine shouldn't be queued"""
+        queue = sonos.CommandQueue(self.speaker, threaded=False)
+        with self.assertRaises(ValueError):
+            queue.submit('Stop')
+
+    @unittest.skipIf(sonos._thread is None, 'needs threads')
+    def test_threaded(self):
+        """submit() shouldn't block, and commands arriving while one is in
+        flight should be combined into the next request"""
+        in_flight = sonos._thread.allocate_lock()
+        in_flight.acquire()
+
+        def issue(command, args=None):
+            in_flight.acquire()
+            self.requests.append((command, args))
+            in_flight.release()
+            return {'NewVolume': '30'}
+
+        self.speaker._issue_rendering_control_command = issue
+        for _ in range(5):
+            self.speaker.submit('SetRelativeVolume', 1)
+            time.sleep(0.01)
+        in_flight.release()
+        for _ in range(100):
+            if not self.speaker.commands._busy:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.requests, [
+            ('SetRelativeVolume', [('InstanceID', 0), ('Channel', 'Master'), ('Adjustment', 1)]),
+            ('SetRelativeVolume', [('InstanceID', 0), ('Channel', 'Master'), ('Adjustment', 4)]),
+        ])
+
+
+class TrackInfoTests(unittest.TestCase):
+
+    def test_metadata_parsed_lazily(self):
+        """The DIDL-Lite shouldn't be parsed until it's needed"""
+        track_info = sonos.TrackInfo(DIDL_XML, '0:04:21', '0:00:42')
+        self.assertEqual(track_info.current_time, '0:00:42')
+        self.assertIs(track_info._fields, None)
+        self.assertEqual(track_info.title, 'Knees to the Floor')
+        self.assertIsNot(track_info._fields, None)
+
+    def test_no_instance_dict(self):
+        """TrackInfo shouldn't carry a dict around with it"""
+        track_info = sonos.TrackInfo(DIDL_XML, '0:04:21', '0:00:42')
+        with self.assertRaises(AttributeError):
+            track_info.something_else = 1
+
+    def test_same_track_equal_without_parsing(self):
+        """Infos for the same track should be equal, without parsing either"""
+        first = sonos.TrackInfo(DIDL_XML, '0:04:21', '0:00:42')
+        second = sonos.TrackInfo(DIDL_XML, '0:04:21', '0:00:43')
+        other = sonos.TrackInfo(DIDL_XML.replace('Knees', 'Elbows'), '0:04:21', '0:00:43')
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertIs(first._fields, None)
+        self.assertIs(second._fields, None)
+
+    def test_times_in_seconds(self):
+        """Times should be parsed into seconds, and anything else into None"""
+        track_info = sonos.TrackInfo(DIDL_XML, '1:04:21', 'NOT_IMPLEMENTED')
+        self.assertEqual(track_info.duration, 3861)
+        self.assertIs(track_info.position, None)
+        self.assertIs(track_info.estimated_position(), None)
+
+    def test_estimated_position(self):
+        """The position should only move on while PLAYING, and never past the
+        end of the track"""
+        paused = sonos.TrackInfo(DIDL_XML, '0:04:21', '0:00:42', 'PAUSED_PLAYBACK', 1000)
+        self.assertEqual(paused.estimated_position(31000), 42)
+        playing = sonos.TrackInfo(DIDL_XML, '0:04:21', '0:00:42', 'PLAYING', 1000)
+        self.assertEqual(playing.estimated_position(31999), 72)
+        self.assertEqual(playing.estimated_position(1000000), 261)
+
+    def test_missing_tags(self):
+        """Missing tags should give None, rather than breaking repr()"""
+        metadata = DIDL_XML.replace('<upnp:album>It\'ll Be Better</upnp:album>', '')
+        track_info = sonos.TrackInfo(metadata, '0:04:21', '0:00:42')
+        self.assertIs(track_info.album, None)
+        self.assertEqual(track_info.artist, 'Francis and the Lights')
+        self.assertIn('album=None', repr(track_info))
+
+
+class BroadcastTests(unittest.TestCase):
+
+    latency = 0.2
+
+    def setUp(self):
+        self.devices = [
+            testhelpers.FakeSonos({'Pause': []}, latency=self.latency)
+            for _ in range(4)
+        ]
+        self.speakers = []
+        for i, device in enumerate(self.devices):
+            speaker = sonos.Sonos('RINCON_%d' % i, device.ip, 'Room %d' % i)
+            speaker._base_url = device.base_url
+            self.speakers.append(speaker)
+
+    def tearDown(self):
+        for device in self.devices:
+            device.stop()
+
+    def test_broadcast_concurrently(self):
+        """Commands should be sent to every speaker at once"""
+        start = time.time()
+        results = sonos.broadcast(self.speakers, 'Pause')
+        self.assertLess(time.time() - start, self.latency * 2.5)
+        self.assertEqual(results, [(speaker, dict()) for speaker in self.speakers])
+        for device in self.devices:
+            self.assertEqual(len(device.requests), 1)
+
+    def test_broadcast_errors_per_speaker(self):
+        """A failure on one speaker shouldn't affect the others"""
+        self.devices[1].responses = {}
+        results = sonos.broadcast(self.speakers, 'Pause')
+        self.assertEqual([speaker for speaker, _ in results], self.speakers)
+        self.assertIsInstance(results[1][1], Exception)
+        for idx in (0, 2, 3):
+            self.assertEqual(results[idx][1], dict())
+
+    def test_broadcast_to_groups(self):
+        """Group commands should go to coordinators, and optionally members"""
+        coordinator, member, other_coordinator, _ = self.speakers
+        coordinator.add_player_to_group(member)
+        results = sonos.broadcast_to_groups([coordinator, other_coordinator], 'Pause')
+        self.assertEqual([speaker for speaker, _ in results], [coordinator, other_coordinator])
+        results = sonos.broadcast_to_groups(
+            [coordinator, other_coordinator], 'Pause', members=True
+        )
+        self.assertEqual(
+            [speaker for speaker, _ in results],
+            [coordinator, member, other_coordinator]
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,16 @@
 # encoding: utf-8
 
 import io
+import time
 import unittest
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 import upnp
+import testhelpers
 
 
 class UpnpTests(unittest.TestCase):
@@ -65,5 +72,431 @@ class UpnpTests(unittest.TestCase):
         arguments = upnp.parse_response('NotReal', io.StringIO(soap_xml))
         self.assertEqual(arguments, dict(arg1='<xml attr="with \' in it"></test>'))
 
+
+class ArgumentsTests(unittest.TestCase):
+
+    def test_unescape(self):
+        """Entities should be unescaped, and anything else left alone"""
+        self.assertEqual(
+            upnp._unescape('&lt;a b=&quot;c &amp; d&quot;&gt; &amp;lt; & &foo; &amp;apos;'),
+            '<a b="c & d"> &lt; & &foo; \''
+        )
+
+    def test_values_unescaped_lazily(self):
+        """Values should be kept escaped until they are looked at"""
+        arguments = upnp.Arguments({'A': '&lt;a/&gt;', 'B': 'b'})
+        self.assertEqual(arguments._raw, {'A': '&lt;a/&gt;', 'B': 'b'})
+        self.assertEqual(arguments['A'], '<a/>')
+        self.assertEqual(arguments._raw, {'B': 'b'})
+        self.assertIn('B', arguments)
+        self.assertEqual(arguments.get('C', 'c'), 'c')
+        self.assertEqual(arguments, dict(A='<a/>', B='b'))
+
+    def test_stream(self):
+        """Values should be unescaped as they are streamed, even when an
+        entity is split across reads"""
+        value = '&lt;ZoneGroup Name=&quot;Michael&amp;apos;s Room&quot;/&gt;' * 3
+        for size in range(1, 12):
+            reader = upnp.Arguments({'ZoneGroupState': value}).stream('ZoneGroupState')
+            text = ''
+            while True:
+                data = reader.read(size)
+                if not data:
+                    break
+                self.assertLessEqual(len(data), size)
+                text += data
+            self.assertEqual(text, upnp._unescape(value))
+
+
+class BuildCommandTests(unittest.TestCase):
+
+    def test_build_command(self):
+        """The compiled action should give the same request as formatting the
+        templates would"""
+        headers, body = upnp.build_command(
+            'AVTransport', 1, 'Play', [('InstanceID', 0), ('Speed', 1)]
+        )
+        self.assertEqual(body, upnp.soap_body_template.format(
+            service_urn='urn:schemas-upnp-org:service:AVTransport:1', action='Play',
+            arguments='<InstanceID>0</InstanceID><Speed>1</Speed>'
+        ).encode('utf-8'))
+        self.assertEqual(headers, (
+            b'Content-Type: text/xml; charset="utf-8"\r\n'
+            b'SOAPACTION: urn:schemas-upnp-org:service:AVTransport:1#Play\r\n'
+        ))
+
+    def test_full_service_urn(self):
+        """Services outside the UPnP namespace should be given by their URN"""
+        headers, body = upnp.build_command(
+            'urn:schemas-sonos-com:service:Queue:1', None, 'RemoveAllTracks', []
+        )
+        self.assertIn(b'SOAPACTION: urn:schemas-sonos-com:service:Queue:1#RemoveAllTracks', headers)
+        self.assertIn(b'xmlns:u="urn:schemas-sonos-com:service:Queue:1"', body)
+
+    def test_arguments_escaped(self):
+        """Argument values should have their special characters escaped"""
+        _, body = upnp.build_command(
+            'AVTransport', 1, 'SetAVTransportURI',
+            [('CurrentURIMetaData', '<DIDL-Lite title="Rock & Roll"/>')]
+        )
+        self.assertIn(
+            b'<CurrentURIMetaData>&lt;DIDL-Lite title=&quot;Rock &amp; Roll&quot;/&gt;'
+            b'</CurrentURIMetaData>',
+            body
+        )
+
+    def test_constant_arguments_cached(self):
+        """Repeating a command with the same arguments should re-use the body"""
+        args = [('InstanceID', 0), ('Speed', 1)]
+        _, first = upnp.build_command('AVTransport', 1, 'Play', args)
+        _, second = upnp.build_command('AVTransport', 1, 'Play', list(args))
+        self.assertIs(first, second)
+        _, other = upnp.build_command('AVTransport', 1, 'Play', [('InstanceID', 1), ('Speed', 1)])
+        self.assertIsNot(other, first)
+
+    def test_cache_keyed_on_type(self):
+        """Values which are equal but render differently shouldn't share a
+        cached body"""
+        for value, rendered in ((1, b'<Value>1</Value>'), (True, b'<Value>True</Value>'),
+                                (1.0, b'<Value>1.0</Value>'), (1, b'<Value>1</Value>')):
+            _, body = upnp.build_command('RenderingControl', 1, 'SetMute', [('Value', value)])
+            self.assertIn(rendered, body)
+
+
+class FakeConnection:
+    """Stands in for upnp._Connection, serving a body in pieces."""
+
+    def __init__(self, body):
+        self.host = 'sonos'
+        self.port = 1400
+        self.body = body
+        self.bytes_read = 0
+        self.sock = object()
+        self.last_used = 0
+
+    def recv_body(self, size):
+        data = self.body[self.bytes_read:self.bytes_read + size]
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.sock = None
+
+
+class StreamingResponseTests(unittest.TestCase):
+
+    def response(self, body, chunk_size):
+        conn = FakeConnection(body)
+        pool = upnp.ConnectionPool(chunk_size=chunk_size)
+        return conn, pool, upnp._Response(pool, conn, 200, len(body), False, chunk_size)
+
+    def test_multibyte_characters_split_across_chunks(self):
+        """Characters split across chunks should be decoded correctly"""
+        body = '<a>Caf\u00e9 \u266b \U0001f3b5</a>'.encode('utf-8')
+        for chunk_size in range(1, 6):
+            _, _, resp = self.response(body, chunk_size)
+            text = ''
+            while True:
+                c = resp.read(1)
+                if not c:
+                    break
+                text += c
+            self.assertEqual(text, body.decode('utf-8'))
+
+    def test_stops_reading_after_action_response(self):
+        """parse_response() shouldn't read any further than it needs to"""
+        soap_xml = UpnpTests.soap_response_template.format(
+            action='Pause', args_xml='<arg1>value1</arg1>'
+        )
+        body = (soap_xml + '<!--' + 'x' * 4096 + '-->').encode('utf-8')
+        conn, pool, resp = self.response(body, 64)
+        arguments = upnp.parse_response('Pause', resp)
+        self.assertEqual(arguments, dict(arg1='value1'))
+        self.assertLess(conn.bytes_read, len(soap_xml) + 64)
+        # There was too much left to bother reading, so the connection
+        # should have been dropped rather than re-used.
+        resp.close()
+        self.assertIs(conn.sock, None)
+        self.assertEqual(pool._idle, dict())
+
+    def test_remainder_drained_for_reuse(self):
+        """If only a little of the body is left, it should be read so that the
+        connection can be re-used"""
+        body = b'<a>b</a><!---->'
+        conn, pool, resp = self.response(body, 64)
+        resp.read(3)
+        resp.close()
+        self.assertEqual(conn.bytes_read, len(body))
+        self.assertIsNot(conn.sock, None)
+        self.assertEqual(pool._idle, {'sonos:1400': [conn]})
+
+
+class FakeSocket:
+    """A socket which has already been sent `data`, and records what is
+    sent to it."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.sent = b''
+
+    def recv_into(self, buf):
+        size = min(len(buf), len(self.data) - self.pos)
+        buf[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def sendall(self, data):
+        self.sent += bytes(data)
+
+    def close(self):
+        pass
+
+
+class TransportTests(unittest.TestCase):
+
+    def connection(self, data, buffer_size=upnp.DEFAULT_CHUNK_SIZE):
+        conn = upnp._Connection('sonos', 1400, buffer_size)
+        conn.sock = FakeSocket(data)
+        conn._attach()
+        return conn
+
+    def test_response_head(self):
+        """The status, Content-Length and Connection headers should be parsed
+        regardless of case"""
+        conn = self.connection(
+            b'HTTP/1.1 500 Internal Server Error\r\n'
+            b'SERVER: Linux UPnP/1.0 Sonos/34.16\r\n'
+            b'content-LENGTH:  42\r\n'
+            b'CONNECTION: close\r\n\r\n'
+        )
+        self.assertEqual(conn.read_response_head(), (500, 42, True, None))
+
+    def test_response_head_with_headers(self):
+        """All headers should be collected if they're wanted"""
+        conn = self.connection(
+            b'HTTP/1.1 200 OK\r\nSID: uuid:1\r\nContent-Length: 0\r\n\r\n'
+        )
+        self.assertEqual(
+            conn.read_response_head(want_headers=True),
+            (200, 0, False, {'sid': 'uuid:1', 'content-length': '0'})
+        )
+
+    def test_header_longer_than_buffer(self):
+        """Headers which don't fit in the receive buffer should be rejected"""
+        conn = self.connection(b'HTTP/1.1 200 OK\r\nX: ' + b'x' * 64 + b'\r\n\r\n', 32)
+        with self.assertRaises(Exception):
+            conn.read_response_head()
+
+    def test_request_gathered(self):
+        """The request should be sent in one go if it fits in the buffer"""
+        conn = self.connection(b'')
+        conn.send_request('POST', '/Control', {'SOAPACTION': 'a'}, b'<body/>')
+        self.assertEqual(conn.sock.sent, (
+            b'POST /Control HTTP/1.1\r\nHost: sonos:1400\r\nSOAPACTION: a\r\n'
+            b'Content-Length: 7\r\n\r\n<body/>'
+        ))
+
+    @unittest.skipIf(tracemalloc is None, 'needs tracemalloc')
+    def test_allocations(self):
+        """Reading a large response shouldn't allocate much more than a chunk
+        at a time"""
+        body = ('<a>' + 'x' * 65536 + '</a>').encode('utf-8')
+        data = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body
+        conn = self.connection(data)
+        tracemalloc.start()
+        try:
+            start, _ = tracemalloc.get_traced_memory()
+            status, content_length, close, _ = conn.read_response_head()
+            resp = upnp._Response(
+                None, conn, status, content_length, close, upnp.DEFAULT_CHUNK_SIZE
+            )
+            while resp.read(upnp.DEFAULT_CHUNK_SIZE):
+                pass
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # Roughly one decoded chunk plus bookkeeping, however big the body.
+        self.assertLess(peak - start, 4 * upnp.DEFAULT_CHUNK_SIZE)
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    responses = {
+        'Play': [],
+        'GetPositionInfo': [('Track', '3'), ('RelTime', '0:00:42')],
+    }
+
+    def send(self, device, pool, action='Play'):
+        return upnp.send_command(
+            device.base_url + '/MediaRenderer/AVTransport/Control',
+            'AVTransport', 1, action, [('InstanceID', 0)], pool=pool
+        )
+
+    def test_split_url(self):
+        """URLs should be split into host, port and path"""
+        self.assertEqual(
+            upnp._split_url('http://192.168.1.69:1400/xml/device_description.xml'),
+            ('192.168.1.69', 1400, '/xml/device_description.xml')
+        )
+        self.assertEqual(upnp._split_url('http://sonos'), ('sonos', 80, '/'))
+
+    def test_connection_reused(self):
+        """Repeated commands to a device should share one connection"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos(self.responses) as device:
+            for _ in range(3):
+                self.assertEqual(self.send(device, pool), dict())
+            arguments = self.send(device, pool, 'GetPositionInfo')
+            self.assertEqual(arguments, dict(Track='3', RelTime='0:00:42'))
+            self.assertEqual(len(device.requests), 4)
+            self.assertEqual(device.connections, 1)
+        pool.close()
+
+    def test_connections_keyed_on_device(self):
+        """Each device should get its own connection"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos(self.responses) as first:
+            with testhelpers.FakeSonos(self.responses) as second:
+                for _ in range(2):
+                    self.send(first, pool)
+                    self.send(second, pool)
+                self.assertEqual(first.connections, 1)
+                self.assertEqual(second.connections, 1)
+        pool.close()
+
+    def test_idle_connections_evicted(self):
+        """Connections which have been idle for too long shouldn't be re-used"""
+        pool = upnp.ConnectionPool(idle_timeout=0)
+        with testhelpers.FakeSonos(self.responses) as device:
+            for _ in range(3):
+                self.send(device, pool)
+            self.assertEqual(device.connections, 3)
+            pool.evict_idle()
+            self.assertEqual(pool._idle, dict())
+
+    def test_reconnect_when_device_drops_socket(self):
+        """If the device has dropped the socket, we should reconnect and retry"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos(self.responses, keep_alive=False) as device:
+            for _ in range(3):
+                self.assertEqual(self.send(device, pool), dict())
+            self.assertEqual(len(device.requests), 3)
+            self.assertEqual(device.connections, 3)
+        pool.close()
+
+    def idle_connection(self, pool, data):
+        """Puts a connection in `pool` which has been sent `data`, as if it
+        had been used before."""
+        conn = upnp._Connection('sonos', 1400)
+        conn.sock = FakeSocket(data)
+        conn._attach()
+        conn.last_used = time.time()
+        pool._release(conn)
+        return conn
+
+    def test_retry_only_before_response(self):
+        """A request should only be sent again if the old socket failed
+        before any of the response came back"""
+        response = b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+        pool = upnp.ConnectionPool()
+        connects = []
+
+        def connect(conn, timer):
+            connects.append(conn)
+            conn.sock = FakeSocket(response)
+            conn._attach()
+
+        pool._connect = connect
+        self.idle_connection(pool, b'')
+        self.assertEqual(pool.request('POST', 'http://sonos:1400/', {})[0], 200)
+        self.assertEqual(len(connects), 1)
+
+        self.idle_connection(pool, b'HTTP/1.1 200 OK\r\n')
+        with self.assertRaises(OSError):
+            pool.request('POST', 'http://sonos:1400/', {})
+        self.assertEqual(len(connects), 1)
+
+    def test_streamed_body(self):
+        """Joined values should be streamed out, giving the same request as
+        if they were joined first"""
+        pool = upnp.ConnectionPool(chunk_size=64)
+        values = ['<DIDL-Lite>%d &amp; co</DIDL-Lite>' % idx for idx in range(20)]
+        with testhelpers.FakeSonos(self.responses) as device:
+            upnp.send_command(
+                device.base_url + '/MediaRenderer/AVTransport/Control',
+                'AVTransport', 1, 'Play', [('InstanceID', 0), ('Values', upnp.Joined(' ', values))],
+                pool=pool
+            )
+            _, expected = upnp.build_command(
+                'AVTransport', 1, 'Play', [('InstanceID', 0), ('Values', ' '.join(values))]
+            )
+            self.assertEqual(device.requests[0][3], expected)
+        pool.close()
+
+    def test_failed_command(self):
+        """A non-200 response should raise, and not break the connection"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos(self.responses) as device:
+            with self.assertRaises(Exception):
+                self.send(device, pool, 'NotReal')
+            self.send(device, pool)
+            self.assertEqual(device.connections, 1)
+        pool.close()
+
+
+class DeadlineTests(unittest.TestCase):
+
+    responses = ConnectionPoolTests.responses
+
+    def send(self, device, pool, timeout):
+        return upnp.send_command(
+            device.base_url + '/MediaRenderer/AVTransport/Control',
+            'AVTransport', 1, 'Play', [('InstanceID', 0)], pool=pool, timeout=timeout
+        )
+
+    def test_timeout(self):
+        """A device that's too slow should raise Timeout by the deadline"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos(self.responses, latency=0.5) as device:
+            start = time.time()
+            with self.assertRaises(upnp.Timeout):
+                self.send(device, pool, 0.1)
+            self.assertLess(time.time() - start, 0.4)
+        pool.close()
+
+    def test_circuit_breaker(self):
+        """After repeated timeouts, commands should fail without waiting, and
+        be let through again after the cooldown"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos(self.responses, latency=0.3) as device:
+            for _ in range(upnp.DEFAULT_BREAKER_THRESHOLD):
+                with self.assertRaises(upnp.Timeout):
+                    self.send(device, pool, 0.05)
+            self.assertFalse(pool.is_available(device.base_url))
+            with self.assertRaises(upnp.CircuitOpen):
+                self.send(device, pool, 0.05)
+            self.assertEqual(len(device.requests), upnp.DEFAULT_BREAKER_THRESHOLD)
+
+            device.latency = 0
+            pool.breaker(device.ip, device.port).cooldown = 0
+            self.assertEqual(self.send(device, pool, 1), dict())
+            self.assertTrue(pool.is_available(device.base_url))
+        pool.close()
+
+    def test_probe(self):
+        """probe() should close the breaker of a device that's back"""
+        pool = upnp.ConnectionPool()
+        with testhelpers.FakeSonos(self.responses) as device:
+            breaker = pool.breaker(device.ip, device.port)
+            for _ in range(breaker.threshold):
+                breaker.failed()
+            self.assertEqual(pool.probe(), [])
+            breaker.cooldown = 0
+            self.assertEqual(pool.probe(), ['%s:%d' % (device.ip, device.port)])
+            self.assertTrue(pool.is_available(device.base_url))
+        pool.close()
+
+
 if __name__ == '__main__':
     unittest.main()
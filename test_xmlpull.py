@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import io
+import unittest
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import xmltok
+
+import bench
+import xmlpull
+
+
+class _ChunkedReader:
+    """Returns at most `size` characters per read, whatever is asked for."""
+
+    def __init__(self, value, size):
+        self._f = io.StringIO(value)
+        self._size = size
+
+    def read(self, size):
+        return self._f.read(min(size, self._size))
+
+
+class UnescapeTests(unittest.TestCase):
+
+    def test_entities(self):
+        """The predefined entities should be unescaped in one pass"""
+        self.assertEqual(xmlpull.unescape('&lt;a href=&quot;x&quot;&gt; &amp;lt;'), '<a href="x"> &lt;')
+
+    def test_double_escaped_apostrophe(self):
+        """Sonos's '&amp;apos;' should become an apostrophe"""
+        self.assertEqual(xmlpull.unescape('Kid&amp;apos;s Room'), 'Kid\'s Room')
+
+    def test_unknown_entity(self):
+        """Anything that isn't an entity we know should be left alone"""
+        self.assertEqual(xmlpull.unescape('a & b &nbsp; c'), 'a & b &nbsp; c')
+
+    def test_range(self):
+        """Only value[start:end] should be unescaped"""
+        self.assertEqual(xmlpull.unescape('xx&amp;yy', 2, 7), '&')
+
+
+class ParserTests(unittest.TestCase):
+
+    XML = (
+        '<ZoneGroups><ZoneGroup Coordinator="RINCON_1" ID="RINCON_1:0">'
+        '<ZoneGroupMember UUID="RINCON_1" ZoneName="Kid&amp;apos;s Room">'
+        '<Satellite UUID="RINCON_3"/>'
+        '</ZoneGroupMember>'
+        '<ZoneGroupMember UUID="RINCON_2" ZoneName="Kitchen"/>'
+        '</ZoneGroup></ZoneGroups>'
+    )
+
+    def test_find_attributes(self):
+        """find() should return the requested attributes, unescaped"""
+        parser = xmlpull.Parser(self.XML)
+        self.assertEqual(parser.find('ZoneGroup', ('Coordinator', 'Missing')), ('RINCON_1', None))
+        self.assertEqual(parser.find('ZoneGroupMember', ('ZoneName',)), ('Kid\'s Room',))
+        self.assertEqual(parser.find('ZoneGroupMember', ('ZoneName',)), ('Kitchen',))
+        self.assertIs(parser.find('ZoneGroupMember'), None)
+
+    def test_find_whole_name(self):
+        """find() shouldn't match a tag whose name merely starts the same"""
+        parser = xmlpull.Parser(self.XML)
+        self.assertEqual(parser.find('ZoneGroup', ('ID',)), ('RINCON_1:0',))
+
+    def test_bytes(self):
+        """bytes and bytearrays should give the same values as str"""
+        for xml in (self.XML.encode('utf-8'), bytearray(self.XML.encode('utf-8'))):
+            parser = xmlpull.Parser(xml)
+            parser.find('ZoneGroupMember')
+            self.assertEqual(parser.attribute('ZoneName'), 'Kid\'s Room')
+
+    def test_range(self):
+        """Nothing outside of xml[start:end] should be found"""
+        start = self.XML.index('<ZoneGroupMember UUID="RINCON_2"')
+        parser = xmlpull.Parser(self.XML, 0, start)
+        parser.find('ZoneGroupMember')
+        self.assertIs(parser.find('ZoneGroupMember'), None)
+
+    def test_skip(self):
+        """skip() should move past the current element, including anything
+        nested inside it"""
+        parser = xmlpull.Parser(self.XML)
+        parser.find('ZoneGroupMember')
+        parser.skip('ZoneGroupMember')
+        self.assertIs(parser.find('Satellite'), None)
+
+    def test_skip_nested_same_name(self):
+        """skip() should cope with elements nested inside others of the same
+        name"""
+        parser = xmlpull.Parser('<a><a>1</a><a/></a><b>2</b>')
+        parser.find('a')
+        parser.skip('a')
+        self.assertEqual(parser.texts(('b',)), ['2'])
+
+    def test_texts(self):
+        """texts() should return the text of each tag, in the order asked
+        for, and stop at `until`"""
+        xml = (
+            '<DIDL-Lite><item><dc:title>Fish &amp; Chips</dc:title><upnp:album/>'
+            '<dc:creator>Wilco</dc:creator></item>'
+            '<item><upnp:class>Other</upnp:class></item></DIDL-Lite>'
+        )
+        parser = xmlpull.Parser(xml)
+        self.assertEqual(
+            parser.texts(('dc:creator', 'upnp:album', 'dc:title', 'upnp:class'), until='item'),
+            ['Wilco', '', 'Fish & Chips', None]
+        )
+
+
+class ElementsTests(unittest.TestCase):
+
+    def test_chunk_splits(self):
+        """Every element should be found, however the document is split
+        between reads"""
+        xml = bench.topology_xml(5)
+        expected = xml.count('</ZoneGroup>')
+        for size in (1, 7, 11, 64, len(xml)):
+            found = [
+                xml[start:end]
+                for xml, start, end in xmlpull.elements(_ChunkedReader(xml, size), 'ZoneGroup')
+            ]
+            self.assertEqual(len(found), expected)
+            for element in found:
+                self.assertTrue(element.startswith('<ZoneGroup '))
+                self.assertTrue(element.endswith('</ZoneGroup>'))
+
+
+class ChildrenTests(unittest.TestCase):
+
+    RESPONSE = (
+        '<s:Envelope><s:Body><u:GetPositionInfoResponse>'
+        '<Track>1</Track><TrackMetaData>%s</TrackMetaData><RelCount/>'
+        '</u:GetPositionInfoResponse><u:Other>x</u:Other></s:Body></s:Envelope>'
+    )
+
+    def test_children(self):
+        """Large children should be collected whole, still escaped, and empty
+        ones left out"""
+        metadata = '&lt;item&gt;' * 500
+        xml = self.RESPONSE % metadata
+        for size in (5, 64, 512):
+            values = xmlpull.children(_ChunkedReader(xml, size), 'u:GetPositionInfoResponse')
+            self.assertEqual(values, {'Track': '1', 'TrackMetaData': metadata})
+
+    def test_missing_end_tag(self):
+        """A truncated response should raise ValueError"""
+        xml = (self.RESPONSE % '')[:60]
+        with self.assertRaises(ValueError):
+            xmlpull.children(io.StringIO(xml), 'u:GetPositionInfoResponse')
+
+
+@unittest.skipIf(tracemalloc is None, 'needs tracemalloc')
+class AllocationTests(unittest.TestCase):
+
+    def _peak(self, fn):
+        tracemalloc.start()
+        try:
+            fn()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_less_than_xmltok(self):
+        """Pulling the members out of a large topology should need less heap
+        than tokenizing it with xmltok"""
+        xml = bench.topology_xml(32)
+
+        def pull():
+            names = []
+            parser = xmlpull.Parser(xml)
+            while parser.find('ZoneGroupMember', ('ZoneName',)) is not None:
+                names.append(parser.attribute('ZoneName'))
+            return names
+
+        def tokenize():
+            names = []
+            tokens = xmltok.tokenize(io.StringIO(xml))
+            for token, value, *rest in tokens:
+                if token == xmltok.ATTR and value == ('', 'ZoneName'):
+                    names.append(rest[0])
+                elif token == xmltok.END_TAG and value == ('', 'ZoneGroups'):
+                    break
+            return names
+
+        self.assertEqual(pull(), tokenize())
+        self.assertLess(self._peak(pull), self._peak(tokenize))
+
+
+if __name__ == '__main__':
+    unittest.main()
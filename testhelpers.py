@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+import _thread
+import time
+
 
 class mock:
     """Poor man's unittest.mock.
@@ -21,3 +28,237 @@ class mock:
 
     def __exit__(self, *unused):
         setattr(self.owner, self.method_name, self.original)
+
+
+class FakeSonos:
+    """A fake Sonos device, which serves canned SOAP responses over HTTP on
+    localhost.
+
+    `responses` maps an action name to the list of (name, value) arguments to
+    put in its response. The values are used as-is, so should already be
+    escaped. It counts the TCP connections and requests it has seen, so that
+    tests can check how we're talking to it.
+
+    If `keep_alive` is False, the device drops the socket after every
+    response (without telling the client), like a real device does when it
+    gets bored of an idle connection. Each response is delayed by `latency`
+    seconds. GET requests are answered from `files`, keyed on path.
+    """
+
+    soap_response_template = (
+        '<?xml version="1.0"?>'
+        '<s:Envelope '
+            'xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+            's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+            '<s:Body>'
+                '<u:{action}Response xmlns:u="urn:schemas-upnp-org:service:serviceType:v">'
+                    '{args_xml}'
+                '</u:{action}Response>'
+            '</s:Body>'
+        '</s:Envelope>'
+    )
+
+    def __init__(self, responses=None, keep_alive=True, latency=0, files=None):
+        self.responses = responses or {}
+        self.files = files or {}
+        self.keep_alive = keep_alive
+        self.latency = latency
+        self.connections = 0
+        # List of (method, path, headers, body) tuples.
+        self.requests = []
+        # Keyed on SID, values are (path, callback URL).
+        self.subscriptions = {}
+        self._running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(socket.getaddrinfo('127.0.0.1', 0)[0][-1])
+        self.sock.listen(5)
+        self.sock.settimeout(0.1)
+        self.ip = '127.0.0.1'
+        self.port = self.sock.getsockname()[1]
+        self.base_url = 'http://%s:%d' % (self.ip, self.port)
+        _thread.start_new_thread(self._serve, ())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.stop()
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                continue
+            self.connections += 1
+            _thread.start_new_thread(self._handle, (conn,))
+
+    def _handle(self, conn):
+        conn.settimeout(5)
+        buffer = b''
+        try:
+            while self._running:
+                while b'\r\n\r\n' not in buffer:
+                    data = conn.recv(1024)
+                    if not data:
+                        return
+                    buffer += data
+                head, _, buffer = buffer.partition(b'\r\n\r\n')
+                lines = head.decode('utf-8').split('\r\n')
+                method, path, _ = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                while len(buffer) < length:
+                    buffer += conn.recv(1024)
+                body, buffer = buffer[:length], buffer[length:]
+                self.requests.append((method, path, headers, body))
+                time.sleep(self.latency)
+
+                status, response, *extra_headers = self.respond(method, path, headers, body)
+                head = 'HTTP/1.1 %d OK\r\nContent-Type: text/xml\r\n' % status
+                for name, value in (extra_headers[0] if extra_headers else {}).items():
+                    head += '%s: %s\r\n' % (name, value)
+                head += 'Content-Length: %d\r\n\r\n' % len(response)
+                conn.sendall(head.encode('utf-8') + response)
+                if not self.keep_alive:
+                    break
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def respond(self, method, path, headers, body):
+        """Returns (status, body) or (status, body, headers) for a request.
+        Override for anything other than canned SOAP responses or event
+        subscriptions."""
+        if method == 'SUBSCRIBE':
+            return self._subscribe(path, headers)
+        if method == 'UNSUBSCRIBE':
+            self.subscriptions.pop(headers['sid'], None)
+            return 200, b''
+        if method == 'GET':
+            if path not in self.files:
+                return 404, b''
+            return 200, self.files[path]
+        action = headers.get('soapaction', '').strip('"').rpartition('#')[2]
+        if action not in self.responses:
+            return 500, b'<s:Fault/>'
+        args_xml = ''.join(
+            '<{name}>{value}</{name}>'.format(name=name, value=value)
+            for name, value in self.responses[action]
+        )
+        return 200, self.soap_response_template.format(
+            action=action, args_xml=args_xml
+        ).encode('utf-8')
+
+    def _subscribe(self, path, headers):
+        if 'sid' in headers:
+            # Renewal.
+            if headers['sid'] not in self.subscriptions:
+                return 412, b''
+            sid = headers['sid']
+        else:
+            sid = 'uuid:RINCON_FAKE_sub%d' % len(self.subscriptions)
+            self.subscriptions[sid] = (path, headers['callback'].strip('<>'))
+        return 200, b'', {'SID': sid, 'TIMEOUT': headers['timeout']}
+
+    def notify(self, sid, variables):
+        """Sends a NOTIFY for subscription `sid`, with a dict of `variables`
+        (which should already be escaped). This happens in the background,
+        as the listener probably isn't listening yet."""
+        _, callback_url = self.subscriptions[sid]
+        body = (
+            '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">' +
+            ''.join(
+                '<e:property><{name}>{value}</{name}></e:property>'.format(
+                    name=name, value=value
+                )
+                for name, value in variables.items()
+            ) +
+            '</e:propertyset>'
+        ).encode('utf-8')
+        scheme_prefix = 'http://'
+        netloc, _, path = callback_url[len(scheme_prefix):].partition('/')
+        host, _, port = netloc.partition(':')
+        request = (
+            'NOTIFY /%s HTTP/1.1\r\nHOST: %s\r\nNT: upnp:event\r\n'
+            'NTS: upnp:propchange\r\nSID: %s\r\nSEQ: 0\r\n'
+            'Content-Length: %d\r\n\r\n' % (path, netloc, sid, len(body))
+        ).encode('utf-8') + body
+
+        def send():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect(socket.getaddrinfo(host, int(port))[0][-1])
+                sock.sendall(request)
+                sock.recv(1024)
+            finally:
+                sock.close()
+        _thread.start_new_thread(send, ())
+
+
+def ssdp_response(uuid, ip, max_age=1800, household='Sonos_fake'):
+    """Builds the SSDP response a ZonePlayer would send."""
+    return '\r\n'.join((
+        'HTTP/1.1 200 OK',
+        'CACHE-CONTROL: max-age = %d' % max_age,
+        'EXT:',
+        'LOCATION: http://%s:1400/xml/device_description.xml' % ip,
+        'SERVER: Linux UPnP/1.0 Sonos/34.7-33240-Wilco_Release (ZPS1)',
+        'ST: urn:schemas-upnp-org:device:ZonePlayer:1',
+        'USN: uuid:%s::urn:schemas-upnp-org:device:ZonePlayer:1' % uuid,
+        'X-RINCON-HOUSEHOLD: %s' % household,
+        '',
+        '',
+    )).encode('utf-8')
+
+
+class FakeSSDPResponder:
+    """Answers SSDP searches sent directly to it (rather than to the
+    multicast group) with canned responses, each sent `delay` seconds after
+    the last."""
+
+    def __init__(self, responses, delay=0):
+        self.responses = responses
+        self.delay = delay
+        self.searches = 0
+        self._running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(socket.getaddrinfo('127.0.0.1', 0)[0][-1])
+        self.sock.settimeout(0.1)
+        self.address = ('127.0.0.1', self.sock.getsockname()[1])
+        _thread.start_new_thread(self._serve, ())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.stop()
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                data, addr = self.sock.recvfrom(1024)
+            except OSError:
+                continue
+            if not data.startswith(b'M-SEARCH'):
+                continue
+            self.searches += 1
+            for response in self.responses:
+                time.sleep(self.delay)
+                try:
+                    self.sock.sendto(response, addr)
+                except OSError:
+                    return
@@ -1,24 +1,80 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import errno
 import io
+import time
 
-import xmltok
+import instrument
+import xmlpull
 
 try:
-    import urequests as requests
+    import usocket as socket
 except ImportError:
-    import requests
+    import socket
 
+try:
+    from time import ticks_ms, ticks_add, ticks_diff
+except ImportError:
+    # CPython. Unlike MicroPython's, these never wrap around.
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    # No threads (e.g. the ESP8266), so nothing to lock against.
+    class allocate_lock:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *unused):
+            pass
+
+
+# Sonos drops keep-alive sockets that have been idle for a while, so don't
+# bother trying to re-use anything older than this (in seconds).
+DEFAULT_IDLE_TIMEOUT = 10
+# Responses are read from the socket in chunks of (at most) this many bytes.
+DEFAULT_CHUNK_SIZE = 512
+# How long a command has to connect, send and receive (in seconds).
+DEFAULT_TIMEOUT = 5
+# After this many failures in a row, a device's circuit breaker opens, and
+# commands to it fail straight away for `DEFAULT_BREAKER_COOLDOWN` seconds.
+DEFAULT_BREAKER_THRESHOLD = 3
+DEFAULT_BREAKER_COOLDOWN = 30
 
-soap_action_template = 'urn:schemas-upnp-org:service:{service_type}:{version}#{action}'
+_socket_timeout = getattr(socket, 'timeout', ())
+
+
+class Timeout(OSError):
+    """Raised when a request isn't finished by its deadline."""
+
+
+class CircuitOpen(OSError):
+    """Raised instead of making a request to a device which has stopped
+    responding, while its circuit breaker is open."""
+
+
+def _is_timeout(e):
+    # CPython raises socket.timeout, MicroPython an OSError with ETIMEDOUT.
+    return isinstance(e, _socket_timeout) or (len(e.args) > 0 and e.args[0] == errno.ETIMEDOUT)
+
+
+service_urn_template = 'urn:schemas-upnp-org:service:{service_type}:{version}'
+soap_action_template = '{service_urn}#{action}'
 soap_body_template = (
     '<?xml version="1.0"?>'
     '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"'
     ' s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
         '<s:Body>'
-            '<u:{action} xmlns:u="urn:schemas-upnp-org:service:'
-                '{service_type}:{version}">'
+            '<u:{action} xmlns:u="{service_urn}">'
                 '{arguments}'
             '</u:{action}>'
         '</s:Body>'
@@ -26,70 +82,971 @@ soap_body_template = (
 )
 
 
-def _unescape(value):
-    # xmltok doesn't unescape any of the characters that are escaped inside the
-    # tokens. As Sonos regularly includes XML as text inside their UPnP responses,
-    # it's important we unescape it.
-    # Do the noddiest thing possible, as it seems to be enough.
-    return (value
-        .replace('&lt;', '<')
-        .replace('&gt;', '>')
-        .replace('&quot;', '"')
-        .replace('&amp;', '&')
-        .replace('&apos;', '\'')
-    )
+# Used all over the place, from before it moved to xmlpull.
+_unescape = xmlpull.unescape
+
+
+class _UnescapingReader:
+    """A file-like object which reads an escaped value, unescaping it as it
+    goes. This lets a document embedded in a response (like ZoneGroupState)
+    be parsed without making an unescaped copy of all of it first."""
+
+    def __init__(self, value):
+        self._value = value
+        self._pos = 0
+
+    def read(self, size=-1):
+        value = self._value
+        start = self._pos
+        if size < 0:
+            end = len(value)
+        else:
+            end = min(start + size, len(value))
+            # Don't split an entity across reads.
+            idx = value.rfind('&', max(start, end - len('&amp;apos;')), end)
+            if idx != -1:
+                entity_end = xmlpull.entity_end(value, idx)
+                if entity_end > end:
+                    end = entity_end
+        self._pos = end
+        return _unescape(value, start, end)
+
+
+class Arguments:
+    """The arguments of a SOAP response, as a read-only mapping of {name:
+    value}.
+
+    Values are kept as they came off the wire, and only unescaped the first
+    time they're looked at. Large values holding a document of their own can
+    instead be read with `stream()`, without unescaping them all at once.
+    """
+
+    def __init__(self, raw):
+        # Values we haven't unescaped yet.
+        self._raw = raw
+        self._values = dict()
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        value = self._values[name] = _unescape(self._raw.pop(name))
+        return value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in self._values or name in self._raw
+
+    def __len__(self):
+        return len(self._values) + len(self._raw)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(self._values) + list(self._raw)
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, Arguments):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Arguments(%r)' % dict(self.items())
+
+    def stream(self, name):
+        """Returns a file-like object from which the unescaped value of
+        `name` can be read."""
+        if name in self._values:
+            return io.StringIO(self._values[name])
+        return _UnescapingReader(self._raw[name])
 
 
 def parse_response(action, resp):
-    arguments = []
-    action_response_tag = ('u', action + 'Response')
-
-    # We want to look for a tag <u:{action}Response>, and produce a list of
-    # ({name}, {value}) tuples, for each <{name}>{value}</{name}> child element
-    # of it. Rather than use a proper parser, use the MicroPython XML tokenizer.
-    tokens = xmltok.tokenize(resp)
-    token = token_value = None
+    """Parses the SOAP response to `action` read from file-like `resp`,
+    returning its Arguments.
+
+    Only the <u:{action}Response> element is looked at, and nothing after
+    it is read.
+    """
     try:
-        while not (token == xmltok.START_TAG and token_value == action_response_tag):
-            token, token_value, *_ = next(tokens)
-
-        argument_name = None
-        while not (token == xmltok.END_TAG and token_value == action_response_tag):
-            token, token_value, *_ = next(tokens)
-            # This will produce some screwy results on dodgy input, but it's
-            # nice and simple.
-            if token == xmltok.START_TAG:
-                _, argument_name = token_value
-            elif token == xmltok.TEXT:
-                arguments.append((argument_name, _unescape(token_value)))
-                argument_name = None
-    except StopIteration:
+        return Arguments(xmlpull.children(resp, 'u:' + action + 'Response'))
+    except ValueError:
         raise Exception('Bad UPnP response')
 
-    return dict(arguments)
 
+def _split_url(url):
+    """Splits a http://host:port/path URL into (host, port, path)."""
+    # Like _zone_group_topology_location_to_ip(), don't pull in urllib.parse
+    # just for this.
+    scheme_prefix = 'http://'
+    assert url.startswith(scheme_prefix)
+    url = url[len(scheme_prefix):]
+    path_idx = url.find('/')
+    if path_idx == -1:
+        netloc, path = url, '/'
+    else:
+        netloc, path = url[:path_idx], url[path_idx:]
+    port_idx = netloc.find(':')
+    if port_idx == -1:
+        return netloc, 80, path
+    return netloc[:port_idx], int(netloc[port_idx + 1:]), path
 
-def send_command(url, service_type, version, action, arguments):
-    # NOTE: Does not deal with any escaping.
-    wrapped_arguments = ''.join(
-        '<{name}>{value}</{name}>'.format(name=name, value=value)
-        for name, value in arguments
-    )
-    soap = soap_body_template.format(
-        service_type=service_type, version=version, action=action,
-        arguments=wrapped_arguments
+
+def _encode_headers(headers):
+    """Encodes a dict of headers as 'Name: value' lines, each ending in
+    CRLF."""
+    return ''.join(
+        '%s: %s\r\n' % (name, value) for name, value in headers.items()
     ).encode('utf-8')
-    soap_action = soap_action_template.format(
-        service_type=service_type, version=version, action=action,
+
+
+def _request_head(method, path, host, port, headers, content_length):
+    """Returns the encoded request line and headers for a HTTP request.
+
+    `headers` is either a dict or headers already encoded by
+    `_encode_headers()`.
+    """
+    if not isinstance(headers, bytes):
+        headers = _encode_headers(headers)
+    return b''.join((
+        ('%s %s HTTP/1.1\r\nHost: %s:%d\r\n' % (method, path, host, port)).encode('utf-8'),
+        headers,
+        ('Content-Length: %d\r\n\r\n' % content_length).encode('utf-8'),
+    ))
+
+
+def _parse_header(line):
+    """Parses a 'Name: value' header line (as bytes), returning (name,
+    value) with the name lower-cased."""
+    name, _, value = str(line, 'utf-8').partition(':')
+    return name.strip().lower(), value.strip()
+
+
+def _header_name_is(buf, start, end, name):
+    """Checks whether buf[start:end] is the (lower-case) header `name`,
+    ignoring case, without copying anything out of `buf`."""
+    if end - start != len(name):
+        return False
+    for i in range(len(name)):
+        # Lower-cases letters, and leaves '-' alone.
+        if buf[start + i] | 0x20 != name[i]:
+            return False
+    return True
+
+
+def _parse_int(buf, start, end):
+    """Parses the decimal number at buf[start:end], skipping any leading
+    spaces and stopping at the first non-digit."""
+    while start < end and buf[start] == 0x20:
+        start += 1
+    value = 0
+    while start < end and 0x30 <= buf[start] <= 0x39:
+        value = value * 10 + buf[start] - 0x30
+        start += 1
+    return value
+
+
+class _Connection:
+    """A single HTTP/1.1 connection to a device, which may be kept alive
+    between requests.
+
+    This is deliberately minimal: it only does what we need to talk to Sonos
+    devices, which always give us a Content-Length.
+
+    To avoid fragmenting the heap, everything is received into one
+    `bytearray` of `buffer_size` bytes which lives as long as the connection,
+    and requests are gathered into another before being sent. The status and
+    the headers we care about are parsed straight out of the receive buffer.
+
+    If `deadline` (in `ticks_ms()`) is set, socket operations raise Timeout
+    rather than carry on past it.
+    """
+
+    def __init__(self, host, port, buffer_size=DEFAULT_CHUNK_SIZE):
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.last_used = 0
+        # Number of requests sent over the current socket.
+        self.requests = 0
+        # Bytes received since the last request was sent.
+        self.received = 0
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        # Unread data is self._buf[self._start:self._end].
+        self._start = self._end = 0
+        self._out = bytearray(buffer_size)
+        self._out_view = memoryview(self._out)
+        self._out_len = 0
+        self.deadline = None
+        # Whether the socket has a timeout set.
+        self._timed = False
+
+    def connect(self):
+        addr = socket.getaddrinfo(self.host, self.port)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._timed = False
+        self._set_timeout()
+        try:
+            self.sock.connect(addr)
+        except OSError as e:
+            if _is_timeout(e):
+                raise Timeout('Timed out connecting to %s' % self.host)
+            raise
+        self._attach()
+
+    def _set_timeout(self):
+        """Sets the socket's timeout to whatever is left before `deadline`."""
+        if self.deadline is None:
+            if self._timed:
+                self.sock.settimeout(None)
+                self._timed = False
+            return
+        remaining = ticks_diff(self.deadline, ticks_ms())
+        if remaining <= 0:
+            raise Timeout('Deadline exceeded talking to %s' % self.host)
+        self.sock.settimeout(remaining / 1000)
+        self._timed = True
+
+    def _recv_into(self, view):
+        self._set_timeout()
+        try:
+            return self._readinto(view)
+        except OSError as e:
+            if _is_timeout(e):
+                raise Timeout('Timed out waiting for %s' % self.host)
+            raise
+
+    def _send(self, data):
+        self._set_timeout()
+        try:
+            self._sendall(data)
+        except OSError as e:
+            if _is_timeout(e):
+                raise Timeout('Timed out sending to %s' % self.host)
+            raise
+
+    def _attach(self):
+        # MicroPython sockets are streams, CPython's aren't.
+        self._readinto = getattr(self.sock, 'recv_into', None) or self.sock.readinto
+        self._sendall = getattr(self.sock, 'sendall', None) or self.sock.write
+        self.requests = 0
+        self.received = 0
+        self._start = self._end = self._out_len = 0
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _fill(self):
+        """Reads more from the socket into the receive buffer, after anything
+        that's already there."""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            # Move what's left to the front, to make room.
+            unread = self._end - self._start
+            if unread == len(self._buf):
+                raise ValueError('Header too long')
+            self._buf[:unread] = self._view[self._start:self._end]
+            self._start, self._end = 0, unread
+        read = self._recv_into(self._view[self._end:])
+        if not read:
+            raise OSError('Connection closed by device')
+        self._end += read
+        self.received += read
+
+    def _next_line(self):
+        """Returns the (start, end) of the next line in the receive buffer,
+        without the line ending."""
+        while True:
+            idx = self._buf.find(b'\n', self._start, self._end)
+            if idx != -1:
+                break
+            self._fill()
+        start = self._start
+        self._start = idx + 1
+        if idx > start and self._buf[idx - 1] == 0x0D:
+            idx -= 1
+        return start, idx
+
+    def recv_body(self, size):
+        """Reads up to `size` bytes of the response body. The result is a
+        memoryview into the receive buffer, which is only valid until the
+        next read. It is empty only if the device has closed the socket."""
+        if self._start == self._end:
+            self._start = self._end = 0
+            read = self._recv_into(self._view[:min(size, len(self._buf))]) or 0
+            self.received += read
+            return self._view[:read]
+        end = min(self._end, self._start + size)
+        data = self._view[self._start:end]
+        self._start = end
+        return data
+
+    def write(self, data):
+        """Queues `data` to be sent, sending anything already queued first if
+        there isn't room."""
+        if self._out_len + len(data) > len(self._out):
+            self.flush()
+            if len(data) > len(self._out):
+                self._send(data)
+                return
+        self._out[self._out_len:self._out_len + len(data)] = data
+        self._out_len += len(data)
+
+    def flush(self):
+        if self._out_len:
+            self._send(self._out_view[:self._out_len])
+            self._out_len = 0
+
+    def send_request(self, method, path, headers, body):
+        self.received = 0
+        self.write(_request_head(method, path, self.host, self.port, headers, len(body)))
+        if isinstance(body, _StreamedBody):
+            body.write_to(self)
+        else:
+            self.write(body)
+        self.flush()
+        self.requests += 1
+
+    def read_head(self):
+        """Reads the start line and headers of a request or response,
+        returning (start_line, headers). Headers are keyed on their
+        lower-cased name."""
+        start, end = self._next_line()
+        start_line = str(self._view[start:end], 'utf-8').strip()
+        headers = {}
+        while True:
+            start, end = self._next_line()
+            if start == end:
+                break
+            name, value = _parse_header(self._view[start:end])
+            headers[name] = value
+        return start_line, headers
+
+    def read_response_head(self, want_headers=False):
+        """Reads the status line and headers of a response, returning
+        (status, content_length, close, headers).
+
+        Only Content-Length and Connection are looked at, without copying
+        them out of the receive buffer. `headers` is None unless
+        `want_headers` is True, in which case it's a dict of every header.
+        """
+        buf = self._buf
+        start, end = self._next_line()
+        # HTTP/1.1 200 OK
+        status = _parse_int(buf, buf.find(b' ', start, end) + 1, end)
+        content_length = None
+        close = False
+        headers = {} if want_headers else None
+        while True:
+            start, end = self._next_line()
+            if start == end:
+                break
+            colon = buf.find(b':', start, end)
+            if colon == -1:
+                continue
+            if _header_name_is(buf, start, colon, b'content-length'):
+                content_length = _parse_int(buf, colon + 1, end)
+            elif _header_name_is(buf, start, colon, b'connection'):
+                idx = colon + 1
+                while idx < end and buf[idx] == 0x20:
+                    idx += 1
+                close = _header_name_is(buf, idx, end, b'close')
+            if headers is not None:
+                name, value = _parse_header(self._view[start:end])
+                headers[name] = value
+        return status, content_length, close, headers
+
+
+def _complete_utf8(data):
+    """Returns the length of the longest prefix of `data` which doesn't end
+    part-way through a multi-byte UTF-8 character."""
+    end = len(data)
+    for i in range(1, min(4, end) + 1):
+        byte = data[end - i]
+        if byte & 0xC0 != 0x80:
+            # Not a continuation byte, so this starts the last character.
+            if byte >= 0xF0:
+                length = 4
+            elif byte >= 0xE0:
+                length = 3
+            elif byte >= 0xC0:
+                length = 2
+            else:
+                length = 1
+            return end if length <= i else end - i
+    return end
+
+
+class _Response:
+    """The response to a request made through a ConnectionPool, with a body
+    that is read from the socket as it is needed.
+
+    `read()` decodes the body as UTF-8 and returns unicode strings, so that
+    it can be passed directly to a parser. At most `chunk_size`
+    bytes are read from the socket at once, straight into the connection's
+    receive buffer.
+
+    The response must be `close()`d, so that the connection can go back to
+    the pool (if it came from one).
+    """
+
+    def __init__(self, pool, conn, status, content_length, close, chunk_size,
+                 headers=None, timer=None):
+        self.status = status
+        self.headers = headers
+        self._pool = pool
+        self._conn = conn
+        self._chunk_size = chunk_size
+        self._close = close
+        # If there's an instrument.Timer, how long we've spent waiting for
+        # the body, and how much of it we've had.
+        self._timer = timer
+        self.body_us = 0
+        self.body_bytes = 0
+        # If None, the device will close the socket when it's done.
+        self._remaining = content_length
+        # The start of a character split across chunks.
+        self._partial = b''
+        self._text = ''
+        self._pos = 0
+
+    def _recv_chunk(self):
+        size = self._chunk_size
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+            if not size:
+                return b''
+        if self._timer is None:
+            data = self._conn.recv_body(size)
+        else:
+            start = instrument.ticks_us()
+            data = self._conn.recv_body(size)
+            self.body_us += instrument.ticks_diff(instrument.ticks_us(), start)
+            self.body_bytes += len(data)
+        if self._remaining is not None:
+            if not data:
+                raise OSError('Connection closed by device')
+            self._remaining -= len(data)
+        return data
+
+    def read_bytes(self):
+        """Reads the rest of the body as bytes."""
+        data = self._partial + self._text[self._pos:].encode('utf-8')
+        self._partial = b''
+        self._text = ''
+        self._pos = 0
+        while True:
+            chunk = self._recv_chunk()
+            if not chunk:
+                return data
+            data += bytes(chunk)
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.read_bytes().decode('utf-8')
+        if self._pos >= len(self._text):
+            self._text = ''
+            self._pos = 0
+            while not self._text:
+                data = self._recv_chunk()
+                if not data:
+                    # Anything left over is not valid UTF-8, so let decode()
+                    # complain about it.
+                    return self._partial.decode('utf-8')
+                if self._partial:
+                    data = self._partial + bytes(data)
+                end = _complete_utf8(data)
+                self._text = str(data[:end], 'utf-8')
+                self._partial = bytes(data[end:])
+        text = self._text[self._pos:self._pos + size]
+        self._pos += len(text)
+        return text
+
+    def close(self):
+        """Finishes with the response, returning the connection to the pool.
+
+        If only a little of the body is left unread, it is read and thrown
+        away so that the connection can be re-used. Otherwise it's cheaper to
+        just drop the connection.
+        """
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        try:
+            if self._remaining is None or self._remaining > self._chunk_size:
+                conn.close()
+            else:
+                while self._remaining:
+                    data = conn.recv_body(self._remaining)
+                    if not data:
+                        conn.close()
+                        break
+                    self._remaining -= len(data)
+                if self._close:
+                    conn.close()
+        except OSError:
+            conn.close()
+        conn.last_used = time.time()
+        if self._pool is not None:
+            self._pool._release(conn)
+
+
+class CircuitBreaker:
+    """Stops us waiting on a device which has stopped responding.
+
+    After `threshold` failures in a row, the breaker opens and `allow()`
+    says no until `cooldown` seconds have passed. Then one request is
+    allowed through as a probe: if it succeeds the breaker closes, and if
+    not it stays open for another `cooldown`.
+    """
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        # When the breaker opened (in ticks_ms()), or None if it's closed.
+        self.opened_at = None
+        self._probing = False
+
+    def __repr__(self):
+        return '<CircuitBreaker failures=%d open=%s>' % (self.failures, self.is_open())
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def probe_due(self, now=None):
+        """Checks whether the breaker is open, and it's time to try again."""
+        if self.opened_at is None or self._probing:
+            return False
+        if now is None:
+            now = ticks_ms()
+        return ticks_diff(now, self.opened_at) >= self.cooldown * 1000
+
+    def allow(self):
+        """Checks whether a request should be made. If the breaker is open
+        and it's time to try again, only the first caller is allowed
+        through."""
+        if self.opened_at is None:
+            return True
+        if not self.probe_due():
+            return False
+        self._probing = True
+        return True
+
+    def succeeded(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def released(self):
+        """Gives up a probe which neither succeeded nor failed (e.g. because
+        it was cancelled), so that the next caller can probe instead."""
+        self._probing = False
+
+    def failed(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.threshold:
+            self.opened_at = ticks_ms()
+
+
+class ConnectionPool:
+    """Keeps HTTP/1.1 keep-alive connections open to each device, so that
+    repeated commands don't need a new TCP handshake each time.
+
+    Connections are keyed on the 'host:port' of the device (i.e. the host of
+    `Sonos._base_url`), and any that have been idle for longer than
+    `idle_timeout` seconds are thrown away rather than re-used.
+
+    Each device has a CircuitBreaker, so that once it has stopped
+    responding, requests to it fail straight away with CircuitOpen rather
+    than each waiting for their deadline. `probe()` can be called now and
+    again (e.g. from a background thread or the main loop) to find out when
+    it's back, without waiting for the next request to it.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self._idle = {}
+        # CircuitBreaker for each 'host:port'.
+        self.breakers = {}
+        # Requests may be made from several threads at once (e.g. by
+        # sonos.broadcast()).
+        self._lock = allocate_lock()
+
+    def _acquire(self, host, port):
+        key = '%s:%d' % (host, port)
+        now = time.time()
+        while True:
+            with self._lock:
+                connections = self._idle.get(key)
+                if not connections:
+                    return _Connection(host, port, self.chunk_size)
+                conn = connections.pop()
+            if now - conn.last_used < self.idle_timeout:
+                return conn
+            conn.close()
+
+    def _release(self, conn):
+        if conn.sock is None:
+            return
+        key = '%s:%d' % (conn.host, conn.port)
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def evict_idle(self):
+        """Closes any connections that have been idle for too long."""
+        now = time.time()
+        with self._lock:
+            for key, connections in list(self._idle.items()):
+                for conn in connections:
+                    if now - conn.last_used >= self.idle_timeout:
+                        conn.close()
+                connections = [conn for conn in connections if conn.sock is not None]
+                if connections:
+                    self._idle[key] = connections
+                else:
+                    del self._idle[key]
+
+    def breaker(self, host, port):
+        """Returns the CircuitBreaker for a device."""
+        key = '%s:%d' % (host, port)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker()
+        return breaker
+
+    def is_available(self, url):
+        """Checks whether requests to the device at `url` are being made,
+        rather than failing because its circuit breaker is open."""
+        host, port, _ = _split_url(url)
+        breaker = self.breakers.get('%s:%d' % (host, port))
+        return breaker is None or not breaker.is_open()
+
+    def probe(self, timeout=DEFAULT_TIMEOUT):
+        """Tries to connect to each device whose circuit breaker is open and
+        due to be tried again, closing the breaker if it can. Returns the
+        'host:port' of each device that is back."""
+        back = []
+        for key, breaker in list(self.breakers.items()):
+            if not breaker.allow():
+                continue
+            host, port = key.rsplit(':', 1)
+            conn = _Connection(host, int(port), 0)
+            conn.deadline = ticks_add(ticks_ms(), int(timeout * 1000))
+            try:
+                conn.connect()
+            except OSError:
+                breaker.failed()
+                continue
+            finally:
+                conn.close()
+            breaker.succeeded()
+            back.append(key)
+        return back
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+            self._idle = {}
+
+    def stream(self, method, url, headers, body=b'', want_headers=False, timer=None,
+               deadline=None):
+        """Makes a request, re-using an idle connection if there is one.
+
+        Returns a _Response as soon as the headers have been read. The body
+        is read as it is consumed, and the response must be closed when
+        done with. The response's `headers` are only collected if
+        `want_headers` is True.
+
+        If a `deadline` (in `ticks_ms()`) is given, Timeout is raised if
+        the request (including reading the body) isn't done by then.
+
+        If an `instrument.Timer` is given, the connect, send and first_byte
+        phases are recorded with it.
+        """
+        host, port, path = _split_url(url)
+        breaker = self.breaker(host, port)
+        if not breaker.allow():
+            raise CircuitOpen('%s:%d is not responding' % (host, port))
+        conn = self._acquire(host, port)
+        conn.deadline = deadline
+        try:
+            if conn.sock is None:
+                self._connect(conn, timer)
+                head = self._request(conn, method, path, headers, body, want_headers, timer)
+            else:
+                try:
+                    head = self._request(conn, method, path, headers, body, want_headers, timer)
+                except Timeout:
+                    raise
+                except OSError:
+                    if conn.received:
+                        # It got far enough to answer, so it may have acted
+                        # on the request. Sending it again could (e.g.) skip
+                        # two tracks rather than one.
+                        raise
+                    # The device dropped the socket since we last used it,
+                    # before seeing the request. Try again (once) on a fresh
+                    # connection.
+                    conn.close()
+                    self._connect(conn, timer)
+                    head = self._request(conn, method, path, headers, body, want_headers, timer)
+        except OSError:
+            conn.close()
+            breaker.failed()
+            raise
+        except Exception:
+            # The device is there, even if we didn't like what it said.
+            conn.close()
+            breaker.succeeded()
+            raise
+        breaker.succeeded()
+        status, content_length, close, resp_headers = head
+        return _Response(
+            self, conn, status, content_length, close, self.chunk_size,
+            resp_headers, timer
+        )
+
+    def request(self, method, url, headers, body=b'', deadline=None):
+        """Makes a request and reads the whole response. Returns (status,
+        headers, body)."""
+        resp = self.stream(method, url, headers, body, want_headers=True, deadline=deadline)
+        try:
+            return resp.status, resp.headers, resp.read_bytes()
+        finally:
+            resp.close()
+
+    def _connect(self, conn, timer):
+        conn.connect()
+        if timer is not None:
+            timer.lap('connect')
+
+    def _request(self, conn, method, path, headers, body, want_headers, timer=None):
+        conn.send_request(method, path, headers, body)
+        if timer is not None:
+            timer.lap('send', len(body))
+        head = conn.read_response_head(want_headers)
+        if timer is not None:
+            timer.lap('first_byte')
+        return head
+
+
+# Shared by all devices, unless a different pool is passed to send_command().
+connection_pool = ConnectionPool()
+
+
+def _escape(value):
+    """Escapes an argument value for use as XML text."""
+    if not isinstance(value, str):
+        value = str(value)
+    return (value
+        .replace('&', '&amp;')
+        .replace('<', '&lt;')
+        .replace('>', '&gt;')
+        .replace('"', '&quot;')
+        .replace("'", '&apos;')
     )
-    headers = {
-        'Content-Type': 'text/xml; charset="utf-8"',
-        'SOAPACTION': soap_action,
-    }
-
-    resp = requests.post(url, headers=headers, data=soap)
-    if resp.status_code == 200:
-        # Need a file-like object to unicode string.
-        return parse_response(action, io.StringIO(resp.text))
-    else:
-        raise Exception('UPnP command failed: %s' % resp.content.decode('utf-8'))
+
+
+def service_urn(service_type, version):
+    """Returns the URN of a service, e.g. 'AVTransport', 1 gives
+    'urn:schemas-upnp-org:service:AVTransport:1'. Services which aren't in
+    the UPnP namespace (like Sonos' Queue) can be given by their full URN,
+    in which case `version` is ignored."""
+    if service_type.startswith('urn:'):
+        return service_type
+    return service_urn_template.format(service_type=service_type, version=version)
+
+
+class Joined:
+    """An argument value made of `values` (a list) joined by `separator`.
+
+    It's escaped and sent a value at a time, rather than being built as one
+    big string, so that an argument like AddMultipleURIsToQueue's
+    EnqueuedURIsMetaData needs no more memory than its values already do.
+    """
+
+    __slots__ = ('separator', 'values')
+
+    def __init__(self, separator, values):
+        self.separator = separator
+        self.values = values
+
+    def pieces(self):
+        """Yields the escaped value, a piece at a time, as bytes."""
+        separator = _escape(self.separator).encode('utf-8')
+        for idx, value in enumerate(self.values):
+            if idx:
+                yield separator
+            yield _escape(value).encode('utf-8')
+
+
+class _StreamedBody:
+    """A request body made of `parts` (bytes or Joined), which is written
+    straight to the connection rather than joined together first."""
+
+    def __init__(self, parts):
+        self._parts = parts
+        # The Content-Length has to be sent first, so this means escaping
+        # everything twice. That's cheaper than holding it all in memory.
+        self._length = 0
+        for piece in self._pieces():
+            self._length += len(piece)
+
+    def __len__(self):
+        return self._length
+
+    def _pieces(self):
+        for part in self._parts:
+            if isinstance(part, Joined):
+                for piece in part.pieces():
+                    yield piece
+            else:
+                yield part
+
+    def write_to(self, conn):
+        for piece in self._pieces():
+            conn.write(piece)
+
+
+# How many different sets of arguments each _Action keeps the body for.
+ACTION_BODY_CACHE_SIZE = 4
+
+
+class _Action:
+    """A SOAP action compiled down to bytes, so that sending it again only
+    needs its argument values encoding.
+
+    The envelope is rendered once, and kept as the bytes before and after
+    the arguments. Bodies for the last few sets of arguments are also kept,
+    so that commands which are always sent with the same arguments (like
+    Play) are just cached bytes.
+    """
+
+    def __init__(self, service_type, version, action):
+        urn = service_urn(service_type, version)
+        envelope = soap_body_template.format(
+            service_urn=urn, action=action, arguments='\0'
+        ).encode('utf-8')
+        self.prefix, self.suffix = envelope.split(b'\0')
+        self.headers = _encode_headers({
+            'Content-Type': 'text/xml; charset="utf-8"',
+            'SOAPACTION': soap_action_template.format(
+                service_urn=urn, action=action
+            ),
+        })
+        self._bodies = {}
+
+    def body(self, arguments):
+        """Returns the encoded body for `arguments`, a list of (name, value)
+        pairs. If any of the values are Joined, the body is streamed out
+        rather than built."""
+        for _, value in arguments:
+            if isinstance(value, Joined):
+                return self._streamed_body(arguments)
+        try:
+            # 1, 1.0 and True are equal, but are rendered differently, so
+            # the types have to be part of the key.
+            key = tuple((name, type(value), value) for name, value in arguments)
+            body = self._bodies.get(key)
+        except TypeError:
+            # Unhashable values, so just don't cache this one.
+            key = body = None
+        if body is None:
+            parts = [self.prefix]
+            for name, value in arguments:
+                parts.append(('<%s>%s</%s>' % (name, _escape(value), name)).encode('utf-8'))
+            parts.append(self.suffix)
+            body = b''.join(parts)
+            if key is not None:
+                if len(self._bodies) >= ACTION_BODY_CACHE_SIZE:
+                    self._bodies = {}
+                self._bodies[key] = body
+        return body
+
+    def _streamed_body(self, arguments):
+        parts = [self.prefix]
+        for name, value in arguments:
+            if isinstance(value, Joined):
+                parts.append(('<%s>' % name).encode('utf-8'))
+                parts.append(value)
+                parts.append(('</%s>' % name).encode('utf-8'))
+            else:
+                parts.append(('<%s>%s</%s>' % (name, _escape(value), name)).encode('utf-8'))
+        parts.append(self.suffix)
+        return _StreamedBody(parts)
+
+
+_actions = {}
+
+
+def compile_action(service_type, version, action):
+    """Returns the _Action for a SOAP action, compiling it the first time."""
+    key = (service_type, version, action)
+    compiled = _actions.get(key)
+    if compiled is None:
+        compiled = _actions[key] = _Action(service_type, version, action)
+    return compiled
+
+
+def build_command(service_type, version, action, arguments):
+    """Returns the (headers, body) of the request for a SOAP action. The
+    headers are already encoded, ready to be passed to `_request_head()`."""
+    compiled = compile_action(service_type, version, action)
+    return compiled.headers, compiled.body(arguments)
+
+
+def send_command(url, service_type, version, action, arguments, pool=None,
+                 timeout=DEFAULT_TIMEOUT):
+    """Calls a SOAP action, returning the response's Arguments.
+
+    Raises Timeout if it takes longer than `timeout` seconds altogether, or
+    CircuitOpen straight away if the device has stopped responding.
+    """
+    deadline = ticks_add(ticks_ms(), int(timeout * 1000))
+    timer = instrument.timer('send_command', action)
+    headers, soap = build_command(service_type, version, action, arguments)
+    if timer is not None:
+        timer.lap('build', len(soap))
+    if pool is None:
+        pool = connection_pool
+    resp = pool.stream('POST', url, headers, soap, timer=timer, deadline=deadline)
+    try:
+        if resp.status == 200:
+            # The response is parsed as it is read from the socket, and we
+            # stop reading as soon as we've seen </u:{action}Response>.
+            arguments = parse_response(action, resp)
+            if timer is not None:
+                # Waiting for the body isn't parsing.
+                timer.add('body', resp.body_us, resp.body_bytes)
+                timer.lap('parse')
+            return arguments
+        else:
+            raise Exception('UPnP command failed: %s' % resp.read())
+    finally:
+        resp.close()
+        if timer is not None:
+            timer.done(resp.body_bytes)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""A small XML pull parser for the handful of documents we get from Sonos.
+
+Rather than tokenize everything (as xmltok does, a character at a time),
+this jumps straight to the elements we ask for with `find()`, and only
+copies out the attributes and text that we want. Everything else is
+skipped without being looked at, let alone turned into strings.
+
+It understands just enough XML for UPnP: no comments, CDATA or DTDs, and
+attribute values must be in double quotes. Documents can be `str`, `bytes`
+or `bytearray` (such as a receive buffer), and are never copied. Values
+taken from bytes are decoded as UTF-8.
+"""
+
+
+ENTITIES = {'lt': '<', 'gt': '>', 'quot': '"', 'amp': '&', 'apos': '\''}
+
+# How much of a stream to read at a time.
+DEFAULT_READ_SIZE = 512
+
+# Characters which can follow a tag name.
+_TERMINATORS = (' ', '>', '/', '\t', '\r', '\n')
+_BYTES_TERMINATORS = tuple(c.encode('utf-8') for c in _TERMINATORS)
+
+
+def entity_end(value, start):
+    """Returns the index just past the entity starting at `start` in `value`,
+    or -1 if there isn't one we understand there."""
+    # The longest entity we understand is '&quot;'.
+    end = value.find(';', start, start + 6)
+    if end == -1 or value[start + 1:end] not in ENTITIES:
+        return -1
+    # See unescape().
+    if value[start + 1:end] == 'amp' and value.startswith('apos;', end + 1):
+        return end + 6
+    return end + 1
+
+
+def unescape(value, start=0, end=None):
+    """Unescapes value[start:end] in a single pass.
+
+    Only the five predefined entities are understood, as that seems to be
+    enough for Sonos, which regularly includes XML as text inside its UPnP
+    responses.
+
+    Sonos double-escapes apostrophes in names embedded in XML inside XML,
+    so '&amp;apos;' is unescaped all the way to "'".
+    """
+    if end is None:
+        end = len(value)
+    idx = value.find('&', start, end)
+    if idx == -1:
+        return value if start == 0 and end == len(value) else value[start:end]
+    parts = []
+    while idx != -1:
+        parts.append(value[start:idx])
+        end_idx = entity_end(value, idx)
+        if end_idx != -1 and end_idx <= end:
+            name = value[idx + 1:value.find(';', idx)]
+            if end_idx - idx > len(name) + 2:
+                # '&amp;apos;'
+                parts.append('\'')
+            else:
+                parts.append(ENTITIES[name])
+            start = end_idx
+        else:
+            # Not something we understand, so leave it be.
+            parts.append('&')
+            start = idx + 1
+        idx = value.find('&', start, end)
+    parts.append(value[start:end])
+    return ''.join(parts)
+
+
+class Parser:
+    """Pulls elements out of xml[start:end].
+
+    The parser has a position, which `find()` moves forward past each start
+    tag it finds. e.g. for a <ZoneGroup>:
+
+        parser = Parser(xml, start, end)
+        coordinator, = parser.find('ZoneGroup', ('Coordinator',))
+        while parser.find('ZoneGroupMember', ('UUID',)) is not None:
+            ...
+    """
+
+    def __init__(self, xml, start=0, end=None):
+        self.xml = xml
+        self.pos = start
+        self.end = len(xml) if end is None else end
+        self._bytes = not isinstance(xml, str)
+        self._terminators = _BYTES_TERMINATORS if self._bytes else _TERMINATORS
+        self._lt = self._native('<')
+        self._gt = self._native('>')
+        self._slash = self._native('/')
+        self._quote = self._native('"')
+        # The current tag, as found by find(): xml[tag_start:tag_end] is
+        # everything between '<' and '>'.
+        self.tag_start = self.tag_end = start
+
+    def _native(self, text):
+        return text.encode('utf-8') if self._bytes else text
+
+    def _value(self, start, end):
+        value = self.xml[start:end]
+        if self._bytes:
+            value = str(value, 'utf-8')
+        return unescape(value)
+
+    def _is_tag(self, idx, name):
+        """Checks whether there's a tag called `name` (a native string,
+        including any '/') at xml[idx], just after the '<'."""
+        xml = self.xml
+        if not xml.startswith(name, idx):
+            return False
+        after = idx + len(name)
+        if after >= self.end:
+            return False
+        # The name must end there, not just start there.
+        return xml[after:after + 1] in self._terminators
+
+    def find(self, tag, attributes=()):
+        """Moves to just past the next <tag> start tag before `end`.
+
+        Returns a tuple of the (unescaped) values of `attributes`, with None
+        for any that are missing. Returns None if there is no <tag>.
+        """
+        name = self._native(tag)
+        xml = self.xml
+        lt = self._lt
+        idx = xml.find(lt, self.pos, self.end)
+        while idx != -1:
+            if self._is_tag(idx + 1, name):
+                tag_end = xml.find(self._gt, idx, self.end)
+                if tag_end == -1:
+                    return None
+                self.tag_start = idx + 1
+                self.tag_end = tag_end
+                self.pos = tag_end + 1
+                return tuple(self.attribute(attribute) for attribute in attributes)
+            idx = xml.find(lt, idx + 1, self.end)
+        self.pos = self.end
+        return None
+
+    def attribute(self, name):
+        """Returns the (unescaped) value of attribute `name` of the current
+        tag, or None if it doesn't have one."""
+        needle = self._native(' ' + name + '="')
+        idx = self.xml.find(needle, self.tag_start, self.tag_end)
+        if idx == -1:
+            return None
+        idx += len(needle)
+        return self._value(idx, self.xml.find(self._quote, idx, self.tag_end))
+
+    def is_empty(self):
+        """Checks whether the current tag is self-closing."""
+        return self.xml[self.tag_end - 1:self.tag_end] == self._slash
+
+    def text(self):
+        """Returns the (unescaped) text of the current element, which must
+        only contain text, and moves to its end tag."""
+        if self.is_empty():
+            return ''
+        xml = self.xml
+        end = xml.find(self._lt, self.pos, self.end)
+        if end == -1:
+            end = self.end
+        value = self._value(self.pos, end)
+        self.pos = end
+        return value
+
+    def skip(self, tag):
+        """Moves past the end of the current element, <tag>, without looking
+        at anything inside it."""
+        if self.is_empty():
+            return
+        name = self._native('/' + tag)
+        depth = 1
+        xml = self.xml
+        lt = self._lt
+        open_name = self._native(tag)
+        idx = xml.find(lt, self.pos, self.end)
+        while idx != -1:
+            if self._is_tag(idx + 1, name):
+                depth -= 1
+                if depth == 0:
+                    self.pos = xml.find(self._gt, idx, self.end) + 1
+                    return
+            elif self._is_tag(idx + 1, open_name):
+                tag_end = xml.find(self._gt, idx, self.end)
+                if xml[tag_end - 1:tag_end] != self._slash:
+                    depth += 1
+            idx = xml.find(lt, idx + 1, self.end)
+        self.pos = self.end
+
+    def texts(self, tags, until=None):
+        """Returns a list of the text of the first element for each of
+        `tags`, in the same order, with None for any not found.
+
+        Stops as soon as all have been found, or at the end tag `until` if
+        given, rather than looking at the rest of the document.
+        """
+        values = [None] * len(tags)
+        remaining = len(tags)
+        names = [self._native(tag) for tag in tags]
+        until = None if until is None else self._native('/' + until)
+        xml = self.xml
+        lt = self._lt
+        idx = xml.find(lt, self.pos, self.end)
+        while remaining and idx != -1:
+            if until is not None and self._is_tag(idx + 1, until):
+                break
+            for i, name in enumerate(names):
+                if values[i] is None and self._is_tag(idx + 1, name):
+                    self.tag_start = idx + 1
+                    self.tag_end = xml.find(self._gt, idx, self.end)
+                    self.pos = self.tag_end + 1
+                    values[i] = self.text()
+                    remaining -= 1
+                    break
+            idx = xml.find(lt, max(idx + 1, self.pos), self.end)
+        return values
+
+
+def _find_start_tag(xml, start_tag, start=0):
+    """Finds `start_tag` ('<' and the name) in `xml`, but not a longer name
+    that starts the same way. A match right at the end of `xml` counts, as
+    the rest of it may not have been read yet."""
+    idx = xml.find(start_tag, start)
+    while idx != -1:
+        after = idx + len(start_tag)
+        if after == len(xml) or xml[after] in _TERMINATORS:
+            return idx
+        idx = xml.find(start_tag, idx + 1)
+    return -1
+
+
+def elements(f, tag, read_size=DEFAULT_READ_SIZE):
+    """Reads a document from file-like `f`, yielding (xml, start, end) for
+    each <tag> element as soon as it has been read. xml[start:end] is the
+    whole element, from '<' to the end of its closing tag.
+
+    Only the element currently being read is held in memory. <tag> elements
+    must not be nested.
+    """
+    start_tag = '<' + tag
+    end_tag = '</' + tag + '>'
+    xml = ''
+    # Where to start looking for the next end tag. We don't want to re-scan
+    # the whole element each time we read another chunk.
+    search_from = 0
+    while True:
+        end = xml.find(end_tag, search_from)
+        if end == -1:
+            data = f.read(read_size)
+            if not data:
+                return
+            # Throw away anything before the current element, being careful
+            # not to lose the start of a tag split across reads.
+            start = _find_start_tag(xml, start_tag)
+            if start == -1:
+                start = max(0, len(xml) - len(end_tag))
+            xml = xml[start:]
+            search_from = max(0, len(xml) - len(end_tag))
+            xml += data
+            continue
+
+        end += len(end_tag)
+        yield xml, _find_start_tag(xml, start_tag), end
+        xml = xml[end:]
+        search_from = 0
+
+
+def children(f, tag, read_size=DEFAULT_READ_SIZE):
+    """Reads a document from file-like `f`, returning a dict of {name: text}
+    for the children of the first <tag> element. Children are expected to
+    only contain text, which is left escaped. Empty children are left out.
+
+    Nothing after </tag> is read. A large child is collected a chunk at a
+    time, and only joined together once all of it has been read.
+    """
+    start_tag = '<' + tag
+    end_tag = '</' + tag + '>'
+    values = dict()
+    xml = ''
+    pos = 0
+    in_tag = False
+    # The child we're part-way through, if any.
+    name = close_tag = pieces = None
+    while True:
+        data = f.read(read_size)
+        if not data:
+            raise ValueError('No </%s>' % tag)
+        xml = xml[pos:] + data
+        pos = 0
+        if not in_tag:
+            idx = _find_start_tag(xml, start_tag)
+            tag_end = -1 if idx == -1 else xml.find('>', idx)
+            if tag_end == -1:
+                # Keep anything that might be the start of the tag.
+                pos = max(0, len(xml) - len(start_tag)) if idx == -1 else idx
+                continue
+            pos = tag_end + 1
+            in_tag = True
+
+        while True:
+            if name is not None:
+                close = xml.find(close_tag, pos)
+                if close == -1:
+                    # Hang on to anything that might be the start of the
+                    # closing tag.
+                    keep = max(pos, len(xml) - len(close_tag) + 1)
+                    pieces.append(xml[pos:keep])
+                    pos = keep
+                    break
+                pieces.append(xml[pos:close])
+                value = pieces[0] if len(pieces) == 1 else ''.join(pieces)
+                if value:
+                    values[name] = value
+                pos = close + len(close_tag)
+                name = close_tag = pieces = None
+
+            lt = xml.find('<', pos)
+            if lt == -1:
+                # Just whitespace between children.
+                pos = len(xml)
+                break
+            if xml.startswith(end_tag, lt):
+                return values
+            gt = xml.find('>', lt)
+            if gt == -1:
+                pos = lt
+                break
+            pos = gt + 1
+            if xml[gt - 1] == '/':
+                # <Name/>
+                continue
+            name_end = xml.find(' ', lt, gt)
+            name = xml[lt + 1:gt if name_end == -1 else name_end]
+            close_tag = '</' + name + '>'
+            pieces = []